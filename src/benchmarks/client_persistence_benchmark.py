@@ -0,0 +1,104 @@
+"""
+Client persistence with 10,000 stored lists: the cost of saving after a single edit with the
+previous layout (every list rewritten to one indented JSON file) against one file per list, where
+only the edited list is written (aside, fsynced and renamed over the old file). Also times the
+one-off migration of the old file, and startup: decoding every list up front, as the client did,
+against opening the ListStore, which only lists the directory and decodes a list when it is used.
+Run from the src folder:
+    python -m benchmarks.client_persistence_benchmark
+"""
+import contextlib, io, orjson, os, shutil, tempfile, time, tracemalloc
+from storage import shopping_list_manager
+from storage.shopping_list_manager import ShoppingListManager
+from storage.list_store import ListStore
+
+LIST_COUNT = 10_000
+ITEMS_PER_LIST = 5
+EDITS = 20
+
+def build_manager(data_dir):
+    manager = ShoppingListManager(data_dir)
+    for i in range(LIST_COUNT):
+        list_id = manager.create_shopping_list()
+        for j in range(ITEMS_PER_LIST):
+            manager.add_item_to_list(list_id, f"product {i}-{j}", j + 1)
+    return manager
+
+def save_whole_file(manager, path):
+    # What save_to_json did before: every list, indented, over the same file
+    data = {list_id: ListStore.list_to_dict(shopping_list) for list_id, shopping_list in manager.shopping_lists.items()}
+    with open(path, 'wb') as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def measure(function):
+    """Seconds a call takes and bytes it leaves allocated."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, memory
+
+def load_whole_file(path):
+    # What load_from_json did before: every list decoded at startup
+    with open(path, 'rb') as file:
+        data = orjson.loads(file.read())
+    return {list_id: ListStore.list_from_dict(shopping_list_data) for list_id, shopping_list_data in data.items()}
+
+def main():
+    root = tempfile.mkdtemp(prefix="client-persistence-benchmark-")
+    try:
+        legacy_path = os.path.join(root, "shopping_list_data.json")
+        data_dir = os.path.join(root, "lists")
+        # add_item_to_list prints a line per item
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = build_manager(data_dir)
+        list_ids = list(manager.shopping_lists)
+
+        start = time.perf_counter()
+        for i in range(EDITS):
+            manager.shopping_lists[list_ids[i]].add_item("milk", 1)
+            save_whole_file(manager, legacy_path)
+        whole_file = (time.perf_counter() - start) / EDITS
+        legacy_size = os.path.getsize(legacy_path)
+        del manager
+        eager, eager_time, eager_memory = measure(lambda: load_whole_file(legacy_path))
+        del eager
+
+        shopping_list_manager.LEGACY_DATA_PATH = legacy_path
+        start = time.perf_counter()
+        manager = ShoppingListManager(data_dir)
+        manager.load_from_json()
+        migration = time.perf_counter() - start
+
+        def open_lazily():
+            manager = ShoppingListManager(data_dir)
+            manager.load_from_json()
+            return manager
+        manager, lazy_time, lazy_memory = measure(open_lazily)
+        start = time.perf_counter()
+        manager.get_shopping_list(list_ids[0])
+        first_access = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(EDITS):
+            manager.increment_product_quantity(list_ids[i], manager.get_item_id_by_name(list_ids[i], "milk"))
+            manager.save_to_json()
+        per_list = (time.perf_counter() - start) / EDITS
+        files_size = sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir))
+
+        print(f"{LIST_COUNT:,} lists of {ITEMS_PER_LIST} items")
+        print(f"{'layout':>13} | {'ms per save after one edit':>26} | {'bytes written per save':>22} | {'size on disk':>12}")
+        print(f"{'one file':>13} | {whole_file * 1000:>26.2f} | {legacy_size:>22,} | {legacy_size:>12,}")
+        print(f"{'file per list':>13} | {per_list * 1000:>26.2f} | {files_size // LIST_COUNT:>22,} | {files_size:>12,}")
+        print(f"migration of the one file: {migration:.2f} s")
+        print(f"{'startup':>13} | {'seconds':>7} | {'memory (MB)':>11}")
+        print(f"{'decode all':>13} | {eager_time:>7.3f} | {eager_memory / 1e6:>11.1f}")
+        print(f"{'lazy':>13} | {lazy_time:>7.3f} | {lazy_memory / 1e6:>11.1f}")
+        print(f"(lazy: first use of a list reads and decodes it in {first_access * 1000:.2f} ms)")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
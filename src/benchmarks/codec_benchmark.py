@@ -0,0 +1,58 @@
+"""
+Compare the binary wire codec with the previous jsonpickle + orjson + zlib path.
+Run from the src folder:
+    python -m benchmarks.codec_benchmark
+"""
+import time, zlib, orjson, jsonpickle
+from crdt.shopping_list import ShoppingList
+from communication.codec import compress_data, decompress_data
+
+ITEM_COUNTS = [1, 10, 100, 1000, 10000]
+
+def legacy_compress_data(data):
+    """Previous wire path: jsonpickle the CRDT, orjson the envelope, zlib everything."""
+    data = dict(data)
+    if 'hash_ring' in data:
+        data['hash_ring'] = {str(key): value for key, value in data['hash_ring'].items()}
+    if 'shopping_list' in data:
+        data['shopping_list'] = jsonpickle.dumps(data['shopping_list'])
+    return zlib.compress(orjson.dumps(data))
+
+def legacy_decompress_data(compressed_data):
+    data = orjson.loads(zlib.decompress(compressed_data))
+    if 'hash_ring' in data:
+        data['hash_ring'] = {int(key): value for key, value in data['hash_ring'].items()}
+    if 'shopping_list' in data:
+        data['shopping_list'] = jsonpickle.loads(data['shopping_list'])
+    return data
+
+def build_message(item_count):
+    shopping_list = ShoppingList()
+    for i in range(item_count):
+        shopping_list.add_item(f"product {i}", i % 7 + 1)
+    return {"operation": "write", "list_id": "3f1c2e52-8f43-4d55-9a43-7b2b8e1d0c11", "shopping_list": shopping_list}
+
+def measure(function, argument):
+    # Repeat until at least 0.2s has elapsed to get a stable per-call time
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        result = function(argument)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > 0.2:
+            return result, elapsed / runs
+
+def main():
+    print(f"{'items':>6} | {'codec':>6} | {'encode us':>10} | {'decode us':>10} | {'bytes':>8}")
+    for item_count in ITEM_COUNTS:
+        message = build_message(item_count)
+        for name, encode, decode in (("legacy", legacy_compress_data, legacy_decompress_data),
+                                     ("binary", compress_data, decompress_data)):
+            encoded, encode_time = measure(encode, message)
+            decoded, decode_time = measure(decode, encoded)
+            assert len(decoded["shopping_list"].get_shopping_list()) == item_count
+            print(f"{item_count:>6} | {name:>6} | {encode_time * 1e6:>10.1f} | {decode_time * 1e6:>10.1f} | {len(encoded):>8}")
+
+if __name__ == "__main__":
+    main()
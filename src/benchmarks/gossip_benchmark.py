@@ -0,0 +1,126 @@
+"""
+Membership for 5 to 200 nodes, simulated in one process through the message codec: the previous
+protocol (every node sends its node states and the full hash ring to every other node, which
+answers with its own) against the SWIM failure detector and membership gossip (a ping to one
+member, and a checksum to GOSSIP_FANOUT random peers per protocol period). Measures the bytes each
+node sends and receives per period and the CPU time of a period once the membership converged,
+and the seconds until every other node removes a node that died.
+Run from the src folder:
+    python -m benchmarks.gossip_benchmark
+"""
+import random, time
+from communication.codec import compress_data, decompress_data
+from dynamo.consistent_hash import ConsistentHash
+from dynamo.gossipProtocol import GossipProtocol, GOSSIP_FANOUT, PROTOCOL_PERIOD
+from dynamo.metrics import Metrics
+
+NODE_COUNTS = [5, 10, 50, 100, 200]
+PERIODS = 5
+# Simulated seconds between two steps of the cluster, a divisor of the protocol period
+STEP = PROTOCOL_PERIOD / 4
+
+class SimulatedNode:
+    """Just what the gossip protocol uses of a node."""
+    def __init__(self):
+        self.metrics = Metrics()
+
+    def update_hash_ring(self, node_id, state, address=None, weight=1):
+        pass
+
+class SimulatedGossip(GossipProtocol):
+    """Gossip whose messages are handled in-process by their target, still encoded and decoded, on a simulated clock."""
+    def __init__(self, node_id, config, cluster):
+        super().__init__(node_id, SimulatedNode(), config)
+        self.cluster = cluster
+        self.alive = True
+
+    def clock(self):
+        return self.cluster["time"]
+
+    def send(self, node_id, message, callback, timeout, address=None):
+        peer = self.cluster.get(address or self.get_address(node_id))
+        if peer is None or not peer.alive:
+            # No answer: the callback runs when the request would time out
+            self.callbacks[object()] = (callback, self.clock() + timeout)
+            return
+        payload = compress_data(message)
+        message = decompress_data(payload)
+        self.node.metrics.incr("gossip_bytes", len(payload))
+
+        def reply(response):
+            response = compress_data(response)
+            self.node.metrics.incr("gossip_bytes", len(response))
+            callback(decompress_data(response))
+
+        if message["operation"] == "ping_req":
+            peer.handle_ping_req(message, reply)
+        else:
+            handlers = {"ping": peer.handle_ping, "gossip": peer.handle_gossip, "gossip_push": peer.handle_push}
+            reply(handlers[message["operation"]](message))
+
+    def step(self):
+        """What the event loop does at the current time."""
+        if self.clock() >= getattr(self, "next_period", 0):
+            self.period()
+            self.next_period = self.clock() + self.protocol_period
+        self.expire(self.clock())
+        self.check_suspicions(self.clock())
+
+def full_state_round(node_count, ring):
+    """Bytes a node exchanges in one round of the previous protocol, and the CPU time of the round."""
+    node_states = {f"node{i}": "alive" for i in range(node_count)}
+    start = time.perf_counter()
+    sent = 0
+    for _ in range(node_count - 1):
+        for message in ({"operation": "gossip", "node_id": "node0", "node_states": node_states, "hash_ring": ring.ring},
+                        {"status": "success", "node_id": "node1", "node_states": node_states, "hash_ring": ring.ring}):
+            payload = compress_data(message)
+            decompress_data(payload)
+            sent += len(payload)
+    return sent, time.perf_counter() - start
+
+def run(cluster, nodes, seconds):
+    for _ in range(round(seconds / STEP)):
+        cluster["time"] += STEP
+        for node in nodes:
+            if node.alive:
+                node.step()
+
+def main():
+    random.seed(1)
+    print(f"{'nodes':>5} | {'protocol':>10} | {'bytes/node/period':>17} | {'ms/node/period':>14} | {'seconds to remove a dead node':>29}")
+    for node_count in NODE_COUNTS:
+        config = [{"node_id": f"node{i}", "address": f"tcp://localhost:{5001 + i}"} for i in range(node_count)]
+        ring = ConsistentHash()
+        for node in config:
+            ring.add_node(node["node_id"], node["address"])
+        sent, elapsed = full_state_round(node_count, ring)
+        print(f"{node_count:>5} | {'full state':>10} | {sent:>17,} | {elapsed * 1000:>14.2f} | {'one gossip interval':>29}")
+
+        cluster = {"time": 0.0}
+        for node in config:
+            cluster[node["address"]] = SimulatedGossip(node["node_id"], config, cluster)
+        nodes = [cluster[node["address"]] for node in config]
+        # Converge: every node learns every other one
+        while len({node.get_checksum() for node in nodes}) > 1:
+            run(cluster, nodes, PROTOCOL_PERIOD)
+
+        for node in nodes:
+            node.node.metrics.set("gossip_bytes", 0)
+        start = time.perf_counter()
+        run(cluster, nodes, PERIODS * PROTOCOL_PERIOD)
+        elapsed = (time.perf_counter() - start) / PERIODS / node_count
+        sent = sum(node.node.metrics.get("gossip_bytes") for node in nodes) / PERIODS / node_count
+
+        # A node dies: time until every other node declared it dead
+        dead = nodes[-1]
+        dead.alive = False
+        died_at = cluster["time"]
+        while any(node.get_state(dead.node_id) != "dead" for node in nodes[:-1]):
+            run(cluster, nodes, STEP)
+        detection = cluster["time"] - died_at
+        print(f"{node_count:>5} | {'swim':>10} | {sent:>17,.0f} | {elapsed * 1000:>14.2f} | {detection:>29.2f}")
+    print(f"(swim: {PROTOCOL_PERIOD}s protocol period, {GOSSIP_FANOUT} gossip peers per period; full state: every other node per round)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Memory of shopping list items, in bytes per item, for 100,000 items spread over 1,000 lists decoded
+from the wire (as a node holds them), a fifth of them removed or acquired. Compares the previous
+layout, rebuilt here from the same lists: a (name, counter, acquired) tuple per item in add_map and
+again in removed_map or acquired_map, dots in two more dictionaries, counters with a __dict__ and
+every name decoded into its own string; against one slotted Entry per item with interned names.
+The entries figure counts whole lists (name index, causal context included), the other only the maps.
+Run from the src folder:
+    python -m benchmarks.memory_benchmark
+"""
+import gc, random, tracemalloc
+from crdt.shopping_list import ShoppingList
+from crdt.or_map import REMOVED, ACQUIRED
+from communication.codec import compress_data, decompress_data
+
+LIST_COUNT = 1_000
+ITEMS_PER_LIST = 100
+# Item names are drawn from a catalog of products, as real lists share most of them
+PRODUCTS = 500
+TOMBSTONE_RATIO = 0.2
+
+class DictCounter:
+    # The counter as it was, with a per-instance __dict__
+    def __init__(self, positive, negative):
+        self.positive = positive
+        self.negative = negative
+
+def copy_string(value):
+    # A string that is equal to value but not the same object, as a decoder without interning returns
+    return value.encode().decode()
+
+def build_lists():
+    rng = random.Random(0)
+    lists = []
+    for i in range(LIST_COUNT):
+        shopping_list = ShoppingList(f"replica-{i % 3}")
+        for product in rng.sample(range(PRODUCTS), ITEMS_PER_LIST):
+            shopping_list.add_item(f"product {product}", rng.randint(1, 5))
+        for item_id in list(shopping_list.get_shopping_list()):
+            if rng.random() < TOMBSTONE_RATIO:
+                if rng.random() < 0.5:
+                    shopping_list.remove_item(item_id)
+                else:
+                    shopping_list.mark_item_acquired(item_id)
+        lists.append(compress_data({"shopping_list": shopping_list}))
+    return lists
+
+def decode_entries(encoded_lists):
+    return [decompress_data(data)["shopping_list"] for data in encoded_lists]
+
+def decode_maps(encoded_lists):
+    """The lists in the previous layout: add_map, removed_map, acquired_map, dots and removal_dots."""
+    lists = []
+    for data in encoded_lists:
+        or_map = decompress_data(data)["shopping_list"].or_map
+        add_map, removed_map, acquired_map, dots, removal_dots = {}, {}, {}, {}, {}
+        for item_id, entry in or_map.items.items():
+            item_id = copy_string(item_id)
+            item = (copy_string(entry.name), DictCounter(entry.counter.positive, entry.counter.negative), bool(entry.state & ACQUIRED))
+            add_map[item_id] = item
+            if entry.state & REMOVED:
+                removed_map[item_id] = item
+            if entry.state & ACQUIRED:
+                acquired_map[item_id] = item
+            dots[item_id] = (copy_string(entry.dot[0]), entry.dot[1])
+            if entry.removal_dot is not None:
+                removal_dots[item_id] = (copy_string(entry.removal_dot[0]), entry.removal_dot[1])
+        lists.append((add_map, removed_map, acquired_map, dots, removal_dots))
+    return lists
+
+def measure(decode, encoded_lists):
+    """Bytes held by the decoded lists, without the intermediate objects of decoding."""
+    gc.collect()
+    tracemalloc.start()
+    lists = decode(encoded_lists)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del lists
+    return memory
+
+def main():
+    encoded_lists = build_lists()
+    item_count = LIST_COUNT * ITEMS_PER_LIST
+    print(f"{item_count:,} items in {LIST_COUNT:,} lists, {TOMBSTONE_RATIO:.0%} removed or acquired")
+    print(f"{'layout':>14} | {'MB':>6} | {'bytes per item':>14}")
+    for name, decode in (("three maps", decode_maps), ("entries", decode_entries)):
+        memory = measure(decode, encoded_lists)
+        print(f"{name:>14} | {memory / 1e6:>6.1f} | {memory / item_count:>14.0f}")
+
+if __name__ == "__main__":
+    main()
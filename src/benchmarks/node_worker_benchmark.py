@@ -0,0 +1,102 @@
+"""
+Throughput of a Node for 1 to 8 worker threads: concurrent clients write lists of a few hundred
+items to a node (one list per client), while a prober measures the latency of 'stats' requests,
+which the main loop answers between the workers' responses (they used to wait behind every merge).
+Writes are CPU-bound Python (decode, merge, encode) and the workers share the GIL: throughput does
+not grow with more threads, and the main loop waits longer for the GIL as they are added. Threads
+only overlap the writes' waits for the disk; a machine's other cores are used by running more nodes
+on it, the ring spreads the lists over them.
+Run from the src folder:
+    python -m benchmarks.node_worker_benchmark
+"""
+import tempfile, threading, time, zmq
+from multiprocessing import Process
+from crdt.shopping_list import ShoppingList
+from communication.codec import compress_data, decompress_data
+from dynamo.consistent_hash import ConsistentHash
+from dynamo.replication_manager import ReplicationManager
+from dynamo.membership import MembershipService
+from dynamo.node import Node
+
+WORKERS = [1, 2, 4, 8]
+CLIENTS = 16
+REQUESTS_PER_CLIENT = 50
+ITEMS_PER_LIST = 300
+FIRST_PORT = 6101
+
+def run_node(node_id, port, worker_count, data_dir):
+    hash_ring = ConsistentHash()
+    hash_ring.add_node(node_id)
+    membership = MembershipService(hash_ring)
+    replication_manager = ReplicationManager(membership, replication_factor=1, nodes_config={node_id: f"tcp://localhost:{port}"})
+    # Nothing listens on the proxy address, the benchmark talks to the node's own port
+    node = Node(node_id, port, membership, replication_manager, known_nodes=[],
+                proxy_address="tcp://localhost:6199", worker_count=worker_count, data_dir=data_dir)
+    node.start()
+
+def build_payload(client_id):
+    """A full-state write: the node decodes, merges and encodes the whole list."""
+    shopping_list = ShoppingList(f"client{client_id}")
+    for i in range(ITEMS_PER_LIST):
+        shopping_list.add_item(f"product {i}", 1)
+    return compress_data({"operation": "write", "list_id": f"list{client_id}", "shopping_list": shopping_list})
+
+def client(port, payload, done):
+    # Payloads are encoded up front, so the clients only wait on the node
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect(f"tcp://localhost:{port}")
+    for _ in range(REQUESTS_PER_CLIENT):
+        socket.send_multipart([b"write", payload])
+        response = decompress_data(socket.recv())
+        assert "error" not in response, response
+    socket.close()
+    done.append(payload)
+
+def prober(port, stop, latencies):
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect(f"tcp://localhost:{port}")
+    while not stop.is_set():
+        start = time.perf_counter()
+        socket.send_multipart([b"stats", compress_data({"operation": "stats"})])
+        socket.recv()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    socket.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    payloads = [build_payload(client_id) for client_id in range(CLIENTS)]
+    print(f"{'workers':>7} | {'writes/s':>8} | {'stats p50 ms':>12} | {'stats p99 ms':>12}")
+    for index, worker_count in enumerate(WORKERS):
+        port = FIRST_PORT + index
+        # The node runs in its own process, so the clients do not compete with it for the GIL
+        data_dir = tempfile.TemporaryDirectory()
+        node = Process(target=run_node, args=(f"bench{index}", port, worker_count, data_dir.name), daemon=True)
+        node.start()
+        time.sleep(1)
+
+        done, latencies, stop = [], [], threading.Event()
+        probe = threading.Thread(target=prober, args=(port, stop, latencies))
+        clients = [threading.Thread(target=client, args=(port, payload, done)) for payload in payloads]
+        start = time.perf_counter()
+        probe.start()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        probe.join()
+        node.terminate()
+        node.join()
+        data_dir.cleanup()
+
+        assert len(done) == CLIENTS
+        writes = CLIENTS * REQUESTS_PER_CLIENT
+        print(f"{worker_count:>7} | {writes / elapsed:>8.0f} | {percentile(latencies, 0.5) * 1e3:>12.2f} | {percentile(latencies, 0.99) * 1e3:>12.2f}")
+
+if __name__ == "__main__":
+    main()
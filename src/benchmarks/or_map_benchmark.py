@@ -0,0 +1,48 @@
+"""
+Measure ORMap merge time for lists of 10k to 100k items.
+Run from the src folder:
+    python -m benchmarks.or_map_benchmark
+"""
+import time
+from crdt.shopping_list import ShoppingList
+from communication.codec import compress_data, decompress_data
+
+ITEM_COUNTS = [10000, 50000, 100000]
+
+def build_replicas(item_count):
+    """Two replicas sharing half of their items, plus a wire copy of the second one."""
+    # Each replica generates its own dots
+    local = ShoppingList("local")
+    remote = ShoppingList("remote")
+    for i in range(item_count):
+        local.add_item(f"product {i}", 1)
+    for i in range(item_count // 2, item_count + item_count // 2):
+        remote.add_item(f"product {i}", 2)
+    # Decode a wire copy so the merge sees independent objects, as it does on a node
+    remote = decompress_data(compress_data({"shopping_list": remote}))["shopping_list"]
+    return local, remote
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def main():
+    print(f"{'items':>7} | {'full merge ms':>13} | {'re-merge ms':>11} | {'1-item delta ms':>15} | {'live items':>10}")
+    for item_count in ITEM_COUNTS:
+        local, remote = build_replicas(item_count)
+        full_merge = timed(lambda: local.merge(remote))
+        # Merging the same state again must not change anything (idempotence)
+        size = len(local.or_map.items)
+        re_merge = timed(lambda: local.merge(remote))
+        assert len(local.or_map.items) == size
+
+        version = local.get_version()
+        local.increment_quantity(local.get_item_id("product 0"), 1)
+        delta = local.get_delta(version)
+        delta_merge = timed(lambda: remote.merge(delta))
+
+        print(f"{item_count:>7} | {full_merge * 1e3:>13.1f} | {re_merge * 1e3:>11.1f} | {delta_merge * 1e3:>15.3f} | {len(local.get_shopping_list()):>10}")
+
+if __name__ == "__main__":
+    main()
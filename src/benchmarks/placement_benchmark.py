@@ -0,0 +1,55 @@
+"""
+Replica placement over a million keys: the old get_replicas (the primary followed by the next
+nodes in insertion order) against ConsistentHash.get_preference_list (the first distinct nodes
+walking the ring clockwise). Shows the share of replicas each node holds, how far the busiest
+node is from a fair share, and the lookup cost per key. Every node has weight 1, so with the
+default VIRTUAL_NODES each node places 64 virtual nodes (a node of weight 2 would place 128);
+with the 3 per node the ring used to place, its ranges are so uneven that even the ring walk
+is not balanced.
+Run from the src folder:
+    python -m benchmarks.placement_benchmark
+"""
+import time
+from dynamo.consistent_hash import ConsistentHash, VIRTUAL_NODES
+
+KEYS = 1_000_000
+NODE_COUNTS = [5, 10]
+# Virtual nodes per node: as the ring used to place, and its default
+VIRTUAL_NODE_COUNTS = [3, VIRTUAL_NODES]
+REPLICATION_FACTOR = 3
+
+def insertion_order_replicas(ring, key, count):
+    """The placement get_replicas used before the preference lists."""
+    primary_node = ring.get_node(key)
+    all_nodes = ring.get_nodes()
+    start_index = all_nodes.index(primary_node)
+    return [all_nodes[(start_index + i) % len(all_nodes)] for i in range(min(count, len(all_nodes)))]
+
+def preference_list_replicas(ring, key, count):
+    return ring.get_preference_list(key, count)
+
+def measure(ring, keys, placement):
+    load = {node: 0 for node in ring.get_nodes()}
+    start = time.perf_counter()
+    for key in keys:
+        for node in placement(ring, key, REPLICATION_FACTOR):
+            load[node] += 1
+    elapsed = time.perf_counter() - start
+    fair = len(keys) * REPLICATION_FACTOR / len(load)
+    return elapsed, {node: count / fair for node, count in load.items()}
+
+def main():
+    keys = [f"list-{i}" for i in range(KEYS)]
+    print(f"{'nodes':>5} | {'vnodes':>6} | {'placement':>16} | {'us/key':>6} | {'max/fair':>8} | {'min/fair':>8} | load per node (x fair share)")
+    for node_count in NODE_COUNTS:
+        for virtual_nodes in VIRTUAL_NODE_COUNTS:
+            ring = ConsistentHash(replicas=virtual_nodes)
+            for i in range(1, node_count + 1):
+                ring.add_node(f"node{i}")
+            for name, placement in [("insertion order", insertion_order_replicas), ("preference list", preference_list_replicas)]:
+                elapsed, shares = measure(ring, keys, placement)
+                loads = " ".join(f"{share:.2f}" for share in shares.values())
+                print(f"{node_count:>5} | {virtual_nodes:>6} | {name:>16} | {elapsed / len(keys) * 1e6:>6.2f} | {max(shares.values()):>8.2f} | {min(shares.values()):>8.2f} | {loads}")
+
+if __name__ == "__main__":
+    main()
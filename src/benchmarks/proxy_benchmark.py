@@ -0,0 +1,80 @@
+"""
+Load generator for the proxy: measures requests/second and p50/p99 latency.
+Nodes are replaced by echo workers so only the proxy is measured.
+Run from the src folder:
+    python -m benchmarks.proxy_benchmark
+"""
+import asyncio, threading, time, uuid, zmq
+from dynamo.consistent_hash import ConsistentHash
+from communication.codec import compress_data
+from server import run_proxy
+
+FRONTEND_PORT = 6558
+BACKEND_PORT = 6559
+NODES = ["node1", "node2", "node3", "node4", "node5"]
+CLIENTS = [1, 8, 32]
+REQUESTS_PER_CLIENT = 500
+
+def echo_node(node_id, stop):
+    """Answer every request forwarded by the proxy with its own payload."""
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, node_id.encode())
+    socket.connect(f"tcp://localhost:{BACKEND_PORT}")
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    while not stop.is_set():
+        if poller.poll(100):
+            _, client_id, payload = socket.recv_multipart()
+            socket.send_multipart([b'proxy_identity', client_id, b'', payload])
+    socket.close()
+
+def client(latencies, request_count):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.connect(f"tcp://localhost:{FRONTEND_PORT}")
+    for _ in range(request_count):
+        list_id = str(uuid.uuid4())
+        payload = compress_data({"operation": "read", "list_id": list_id})
+        start = time.perf_counter()
+        socket.send_multipart([list_id.encode(), payload])
+        socket.recv()
+        latencies.append(time.perf_counter() - start)
+    socket.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    hash_ring = ConsistentHash()
+    for node_id in NODES:
+        hash_ring.add_node(node_id)
+
+    proxy = threading.Thread(target=lambda: asyncio.run(run_proxy(hash_ring, f"tcp://*:{FRONTEND_PORT}", f"tcp://*:{BACKEND_PORT}")), daemon=True)
+    proxy.start()
+    stop = threading.Event()
+    nodes = [threading.Thread(target=echo_node, args=(node_id, stop)) for node_id in NODES]
+    for node in nodes:
+        node.start()
+    # Let every node connect before routing to it
+    time.sleep(1)
+
+    print(f"{'clients':>7} | {'requests/s':>10} | {'p50 ms':>7} | {'p99 ms':>7}")
+    for client_count in CLIENTS:
+        latencies = []
+        clients = [threading.Thread(target=client, args=(latencies, REQUESTS_PER_CLIENT)) for _ in range(client_count)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"{client_count:>7} | {len(latencies) / elapsed:>10.0f} | {percentile(latencies, 0.5) * 1e3:>7.2f} | {percentile(latencies, 0.99) * 1e3:>7.2f}")
+
+    stop.set()
+    for node in nodes:
+        node.join()
+
+if __name__ == "__main__":
+    main()
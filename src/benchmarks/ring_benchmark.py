@@ -0,0 +1,48 @@
+"""
+Hash ring for 5 to 200 nodes: the previous ring (SHA-256, 3 virtual nodes per node, no cache)
+against the current one (CRC32 + multiplicative mix, 64 virtual nodes), without and with its LRU
+lookup cache. Measures get_node throughput for distinct keys (every lookup misses the cache) and
+for a hot working set of keys, and the standard deviation of the keys owned by each node (% of the mean).
+Run from the src folder:
+    python -m benchmarks.ring_benchmark
+"""
+import hashlib, statistics, time
+from collections import Counter
+from dynamo.consistent_hash import ConsistentHash
+
+NODE_COUNTS = [5, 10, 50, 100, 200]
+KEYS = 200_000
+HOT_KEYS = 1_000
+
+class Sha256ConsistentHash(ConsistentHash):
+    """The ring as it was: SHA-256 through a hex string, 3 virtual nodes and no cache."""
+    def __init__(self):
+        super().__init__(replicas=3, cache_size=0)
+
+    def _hash(self, key):
+        return int(hashlib.sha256(key.encode()).hexdigest(), 16) & self.hash_mask
+
+def lookups_per_second(ring, keys):
+    start = time.perf_counter()
+    for key in keys:
+        ring.get_node(key)
+    return len(keys) / (time.perf_counter() - start)
+
+def main():
+    keys = [f"list-{i}" for i in range(KEYS)]
+    hot_keys = keys[:HOT_KEYS] * (KEYS // HOT_KEYS)
+    print(f"{'nodes':>5} | {'ring':>9} | {'distinct keys/s':>15} | {'hot keys/s':>10} | {'load stdev %':>12}")
+    for node_count in NODE_COUNTS:
+        for name, ring in [("sha256", Sha256ConsistentHash()), ("crc32", ConsistentHash(cache_size=0)), ("crc32+lru", ConsistentHash())]:
+            for i in range(node_count):
+                ring.add_node(f"node{i}", f"tcp://localhost:{5001 + i}")
+            distinct = lookups_per_second(ring, keys)
+            hot = lookups_per_second(ring, hot_keys)
+
+            load = Counter(ring.get_node(key) for key in keys)
+            counts = [load.get(node, 0) for node in ring.get_nodes()]
+            deviation = statistics.pstdev(counts) / statistics.mean(counts) * 100
+            print(f"{node_count:>5} | {name:>9} | {distinct:>15,.0f} | {hot:>10,.0f} | {deviation:>12.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Node warm start with 1,000 and 10,000 lists of 10 items: time until the node can serve a read and
+memory in use then, for each format the lists can be loaded from:
+    json     one JSON document of every list, decoded at once (the client's loader)
+    records  the codec records of the previous snapshot format, every list decoded and merged
+    mapped   the columnar snapshot, opened with mmap: only the list IDs are read, the one list
+             served is decoded on demand
+Run from the src folder:
+    python -m benchmarks.snapshot_benchmark
+"""
+import orjson, os, shutil, tempfile, time, tracemalloc
+from crdt.shopping_list import ShoppingList
+from storage.list_store import ListStore
+from storage.shopping_list_manager import ShoppingListManager
+from storage.snapshot import Snapshot, SnapshotWriter, SnapshotLists
+from storage.storage_engine import StorageEngine
+
+LIST_COUNTS = [1_000, 10_000]
+ITEMS_PER_LIST = 10
+# Item names are drawn from a catalog of products, as real lists share most of them
+PRODUCTS = 500
+
+def build_lists(count):
+    lists = {}
+    for i in range(count):
+        shopping_list = ShoppingList()
+        for j in range(ITEMS_PER_LIST):
+            shopping_list.add_item(f"product {(i * 7 + j * 13) % PRODUCTS}", j + 1)
+        shopping_list.remove_item(shopping_list.get_item_id(f"product {(i * 7) % PRODUCTS}"))
+        lists[f"list-{i}"] = shopping_list
+    return lists
+
+def load_json(path):
+    with open(path, 'rb') as file:
+        data = orjson.loads(file.read())
+    return {list_id: ListStore.list_from_dict(shopping_list_data) for list_id, shopping_list_data in data.items()}
+
+def load_records(path):
+    manager = ShoppingListManager()
+    records, _ = StorageEngine.read_records(path)
+    for record in records:
+        StorageEngine.apply(manager, record, {})
+    return manager.shopping_lists
+
+def load_mapped(path):
+    return SnapshotLists(Snapshot(path))
+
+def measure(load, path, list_id):
+    """Seconds until the first read is served and bytes in use then."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    lists = load(path)
+    shopping_list = lists.peek(list_id) if isinstance(lists, SnapshotLists) else lists[list_id]
+    shopping_list.get_shopping_list()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, memory
+
+def main():
+    print(f"{'lists':>6} | {'format':>7} | {'file (KB)':>9} | {'seconds to first read':>21} | {'memory (MB)':>11}")
+    for count in LIST_COUNTS:
+        lists = build_lists(count)
+        root = tempfile.mkdtemp(prefix="snapshot-benchmark-")
+        try:
+            paths = {"json": os.path.join(root, "lists.json"), "records": os.path.join(root, "snapshot.dat"),
+                     "mapped": os.path.join(root, "snapshot.snap")}
+            with open(paths["json"], 'wb') as file:
+                file.write(orjson.dumps({list_id: ListStore.list_to_dict(shopping_list) for list_id, shopping_list in lists.items()}))
+            with open(paths["records"], 'wb') as file:
+                for list_id, shopping_list in lists.items():
+                    file.write(StorageEngine.frame({"operation": "merge", "list_id": list_id, "shopping_list": shopping_list,
+                                                    "version": shopping_list.get_version()}))
+            writer = SnapshotWriter()
+            writer.set_catalog(ShoppingListManager().list_ids)
+            for list_id, shopping_list in lists.items():
+                writer.add(list_id, shopping_list)
+            with open(paths["mapped"], 'wb') as file:
+                writer.write(file)
+
+            list_id = f"list-{count // 2}"
+            for name, load in (("json", load_json), ("records", load_records), ("mapped", load_mapped)):
+                elapsed, memory = measure(load, paths[name], list_id)
+                size = os.path.getsize(paths[name])
+                print(f"{count:>6,} | {name:>7} | {size / 1024:>9,.0f} | {elapsed:>21.4f} | {memory / 1e6:>11.2f}")
+        finally:
+            shutil.rmtree(root)
+    print("(times and memory of Python objects measured under tracemalloc; the mapped file itself is in the page cache)")
+
+if __name__ == "__main__":
+    main()
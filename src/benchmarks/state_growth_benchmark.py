@@ -0,0 +1,104 @@
+"""
+Regression benchmark for ShoppingList state growth.
+Two clients write to two replicas that replicate to each other, replaying thousands of
+write/merge cycles over a fixed catalog of products. Edits add, increment and decrement items,
+remove or acquire them and add them back, so every cycle may leave a tombstone; the replicas
+compact the tombstones both of them have seen every COMPACTION_INTERVAL cycles, as nodes do.
+Once compacted, the state must stay flat: no tombstones left on the replicas, every entry a live
+item of the catalog, and clients dropping the compacted tombstones when they sync.
+Run from the src folder:
+    python -m benchmarks.state_growth_benchmark
+"""
+import random, time
+from crdt.shopping_list import ShoppingList
+from crdt.causal_context import stable_version_vector
+from communication.codec import compress_data, decompress_data
+
+CYCLES = 5000
+WARMUP = 500
+COMPACTION_INTERVAL = 250
+CATALOG = [f"product {i}" for i in range(50)]
+
+def wire(shopping_list):
+    """Round-trip a list through the codec, as every write and replicate does."""
+    return decompress_data(compress_data({"shopping_list": shopping_list}))["shopping_list"]
+
+def state_size(shopping_list):
+    """(entries, live items, tombstones, encoded bytes) of a list."""
+    entries = len(shopping_list.or_map.items)
+    tombstones = shopping_list.count_tombstones()
+    return entries, entries - tombstones, tombstones, len(compress_data({"shopping_list": shopping_list}))
+
+def edit(rng, shopping_list):
+    item_name = rng.choice(CATALOG)
+    item_id = shopping_list.get_item_id(item_name)
+    if item_id is None:
+        # Adding back a removed or acquired item creates a new incarnation of it
+        shopping_list.add_item(item_name, rng.randint(1, 3))
+        return "add"
+    operation = rng.random()
+    if operation < 0.15:
+        shopping_list.remove_item(item_id)
+        return "remove"
+    if operation < 0.3:
+        shopping_list.mark_item_acquired(item_id)
+        return "acquire"
+    if operation < 0.8 or shopping_list.get_shopping_list()[item_id][1] <= 1:
+        shopping_list.increment_quantity(item_id, rng.randint(1, 3))
+    else:
+        shopping_list.decrement_quantity(item_id, 1)
+    return "update"
+
+def sync(client, replica):
+    """Client write: ship the client's state, merge the replica's answer back."""
+    replica.merge(wire(client))
+    client.merge(wire(replica))
+
+def compact(replicas):
+    """Drop the tombstones every replica has seen, returns how many were reclaimed."""
+    stable_vv = stable_version_vector([replica.get_context() for replica in replicas])
+    return sum(replica.compact(stable_vv) for replica in replicas)
+
+def main():
+    rng = random.Random(42)
+    clients = [ShoppingList("client1"), ShoppingList("client2")]
+    replicas = [ShoppingList("node1"), ShoppingList("node2")]
+
+    start = time.perf_counter()
+    operations = {}
+    reclaimed = 0
+    sizes, client_entries = [], []
+    print(f"{'cycle':>5} | {'entries':>7} | {'live':>4} | {'tombstones':>10} | {'client entries':>14} | {'bytes':>6}")
+    for cycle in range(1, CYCLES + 1):
+        index = rng.randrange(2)
+        operation = edit(rng, clients[index])
+        operations[operation] = operations.get(operation, 0) + 1
+        sync(clients[index], replicas[index])
+        # Replicate between the two nodes
+        replicas[1 - index].merge(wire(replicas[index]))
+
+        if cycle % COMPACTION_INTERVAL == 0:
+            reclaimed += compact(replicas)
+            if cycle >= WARMUP:
+                sizes.append(state_size(replicas[0]))
+                client_entries.append(max(len(client.or_map.items) for client in clients))
+                entries, live, tombstones, encoded = sizes[-1]
+                print(f"{cycle:>5} | {entries:>7} | {live:>4} | {tombstones:>10} | {client_entries[-1]:>14} | {encoded:>6}")
+
+    elapsed = time.perf_counter() - start
+    print(f"{CYCLES} cycles in {elapsed:.2f}s: " + ", ".join(f"{count} {operation}" for operation, count in sorted(operations.items())))
+    print(f"{reclaimed} tombstones reclaimed")
+
+    entries = [size[0] for size in sizes]
+    # The number of live items varies with the edits, the bytes each of them takes must not
+    encoded = [size[3] / size[0] for size in sizes]
+    # Compaction reclaims every tombstone the replicas share, and every logical item keeps one live ID
+    assert all(size[2] == 0 for size in sizes), f"tombstones left after compaction: {[size[2] for size in sizes]}"
+    assert max(entries) <= len(CATALOG), f"state grew to {max(entries)} entries"
+    # Clients also hold the tombstones made since the last compaction, until they sync the compacted state
+    assert max(client_entries) <= len(CATALOG) + COMPACTION_INTERVAL, f"client state grew to {max(client_entries)} entries"
+    # Counters and retired incarnations keep growing, which may add a few varint bytes but never whole entries
+    assert max(encoded) <= min(encoded) * 1.2, f"encoded bytes per entry are not flat: {[round(size) for size in encoded]}"
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
-import zmq, uuid
-from storage.shopping_list_manager import ShoppingListManager
+import zmq, uuid, weakref
+from communication.codec import compress_data, decompress_data
 
 class Client:
     # Initialize client with REQ-REP proxy address
@@ -9,10 +9,11 @@ class Client:
         self.req_socket = self.context.socket(zmq.REQ)
         self.req_socket.connect(proxy_req_address)
 
-        self.shopping_list_manager = ShoppingListManager()
-
         self.server_availabilty = False
 
+        # Versions of each list the cloud has acknowledged: {list_id: (list, local_version, node_id, node_version)},
+        # the list as a weak reference: the versions only hold for the object they were taken from
+        self.synced_versions = {}
 
     def check_server_availability(self):
         """Ping the server to check availability."""
@@ -23,8 +24,9 @@ class Client:
         availability = False
         try:
             message = {"operation": "ping"}
-            compressed_message = self.shopping_list_manager.compress_data(message)
-            ping_socket.send(compressed_message)
+            compressed_message = compress_data(message)
+            # An empty routing frame tells the proxy this is a ping
+            ping_socket.send_multipart([b"", compressed_message])
             print("Pinging server...")
             ping_socket.recv()  # Expect a response to the ping
             availability = True
@@ -49,8 +51,10 @@ class Client:
 
         print(f"\nSending request: {request}")
             
-        self.req_socket.send(self.shopping_list_manager.compress_data(request))
-        response = self.shopping_list_manager.decompress_data(self.req_socket.recv())
+        # The list_id goes in a plaintext routing frame so the proxy never decodes the payload
+        routing_key = request.get("list_id", "").encode()
+        self.req_socket.send_multipart([routing_key, compress_data(request)])
+        response = decompress_data(self.req_socket.recv())
         return response
 
     # Create new shopping list
@@ -64,19 +68,39 @@ class Client:
         payload = {"list_id": list_id}
         response = self.send_request("read", payload)
         if "shopping_list" in response:
+            # The caller replaces its local list, so the next write ships the full state
+            self.synced_versions.pop(list_id, None)
             return response['shopping_list']
         elif self.server_availabilty == True:
             return False
         elif self.server_availabilty == False:
             return True
 
-    # Send list to node to be merged
+    # Send list changes to node to be merged and merge back the changes from the cloud
     def write_shopping_list(self, list, list_id):
-        payload = {"list_id": list_id}
-        response = self.send_request("write", payload, list)
-        if "shopping_list" in response:
-            return response['shopping_list']
-        return False
+        list_ref, local_version, node_id, node_version = self.synced_versions.get(list_id, (None, None, None, None))
+        if list_ref is None or list_ref() is not list:
+            # A list reloaded from disk (e.g. after it was evicted from memory) counts its versions from 0 again
+            local_version, node_id, node_version = None, None, None
+
+        # Ship only the changes since the last acknowledged write, or the full list
+        delta = list.get_delta(local_version)
+        payload = {"list_id": list_id, "delta": delta is not None, "since": node_version, "since_node": node_id}
+        response = self.send_request("write", payload, list if delta is None else delta)
+
+        if response.get("status") == "resync":
+            # The node does not hold the state the delta was computed against (e.g. the write reached another node)
+            self.synced_versions.pop(list_id, None)
+            return self.write_shopping_list(list, list_id)
+        if "shopping_list" not in response:
+            self.synced_versions.pop(list_id, None)
+            return False
+        if not self.server_availabilty:
+            return list
+
+        list.merge(response['shopping_list'])
+        self.synced_versions[list_id] = (weakref.ref(list), list.get_version(), response['node_id'], response['version'])
+        return list
 
     # Delete shopping list by ID
     def delete_shopping_list(self, list_id):
@@ -0,0 +1,379 @@
+import struct, sys, zlib
+from crdt.shopping_list import ShoppingList
+from crdt.or_map import ORMap, Entry
+from crdt.or_set import ORSet
+from crdt.pn_counter import PNCounter
+
+# Wire format version, bumped on every incompatible change of the layout below
+CODEC_VERSION = 3
+# Older versions still decoded (version 2 kept the items of an ORMap in three maps)
+READABLE_VERSIONS = (2, 3)
+
+# Payloads smaller than this are not worth compressing
+COMPRESS_THRESHOLD = 512
+
+# Header flags
+FLAG_COMPRESSED = 0x01
+
+# Value tags
+TAG_NONE = 0x00
+TAG_FALSE = 0x01
+TAG_TRUE = 0x02
+TAG_INT = 0x03
+TAG_STR = 0x04
+TAG_LIST = 0x05
+TAG_DICT = 0x06
+TAG_FLOAT = 0x07
+TAG_BYTES = 0x08
+TAG_SET = 0x09
+TAG_SHOPPING_LIST = 0x10
+TAG_OR_MAP = 0x11
+TAG_PN_COUNTER = 0x12
+TAG_OR_SET = 0x13
+
+# Item id tags
+ID_STR = 0x00
+ID_UUID = 0x01
+
+# Envelope fields encoded as a single byte; any other key is encoded as a string after FIELD_OTHER
+FIELDS = [
+    "operation", "list_id", "shopping_list", "status", "message", "error", "node_id",
+    "node_states", "hash_ring", "delta", "since", "since_node", "version", "context",
+    "checksum", "digest", "updates", "wanted", "target", "address", "ack", "members"
+]
+FIELD_IDS = {field: index for index, field in enumerate(FIELDS)}
+FIELD_OTHER = 0xFF
+
+_float = struct.Struct('<d')
+
+# Layout of an encoded message:
+#     [version: u8][flags: u8][body (zlib compressed if FLAG_COMPRESSED)]
+# The body is the envelope: a varint field count followed by (field id, value) pairs.
+# Values are a one byte tag followed by their payload; integers are zigzag varints,
+# strings and bytes are length prefixed and CRDTs use fixed schemas (see _write_or_map).
+
+def compress_data(data):
+    """
+    Encode a message (dict) to be sent over ZMQ.
+    :param data: The envelope (dict) to encode.
+    :return: Encoded byte data
+    """
+    buffer = bytearray()
+    _write_varint(buffer, len(data))
+    for key, value in data.items():
+        field_id = FIELD_IDS.get(key)
+        if field_id is None:
+            buffer.append(FIELD_OTHER)
+            _write_str(buffer, key)
+        else:
+            buffer.append(field_id)
+        _write_value(buffer, value)
+
+    flags = 0
+    body = bytes(buffer)
+    if len(body) >= COMPRESS_THRESHOLD:
+        compressed_body = zlib.compress(body)
+        if len(compressed_body) < len(body):
+            flags |= FLAG_COMPRESSED
+            body = compressed_body
+
+    return bytes((CODEC_VERSION, flags)) + body
+
+def decompress_data(compressed_data):
+    """
+    Decode a message received over ZMQ back to its original format.
+    :param compressed_data: The encoded data received.
+    :return: Decoded envelope (dict)
+    """
+    if len(compressed_data) < 2:
+        raise ValueError("Truncated message")
+    version, flags = compressed_data[0], compressed_data[1]
+    if version not in READABLE_VERSIONS:
+        raise ValueError(f"Unsupported codec version {version}")
+
+    body = compressed_data[2:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+
+    reader = _Reader(body, version)
+    data = {}
+    for _ in range(reader.read_varint()):
+        field_id = reader.read_byte()
+        key = reader.read_str() if field_id == FIELD_OTHER else FIELDS[field_id]
+        data[key] = reader.read_value()
+    return data
+
+def _write_varint(buffer, value):
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def _write_int(buffer, value):
+    # Zigzag encoding keeps small negative numbers short
+    _write_varint(buffer, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+def _write_str(buffer, value):
+    raw = value.encode()
+    _write_varint(buffer, len(raw))
+    buffer += raw
+
+def _write_id(buffer, item_id):
+    # Canonical uuid4 strings take 16 bytes instead of 36
+    if len(item_id) == 36 and item_id[8] == item_id[13] == item_id[18] == item_id[23] == '-':
+        hex_id = item_id.replace('-', '')
+        if len(hex_id) == 32 and hex_id == hex_id.lower():
+            try:
+                raw = bytes.fromhex(hex_id)
+            except ValueError:
+                raw = b''
+            if len(raw) == 16:
+                buffer.append(ID_UUID)
+                buffer += raw
+                return
+    buffer.append(ID_STR)
+    _write_str(buffer, item_id)
+
+def _write_dot(buffer, dot, replicas):
+    # Dots are (replica, counter) pairs, the replica is an index into the map's replica table
+    if dot is None:
+        buffer.append(0)
+    else:
+        _write_varint(buffer, replicas[dot[0]] + 1)
+        _write_varint(buffer, dot[1])
+
+def _write_items(buffer, items, replicas):
+    _write_varint(buffer, len(items))
+    for item_id, entry in items.items():
+        _write_id(buffer, item_id)
+        _write_str(buffer, entry.name)
+        _write_int(buffer, entry.counter.positive)
+        _write_int(buffer, entry.counter.negative)
+        buffer.append(entry.state)
+        _write_dot(buffer, entry.dot, replicas)
+        _write_dot(buffer, entry.removal_dot, replicas)
+
+def _write_value(buffer, value):
+    # bool must be checked before int, as it is a subclass of it
+    if value is None:
+        buffer.append(TAG_NONE)
+    elif value is True:
+        buffer.append(TAG_TRUE)
+    elif value is False:
+        buffer.append(TAG_FALSE)
+    elif isinstance(value, int):
+        buffer.append(TAG_INT)
+        _write_int(buffer, value)
+    elif isinstance(value, str):
+        buffer.append(TAG_STR)
+        _write_str(buffer, value)
+    elif isinstance(value, dict):
+        buffer.append(TAG_DICT)
+        _write_varint(buffer, len(value))
+        for key, item in value.items():
+            _write_value(buffer, key)
+            _write_value(buffer, item)
+    elif isinstance(value, (list, tuple)):
+        buffer.append(TAG_LIST)
+        _write_varint(buffer, len(value))
+        for item in value:
+            _write_value(buffer, item)
+    elif isinstance(value, ShoppingList):
+        buffer.append(TAG_SHOPPING_LIST)
+        _write_or_map(buffer, value.or_map)
+    elif isinstance(value, ORMap):
+        buffer.append(TAG_OR_MAP)
+        _write_or_map(buffer, value)
+    elif isinstance(value, PNCounter):
+        buffer.append(TAG_PN_COUNTER)
+        _write_int(buffer, value.positive)
+        _write_int(buffer, value.negative)
+    elif isinstance(value, ORSet):
+        buffer.append(TAG_OR_SET)
+        for items in (value.add_set, value.remove_set):
+            _write_varint(buffer, len(items))
+            for item_id in items:
+                _write_id(buffer, item_id)
+    elif isinstance(value, (set, frozenset)):
+        buffer.append(TAG_SET)
+        _write_varint(buffer, len(value))
+        for item in value:
+            _write_value(buffer, item)
+    elif isinstance(value, float):
+        buffer.append(TAG_FLOAT)
+        buffer += _float.pack(value)
+    elif isinstance(value, (bytes, bytearray)):
+        buffer.append(TAG_BYTES)
+        _write_varint(buffer, len(value))
+        buffer += value
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+def _write_or_map(buffer, or_map):
+    context = or_map.context
+    replica_ids = set(context.vv)
+    replica_ids.update(replica_id for replica_id, _ in context.cloud)
+    for entry in or_map.items.values():
+        if entry.dot is not None:
+            replica_ids.add(entry.dot[0])
+        if entry.removal_dot is not None:
+            replica_ids.add(entry.removal_dot[0])
+    replicas = {replica_id: index for index, replica_id in enumerate(replica_ids)}
+
+    buffer.append(TAG_TRUE if or_map.partial else TAG_FALSE)
+    _write_varint(buffer, len(replicas))
+    for replica_id in replicas:
+        _write_str(buffer, replica_id)
+        _write_varint(buffer, context.vv.get(replica_id, 0))
+    _write_varint(buffer, len(context.cloud))
+    for dot in context.cloud:
+        _write_dot(buffer, dot, replicas)
+    _write_varint(buffer, len(or_map.retired))
+    for item_name, incarnation in or_map.retired.items():
+        _write_str(buffer, item_name)
+        _write_varint(buffer, incarnation)
+
+    _write_items(buffer, or_map.items, replicas)
+
+class _Reader:
+    def __init__(self, data, version=CODEC_VERSION):
+        self.data = data
+        self.pos = 0
+        self.version = version
+
+    def read_byte(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def read_varint(self):
+        data = self.data
+        result = 0
+        shift = 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_int(self):
+        value = self.read_varint()
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+    def read_raw(self):
+        length = self.read_varint()
+        start = self.pos
+        self.pos += length
+        return self.data[start:self.pos]
+
+    def read_str(self):
+        return self.read_raw().decode()
+
+    def read_id(self):
+        if self.read_byte() == ID_STR:
+            return self.read_str()
+        hex_id = self.data[self.pos:self.pos + 16].hex()
+        self.pos += 16
+        return f"{hex_id[:8]}-{hex_id[8:12]}-{hex_id[12:16]}-{hex_id[16:20]}-{hex_id[20:]}"
+
+    def read_dot(self, replicas):
+        index = self.read_varint()
+        if index == 0:
+            return None
+        return (replicas[index - 1], self.read_varint())
+
+    def read_items(self, replicas):
+        items = {}
+        for _ in range(self.read_varint()):
+            # Names and IDs repeat across lists, interning keeps one copy of each
+            item_id = sys.intern(self.read_id())
+            item_name = sys.intern(self.read_str())
+            counter = PNCounter()
+            counter.positive = self.read_int()
+            counter.negative = self.read_int()
+            state = self.read_byte()
+            items[item_id] = Entry(item_name, counter, state, self.read_dot(replicas), self.read_dot(replicas))
+        return items
+
+    # Items of a version 2 map: {item_id: (item_name, PNCounter, acquired_flag)}, with their dots
+    def read_legacy_items(self, dots, replicas):
+        items = {}
+        for _ in range(self.read_varint()):
+            item_id = self.read_id()
+            item_name = self.read_str()
+            counter = PNCounter()
+            counter.positive = self.read_int()
+            counter.negative = self.read_int()
+            items[item_id] = (item_name, counter, self.read_byte() == TAG_TRUE)
+            dot = self.read_dot(replicas)
+            if dot is not None:
+                dots[item_id] = dot
+        return items
+
+    def read_or_map(self):
+        or_map = ORMap()
+        or_map.partial = self.read_byte() == TAG_TRUE
+        replicas = []
+        for _ in range(self.read_varint()):
+            replica_id = self.read_str()
+            replicas.append(replica_id)
+            counter = self.read_varint()
+            if counter:
+                or_map.context.vv[replica_id] = counter
+        or_map.context.cloud = {self.read_dot(replicas) for _ in range(self.read_varint())}
+        or_map.retired = {self.read_str(): self.read_varint() for _ in range(self.read_varint())}
+
+        if self.version < 3:
+            dots, removal_dots = {}, {}
+            add_map = self.read_legacy_items(dots, replicas)
+            removed_map = self.read_legacy_items(removal_dots, replicas)
+            acquired_map = self.read_legacy_items(removal_dots, replicas)
+            or_map.load_legacy_maps(add_map, removed_map, acquired_map, dots, removal_dots)
+            return or_map
+        or_map.items = self.read_items(replicas)
+        or_map.rebuild_index()
+        return or_map
+
+    def read_value(self):
+        tag = self.read_byte()
+        if tag == TAG_NONE:
+            return None
+        elif tag == TAG_TRUE:
+            return True
+        elif tag == TAG_FALSE:
+            return False
+        elif tag == TAG_INT:
+            return self.read_int()
+        elif tag == TAG_STR:
+            return self.read_str()
+        elif tag == TAG_DICT:
+            return {self.read_value(): self.read_value() for _ in range(self.read_varint())}
+        elif tag == TAG_LIST:
+            return [self.read_value() for _ in range(self.read_varint())]
+        elif tag == TAG_SHOPPING_LIST:
+            shopping_list = ShoppingList()
+            shopping_list.or_map = self.read_or_map()
+            return shopping_list
+        elif tag == TAG_OR_MAP:
+            return self.read_or_map()
+        elif tag == TAG_PN_COUNTER:
+            counter = PNCounter()
+            counter.positive = self.read_int()
+            counter.negative = self.read_int()
+            return counter
+        elif tag == TAG_OR_SET:
+            or_set = ORSet()
+            or_set.add_set = {self.read_id() for _ in range(self.read_varint())}
+            or_set.remove_set = {self.read_id() for _ in range(self.read_varint())}
+            return or_set
+        elif tag == TAG_SET:
+            return {self.read_value() for _ in range(self.read_varint())}
+        elif tag == TAG_FLOAT:
+            value = _float.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        elif tag == TAG_BYTES:
+            return bytes(self.read_raw())
+        raise ValueError(f"Unknown value tag {tag}")
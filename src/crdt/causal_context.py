@@ -0,0 +1,79 @@
+import uuid
+
+# Replica ID of this process, used for the dots of local operations. It must be a persisted identity
+# (the node ID, or the client ID kept with its lists): every new ID adds an entry to the version vector
+# of each list it touches, for good. Processes that set none (e.g. the benchmarks) get a random one.
+_local_replica_id = None
+
+def set_local_replica_id(replica_id):
+    global _local_replica_id
+    _local_replica_id = replica_id
+
+def get_local_replica_id():
+    global _local_replica_id
+    if _local_replica_id is None:
+        _local_replica_id = uuid.uuid4().hex[:12]
+    return _local_replica_id
+
+class CausalContext:
+    def __init__(self):
+        # Version vector of contiguous dots seen: {replica_id: highest counter}
+        self.vv = {}
+        # Dots seen out of order: {(replica_id, counter)}
+        self.cloud = set()
+
+    # Generate the next dot of a replica and record it as seen
+    def next_dot(self, replica_id):
+        self.compact()
+        counter = self.vv.get(replica_id, 0) + 1
+        self.vv[replica_id] = counter
+        return (replica_id, counter)
+
+    # Check if a dot has been seen
+    def contains(self, dot):
+        replica_id, counter = dot
+        return counter <= self.vv.get(replica_id, 0) or dot in self.cloud
+
+    # Record a dot as seen
+    def add(self, dot):
+        if not self.contains(dot):
+            self.cloud.add(dot)
+            self.compact()
+
+    # Merge with another causal context
+    def merge(self, other):
+        for replica_id, counter in other.vv.items():
+            if counter > self.vv.get(replica_id, 0):
+                self.vv[replica_id] = counter
+        self.cloud.update(other.cloud)
+        self.compact()
+
+    # Move the dots of the cloud that became contiguous into the version vector
+    def compact(self):
+        if not self.cloud:
+            return
+        # In order, so one pass moves every run of contiguous dots
+        for dot in sorted(self.cloud):
+            replica_id, counter = dot
+            current = self.vv.get(replica_id, 0)
+            if counter == current + 1:
+                self.vv[replica_id] = counter
+            if counter <= current + 1:
+                self.cloud.discard(dot)
+
+    def copy(self):
+        context = CausalContext()
+        context.vv = dict(self.vv)
+        context.cloud = set(self.cloud)
+        return context
+
+# Pointwise minimum of version vectors: the dots every one of them has seen
+def stable_version_vector(version_vectors):
+    version_vectors = list(version_vectors)
+    if not version_vectors:
+        return {}
+    stable = dict(version_vectors[0])
+    for vv in version_vectors[1:]:
+        for replica_id in list(stable):
+            stable[replica_id] = min(stable[replica_id], vv.get(replica_id, 0))
+    return stable
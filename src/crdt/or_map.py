@@ -1,140 +1,371 @@
-import uuid
+import sys, uuid, hashlib
 from .pn_counter import PNCounter
+from .causal_context import CausalContext, get_local_replica_id
+
+# Namespace of the deterministic item IDs
+ITEM_NAMESPACE = uuid.UUID('5b0c1a9e-3f7d-4c2a-9e61-8d2f4b7a1c30')
+
+# State of an item, as bits: concurrent removal and acquisition of an item merge into REMOVED | ACQUIRED
+LIVE = 0
+REMOVED = 1
+ACQUIRED = 2
+
+# The greater of two dots, so replicas merging the same operations keep the same one
+def greatest_dot(dot, other_dot):
+    if dot is None or (other_dot is not None and other_dot > dot):
+        return other_dot
+    return dot
+
+class Entry:
+    """An item of an ORMap: its name, quantity, state and the dots of the operations that added and removed it."""
+    __slots__ = ('name', 'counter', 'state', 'dot', 'removal_dot')
+
+    def __init__(self, name, counter, state=LIVE, dot=None, removal_dot=None):
+        self.name = name
+        self.counter = counter
+        self.state = state
+        # Dot of the operation that added the item: (replica_id, counter)
+        self.dot = dot
+        # Dot of the operation that removed or acquired it
+        self.removal_dot = removal_dot
+
+    def copy(self):
+        return Entry(self.name, self.counter.copy(), self.state, self.dot, self.removal_dot)
 
 class ORMap:
-    def __init__(self):
-        # Add set: {item_id: (item_name, PNCounter, acquired_flag)}
-        self.add_map = {}
-        # Remove set: {item_id: (item_name, PNCounter, acquired_flag)}
-        self.removed_map = {}
-        # Acquired set: {item_id: (item_name, PNCounter, acquired_flag)}
-        self.acquired_map = {}
+    def __init__(self, replica_id=None):
+        # Every item, live or tombstoned: {item_id: Entry}
+        self.items = {}
+        # Index of the live items by name: {item_name: item_id}
+        self.name_index = {}
+        # Number of removed and acquired items
+        self.tombstone_count = 0
+        # Local version, incremented on every change to the map
+        self.version = 0
+        # Version of the last change of each item, ordered by version: {item_id: version}
+        self.changes = {}
+        # Replica generating the dots of local operations
+        self.replica_id = replica_id or get_local_replica_id()
+        # Causal context: every add and removal dot this map has seen
+        self.context = CausalContext()
+        # Incarnations of each name whose tombstones were compacted away: {item_name: count}
+        self.retired = {}
+        # Version of the last compaction, deltas older than it may miss removals
+        self.gc_version = 0
+        # True for deltas, which only hold the items changed since some version
+        self.partial = False
+
+    # Record a change to an item so it is shipped in the next deltas
+    def _touch(self, item_id):
+        self.version += 1
+        # Re-insert to keep the dictionary ordered by version
+        self.changes.pop(item_id, None)
+        self.changes[item_id] = self.version
+
+    # Rebuild the name index and tombstone count from the items (after loading or decoding a map)
+    def rebuild_index(self):
+        self.name_index = {}
+        self.tombstone_count = 0
+        for item_id, entry in self.items.items():
+            if entry.state == LIVE:
+                self.name_index.setdefault(entry.name, item_id)
+            else:
+                self.tombstone_count += 1
+
+    # Fill the items from the three maps items were kept in before: {item_id: (item_name, PNCounter, acquired_flag)},
+    # live and tombstoned items in add_map, removed ones also in removed_map and acquired ones in acquired_map
+    # (used to read data written in that layout)
+    def load_legacy_maps(self, add_map, removed_map, acquired_map, dots, removal_dots):
+        self.items = {}
+        for item_id in add_map.keys() | removed_map.keys() | acquired_map.keys():
+            item_name, counter, _ = add_map.get(item_id) or acquired_map.get(item_id) or removed_map[item_id]
+            state = (REMOVED if item_id in removed_map else LIVE) | (ACQUIRED if item_id in acquired_map else LIVE)
+            self.items[sys.intern(item_id)] = Entry(sys.intern(item_name), counter, state, dots.get(item_id), removal_dots.get(item_id))
+        self.rebuild_index()
+
+    # Move an item out of the live items once it is removed or acquired (before its state changes)
+    def _bury(self, item_id, entry):
+        if entry.state == LIVE:
+            self.tombstone_count += 1
+        if self.name_index.get(entry.name) == item_id:
+            del self.name_index[entry.name]
+
+    # Deterministic ID for an item name: every replica derives the same ID for the same
+    # name, and a name added again after being removed or acquired gets its next incarnation
+    def new_item_id(self, item_name):
+        incarnation = self.retired.get(item_name, 0)
+        while True:
+            item_id = str(uuid.uuid5(ITEM_NAMESPACE, f"{item_name}#{incarnation}"))
+            entry = self.items.get(item_id)
+            if entry is None or entry.state == LIVE:
+                return item_id
+            incarnation += 1
 
     # Add item with unique ID, name and initialize acquired flag
     def add(self, item_id, item_name):
-        if item_id not in self.add_map:
-            self.add_map[item_id] = (item_name, PNCounter(), False)
+        if item_id not in self.items:
+            # Names and IDs repeat across lists, interning keeps one copy of each
+            item_id = sys.intern(item_id)
+            item_name = sys.intern(item_name)
+            self.items[item_id] = Entry(item_name, PNCounter(), LIVE, self.context.next_dot(self.replica_id))
+            self.name_index.setdefault(item_name, item_id)
+            self._touch(item_id)
 
     # Logically remove item
     def remove(self, item_id):
-        if ((item_id in self.add_map) and (item_id not in self.acquired_map)):
-            item_name, counter, acquired = self.add_map[item_id]
-            # Add item to remove set
-            self.removed_map[item_id] = (item_name, counter, acquired)
+        entry = self.items.get(item_id)
+        if entry is not None and entry.state == LIVE:
             # Set counters to zero in the remove set
-            self.removed_map[item_id][1].positive = 0
-            self.removed_map[item_id][1].negative = 0
+            entry.counter.positive = 0
+            entry.counter.negative = 0
+            self._bury(item_id, entry)
+            entry.state = REMOVED
+            entry.removal_dot = self.context.next_dot(self.replica_id)
+            self._touch(item_id)
 
     # Mark item as acquired
     def mark_as_acquired(self, item_id):
-        if ((item_id in self.add_map) and (item_id not in self.removed_map)):
-            item_name, counter, _ = self.add_map[item_id]
-
-            #del self.add_map[item_id]
-            self.acquired_map[item_id] = (item_name, counter, True)
-            self.add_map[item_id] = (item_name, counter, True)
+        entry = self.items.get(item_id)
+        if entry is not None and entry.state == LIVE:
+            self._bury(item_id, entry)
+            entry.state = ACQUIRED
+            entry.removal_dot = self.context.next_dot(self.replica_id)
+            self._touch(item_id)
 
     # Increment quantity of item
     def increment_quantity(self, item_id, value):
-        if item_id in self.add_map:
-            _, counter, _ = self.add_map[item_id]
-            counter.increment(value)
+        entry = self.items.get(item_id)
+        if entry is not None:
+            entry.counter.increment(value)
+            self._touch(item_id)
 
     # Decrement quantity of item
     def decrement_quantity(self, item_id, value):
-        if item_id in self.add_map:
-            item_name, counter, acquired = self.add_map[item_id]
-            counter.decrement(value)
-            if counter.get_count() <= 0:
+        entry = self.items.get(item_id)
+        if entry is not None:
+            entry.counter.decrement(value)
+            self._touch(item_id)
+            if entry.counter.get_count() <= 0:
                 self.remove(item_id)
 
     # Retrieve effective items with their effective count
     def get_items(self):
-        removed_or_acquired = set(self.removed_map.keys()).union(self.acquired_map.keys())
-        resolved_items = {
-            item_id: (item_name, counter.get_count(), acquired)
-            for item_id, (item_name, counter, acquired) in self.add_map.items()
-            if item_id not in removed_or_acquired
+        return {
+            item_id: (entry.name, entry.counter.get_count(), False)
+            for item_id, entry in self.items.items()
+            if entry.state == LIVE
         }
-        return resolved_items
 
-     # Retrieve removed items
+    # Check if an item is live (added and neither removed nor acquired)
+    def contains(self, item_id):
+        entry = self.items.get(item_id)
+        return entry is not None and entry.state == LIVE
+
+    # Retrieve the ID of the live item with the given name
+    def get_item_id(self, item_name):
+        return self.name_index.get(item_name)
+
+    # Retrieve removed items
     def get_removed_items(self):
-        acquired_items_ids = set(self.acquired_map.keys())
-        resolved_items = {
-            item_id: (item_name, counter, acquired)
-            for item_id, (item_name, counter, acquired) in self.removed_map.items()
-            if item_id not in acquired_items_ids
-        }
-        return resolved_items
+        return {item_id: (entry.name, entry.counter, False) for item_id, entry in self.items.items() if entry.state == REMOVED}
 
     # Retrieve acquired items
     def get_acquired_items(self):
-        removed_item_ids = set(self.removed_map.keys())
-        resolved_items = {
-            item_id: (item_name, counter, acquired)
-            for item_id, (item_name, counter, acquired) in self.acquired_map.items()
-            if item_id not in removed_item_ids
-        }
-        return
+        return {item_id: (entry.name, entry.counter, True) for item_id, entry in self.items.items() if entry.state == ACQUIRED}
 
     # Retrieve all items
     def get_all_items(self):
         return {
-            item_id: (item_name, counter.get_count(), acquired)
-            for item_id, (item_name, counter, acquired) in self.add_map.items()
+            item_id: (entry.name, entry.counter.get_count(), bool(entry.state & ACQUIRED))
+            for item_id, entry in self.items.items()
         }
 
-    # Merge CRDTs
+    # Build a map holding only the items changed after the given version
+    def get_delta(self, since):
+        delta = ORMap()
+        # Changes are ordered by version, so walk back until the peer's version is reached
+        for item_id, version in reversed(self.changes.items()):
+            if version <= since:
+                break
+            entry = self.items.get(item_id)
+            if entry is not None:
+                delta.items[item_id] = entry.copy()
+                # The delta's context only holds its own dots: a replica merging it without the base state
+                # must not take the items it never received as seen, and later drop them as compacted
+                for dot in (entry.dot, entry.removal_dot):
+                    if dot is not None:
+                        delta.context.cloud.add(dot)
+        delta.context.compact()
+        delta.rebuild_index()
+        delta.retired = dict(self.retired)
+        delta.version = self.version
+        delta.partial = True
+        return delta
+
+    # Hash of the state of an item, the same on every replica holding the same state of it
+    def item_digest(self, item_id):
+        entry = self.items[item_id]
+        state = 'removed' if entry.state & REMOVED else 'acquired' if entry.state & ACQUIRED else 'live'
+        key = f"{item_id}|{entry.name}|{entry.counter.positive}|{entry.counter.negative}|{state}".encode()
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+    # Digest of the whole map, independent of the order of the items (XOR of the item digests)
+    def digest(self):
+        digest = 0
+        for item_id in self.items:
+            digest ^= self.item_digest(item_id)
+        return digest
+
+    # Number of items changed after the given version
+    def count_changes(self, since):
+        count = 0
+        for version in reversed(self.changes.values()):
+            if version <= since:
+                break
+            count += 1
+        return count
+
+    # Number of removed and acquired items kept as tombstones
+    def count_tombstones(self):
+        return self.tombstone_count
+
+    # Forget an item entirely, its dots stay in the causal context so it cannot come back
+    def _drop(self, item_id):
+        entry = self.items.pop(item_id, None)
+        self.changes.pop(item_id, None)
+        if entry is None:
+            return
+        if entry.state != LIVE:
+            self.tombstone_count -= 1
+        elif self.name_index.get(entry.name) == item_id:
+            del self.name_index[entry.name]
+
+    # Remember that an incarnation of a name was compacted away, so its ID is never reused
+    def _retire(self, item_id, item_name):
+        incarnation = self.retired.get(item_name, 0)
+        # IDs that are not derived from the name (e.g. older uuid4 IDs) are not probed forever
+        for candidate in range(incarnation, incarnation + 64):
+            if str(uuid.uuid5(ITEM_NAMESPACE, f"{item_name}#{candidate}")) == item_id:
+                self.retired[item_name] = candidate + 1
+                return
+
+    # Drop the tombstones whose removal every replica has seen (their dot is in the stable version vector)
+    def compact(self, stable_vv):
+        reclaimed = []
+        for item_id, entry in self.items.items():
+            if entry.removal_dot is not None and entry.removal_dot[1] <= stable_vv.get(entry.removal_dot[0], 0):
+                reclaimed.append(item_id)
+
+        for item_id in reclaimed:
+            self._retire(item_id, self.items[item_id].name)
+            self._drop(item_id)
+
+        if reclaimed:
+            # Peers behind this version may still hold the items and need the full state
+            self.version += 1
+            self.gc_version = self.version
+        return len(reclaimed)
+
+    # Merge CRDTs, linear in the size of other
+    # Other may be a full state or a delta; the causal context keeps compacted items from coming back
     def merge(self, other):
-        # Temporary map to store merged items by name
-        merged_items = {}
+        items = self.items
+        for item_id, other_entry in other.items.items():
+            if other_entry.state != LIVE:
+                continue
 
-        # Iterate over the items in the other's add_map
-        for item_id, (item_name, other_counter, acquired) in other.add_map.items():
-            # Skip items that are in removed_map or acquired_map
-            if item_id in self.removed_map or item_id in self.acquired_map or item_id in other.removed_map or item_id in other.acquired_map:
+            entry = items.get(item_id)
+            other_dot = other_entry.dot
+            if entry is not None and entry.state != LIVE:
+                # A removal only covers the adds it observed: an add we have not seen is concurrent and wins
+                if other_dot is None or self.context.contains(other_dot):
+                    continue
+                self._drop(item_id)
+                entry = None
+            # Skip items we have seen before but no longer hold: their tombstone was compacted
+            elif entry is None and other_dot is not None and self.context.contains(other_dot):
                 continue
 
-            # Check if an item with the same name exists in self's add_map
-            existing_item_id = None
-            for self_item_id, (self_item_name, self_counter, self_acquired) in self.add_map.items():
-                if self_item_name == item_name:
-                    existing_item_id = self_item_id
-                    break
-
-            if existing_item_id:
-                # Merge counters and remove the existing item from add_map
-                _, self_counter, _ = self.add_map.pop(existing_item_id)
-                other_counter.merge_max(self_counter)
-                merged_items[item_name] = other_counter
-            else:
-                # No matching item name in self, add directly
-                if item_name not in merged_items:
-                    merged_items[item_name] = other_counter
-
-        # Add all merged items back to add_map with new item_ids
-        for item_name, merged_counter in merged_items.items():
-            new_item_id = str(uuid.uuid4())
-            self.add_map[new_item_id] = (item_name, merged_counter, False)
-
-        # Merge removed_map entries
-        for item_id, (item_name, other_counter, acquired) in other.removed_map.items():
-            if item_id not in self.removed_map:
-                self.removed_map[item_id] = (item_name, other_counter, acquired)
-                self.removed_map[item_id][1].positive = 0
-                self.removed_map[item_id][1].negative = 0
-
-        # Merge all entries from removed_map to add_map
-        for item_id, (item_name, counter, acquired) in self.removed_map.items():
-            self.add_map[item_id] = (item_name, counter, acquired)
-
-        # Merge acquired_map entries
-        for item_id, (item_name, other_counter, acquired) in other.acquired_map.items():
-            if item_id not in self.acquired_map:
-                self.acquired_map[item_id] = (item_name, other_counter, acquired)
-            self.acquired_map[item_id][1].merge_max(other_counter)
-
-        # Merge all entries from acquired_map to add_map
-        for item_id, (item_name, counter, acquired) in self.acquired_map.items():
-            self.add_map[item_id] = (item_name, counter, acquired)
+            item_name = other_entry.name
+            other_counter = other_entry.counter
+            existing_item_id = self.name_index.get(item_name)
+            if existing_item_id is None:
+                # No live item with this name, add it with its own ID
+                items[item_id] = Entry(item_name, other_counter.copy(), LIVE, other_dot)
+                self.name_index[item_name] = item_id
+                self._touch(item_id)
+                continue
+
+            existing = items[existing_item_id]
+            # Concurrent adds of the same item keep the greatest dot, so replicas agree on the add a removal observed
+            if existing_item_id == item_id:
+                existing.dot = greatest_dot(existing.dot, other_dot)
+            counter = existing.counter
+            if counter.positive < other_counter.positive or counter.negative < other_counter.negative:
+                counter.merge_max(other_counter)
+                self._touch(existing_item_id)
+
+            # The same item was added under two IDs, keep the smallest so replicas agree on it
+            if item_id < existing_item_id:
+                self._drop(existing_item_id)
+                dot = other_dot if other_dot is not None else entry.dot if entry is not None else None
+                items[item_id] = Entry(item_name, counter, LIVE, dot)
+                self.name_index[item_name] = item_id
+                self._touch(item_id)
+
+        # Merge the removals, then the acquisitions (tombstoned items keep their entry)
+        for state in (REMOVED, ACQUIRED):
+            for item_id, other_entry in other.items.items():
+                if not other_entry.state & state:
+                    continue
+                entry = items.get(item_id)
+                removal_dot = other_entry.removal_dot
+                if entry is not None and entry.state & state:
+                    entry.dot = greatest_dot(entry.dot, other_entry.dot)
+                    entry.removal_dot = greatest_dot(entry.removal_dot, removal_dot)
+                    counter = entry.counter
+                    other_counter = other_entry.counter
+                    if state == ACQUIRED and (counter.positive < other_counter.positive or counter.negative < other_counter.negative):
+                        counter.merge_max(other_counter)
+                        self._touch(item_id)
+                    continue
+
+                if entry is not None and entry.state == LIVE and entry.dot is not None:
+                    # A removal only covers the adds it observed: the add we hold wins over one that did not see it
+                    if not other.context.contains(entry.dot):
+                        continue
+                # Skip removals we have seen and already compacted
+                elif entry is None and removal_dot is not None and self.context.contains(removal_dot):
+                    continue
+
+                if entry is None:
+                    entry = items[item_id] = Entry(other_entry.name, PNCounter(), LIVE, other_entry.dot)
+                else:
+                    entry.dot = greatest_dot(entry.dot, other_entry.dot)
+                if state == ACQUIRED:
+                    entry.counter = other_entry.counter.copy()
+                elif not entry.state & ACQUIRED:
+                    # Set counters to zero in the remove set
+                    entry.counter = PNCounter()
+                entry.removal_dot = greatest_dot(entry.removal_dot, removal_dot)
+                self._bury(item_id, entry)
+                entry.state |= state
+                self._touch(item_id)
+
+        # A full state lacks the items it compacted: drop those we still hold once other has seen them
+        if not other.partial:
+            compacted = [
+                item_id for item_id, entry in items.items()
+                if item_id not in other.items and ((entry.dot is not None and other.context.contains(entry.dot))
+                                                    or (entry.removal_dot is not None and other.context.contains(entry.removal_dot)))
+            ]
+            for item_id in compacted:
+                self._drop(item_id)
+            if compacted:
+                self.version += 1
+                self.gc_version = self.version
+
+        self.context.merge(other.context)
+        for item_name, incarnation in other.retired.items():
+            if incarnation > self.retired.get(item_name, 0):
+                self.retired[item_name] = incarnation
@@ -2,24 +2,54 @@ class ORSet:
     def __init__(self):
         self.add_set = set()
         self.remove_set = set()
+        # Local version, incremented on every change to the set
+        self.version = 0
+        # Version of the last change of each item, ordered by version: {item_id: version}
+        self.changes = {}
+
+    # Record a change to an item so it is shipped in the next deltas
+    def _touch(self, item_id):
+        self.version += 1
+        self.changes.pop(item_id, None)
+        self.changes[item_id] = self.version
     
     # Add item
     def add(self, item_id):
-        self.add_set.add(item_id)
+        if item_id not in self.add_set:
+            self.add_set.add(item_id)
+            self._touch(item_id)
     
     # Remove item
     def remove(self, item_id):
-        if item_id in self.add_set:
+        if item_id in self.add_set and item_id not in self.remove_set:
             self.remove_set.add(item_id)
+            self._touch(item_id)
     
     # Get items that are in add_set but not in remove_set
     def get_items(self):
         return self.add_set.difference(self.remove_set)
     
-    # Merge with another OR-Set instance
+    # Merge with another OR-Set instance (full states and deltas are merged the same way)
     def merge(self, other):
+        for item_id in other.add_set.difference(self.add_set):
+            self._touch(item_id)
+        for item_id in other.remove_set.difference(self.remove_set):
+            self._touch(item_id)
         self.add_set = self.add_set.union(other.add_set)
         self.remove_set = self.remove_set.union(other.remove_set)
 
+    # Build a set holding only the items changed after the given version
+    def get_delta(self, since):
+        delta = ORSet()
+        for item_id, version in reversed(self.changes.items()):
+            if version <= since:
+                break
+            if item_id in self.add_set:
+                delta.add_set.add(item_id)
+            if item_id in self.remove_set:
+                delta.remove_set.add(item_id)
+        delta.version = self.version
+        return delta
+
     def get_remove_set(self):
-        return self.remove_set
\ No newline at end of file
+        return self.remove_set
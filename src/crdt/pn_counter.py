@@ -1,4 +1,7 @@
 class PNCounter:
+    # No per-instance __dict__: maps hold one counter per item
+    __slots__ = ('positive', 'negative')
+
     def __init__(self):
         self.positive = 0
         self.negative = 0
@@ -23,4 +26,11 @@ class PNCounter:
     # Merge with another PN-Counter (different approach)
     def merge_max(self, other):
         self.positive = max(self.positive, other.positive)
-        self.negative = max(self.negative, other.negative)
\ No newline at end of file
+        self.negative = max(self.negative, other.negative)
+
+    # Copy the counter (a counter's delta is its whole two-integer state)
+    def copy(self):
+        counter = PNCounter()
+        counter.positive = self.positive
+        counter.negative = self.negative
+        return counter
@@ -1,14 +1,16 @@
-import uuid
 from .or_map import ORMap
 
+# Above this fraction of changed items a delta is not worth it and the full state is sent
+DELTA_MAX_RATIO = 0.5
+
 class ShoppingList:
-    def __init__(self):
+    def __init__(self, replica_id=None):
         # OR-Map
-        self.or_map = ORMap()
+        self.or_map = ORMap(replica_id)
 
     # Add item to shopping list
     def add_item(self, item_name, quantity=1):
-        item_id = str(uuid.uuid4())
+        item_id = self.or_map.new_item_id(item_name)
         self.or_map.add(item_id, item_name)
         self.or_map.increment_quantity(item_id, quantity)
 
@@ -32,14 +34,54 @@ class ShoppingList:
     def get_shopping_list(self):
         return self.or_map.get_items()
     
+    # Check if an item is still in the list
+    def has_item(self, item_id):
+        return self.or_map.contains(item_id)
+
+    # Get the ID of the item with the given name, if it is still in the list
+    def get_item_id(self, item_name):
+        return self.or_map.get_item_id(item_name)
+
     # Get all items
     def get_all_items(self):
         return self.or_map.get_all_items()
 
-    # Merge two shopping list instances
+    # Merge two shopping list instances (other may be a full list or a delta)
     def merge(self, other):
         self.or_map.merge(other.or_map)
 
+    # Get the local version of the list
+    def get_version(self):
+        return self.or_map.version
+
+    # Get a delta with the changes since a version acknowledged by a peer,
+    # or None if the peer is too far behind and needs the full state
+    def get_delta(self, since):
+        # Compacted removals are not in deltas, peers from before the compaction need the full state
+        if since is None or since > self.or_map.version or since < self.or_map.gc_version:
+            return None
+        if self.or_map.count_changes(since) > DELTA_MAX_RATIO * max(len(self.or_map.items), 1):
+            return None
+        delta = ShoppingList()
+        delta.or_map = self.or_map.get_delta(since)
+        return delta
+
+    # Get a digest of the list's items, equal on replicas that converged
+    def digest(self):
+        return self.or_map.digest()
+
+    # Get the version vector of the operations this list has seen
+    def get_context(self):
+        return self.or_map.context.vv
+
+    # Get the number of removed and acquired items kept as tombstones
+    def count_tombstones(self):
+        return self.or_map.count_tombstones()
+
+    # Drop the tombstones every replica has seen, returns how many were reclaimed
+    def compact(self, stable_vv):
+        return self.or_map.compact(stable_vv)
+
     # Print list's contents and their quantities
     def display_list(self):
         items = self.get_shopping_list()
@@ -49,4 +91,4 @@ class ShoppingList:
             print("\nThese are the products currently in your list:")
             for item_id, (item_name, quantity, _) in items.items():
                 item_name_cap = item_name.capitalize()
-                print(f"- {item_name_cap}: [x{quantity}]")
\ No newline at end of file
+                print(f"- {item_name_cap}: [x{quantity}]")
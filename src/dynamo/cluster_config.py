@@ -0,0 +1,41 @@
+import orjson
+from storage.storage_engine import FSYNC_POLICIES, FSYNC_POLICY
+
+# Path to the cluster configuration, relative to the src folder
+DEFAULT_CONFIG_PATH = 'config/cluster.json'
+
+def load_cluster_config(path=DEFAULT_CONFIG_PATH):
+    """
+    Load the cluster configuration (proxy addresses, replication factor and nodes).
+    :param path: Path to the JSON configuration file.
+    :return: The configuration (dict).
+    """
+    with open(path, 'rb') as file:
+        config = orjson.loads(file.read())
+
+    node_ids = [node["node_id"] for node in config["nodes"]]
+    if len(set(node_ids)) != len(node_ids):
+        raise ValueError(f"Duplicate node IDs in {path}")
+    for node in config["nodes"]:
+        if node.get("weight", 1) <= 0:
+            raise ValueError(f"Node {node['node_id']} must have a positive weight in {path}")
+
+    # Quorums larger than the replication factor can never be reached
+    for quorum in ("read_quorum", "write_quorum"):
+        if not 1 <= config.get(quorum, 1) <= config["replication_factor"]:
+            raise ValueError(f"{quorum} must be between 1 and the replication factor in {path}")
+    if config.get("fsync_policy", FSYNC_POLICY) not in FSYNC_POLICIES:
+        raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES} in {path}")
+    return config
+
+def get_node_config(config, node_id):
+    """
+    Get the configuration of a single node.
+    :param config: The cluster configuration.
+    :param node_id: The node to look up.
+    :return: The node's configuration (dict with node_id, port, address and optionally data_dir and weight).
+    """
+    for node in config["nodes"]:
+        if node["node_id"] == node_id:
+            return node
+    raise KeyError(f"Node {node_id} is not in the cluster configuration")
@@ -1,50 +1,176 @@
-import hashlib
 import bisect
+import zlib
+from collections import OrderedDict
+
+# Virtual nodes of a physical node of weight 1
+VIRTUAL_NODES = 64
+# Keys whose ring position is remembered between lookups
+LOOKUP_CACHE_SIZE = 65536
 
 class ConsistentHash:
-    def __init__(self, replicas=3, hash_bits=32):
+    def __init__(self, replicas=VIRTUAL_NODES, hash_bits=32, cache_size=LOOKUP_CACHE_SIZE):
         """
-        :param replicas: Number of virtual nodes for each physical node
-        :param hash_bits: Number of bits to use for the reduced hash
+        :param replicas: Number of virtual nodes for each physical node of weight 1
+        :param hash_bits: Number of bits to use for the reduced hash (at most 32)
+        :param cache_size: Number of key lookups kept in the LRU cache, 0 to disable it
         """
         self.replicas = replicas
         self.hash_mask = (1 << hash_bits) - 1  # Create a mask for the desired hash size
         self.ring = {}            # The hash ring
         self.sorted_keys = []     # Sorted keys for binary search
-        self.nodes = {}           # Track physical nodes
+        self.nodes = {}           # Track physical nodes and their addresses
+        self.virtual_nodes = {}   # Virtual nodes of each physical node, from its weight
+        self.version = 0          # Bumped on every membership change
+
+        # Caches, valid for one ring version
+        self.cache_version = 0
+        self.cache_size = cache_size
+        # LRU of key -> index of the virtual node ending its range. Each OrderedDict operation is atomic,
+        # so the threads sharing the ring do without a lock and at worst miss an entry
+        self.positions = OrderedDict()
+        # Preference lists walked from each ring position: {(index, count): [nodes]}
+        self.preference_lists = {}
 
     def _hash(self, key):
         """
-        Hash function using SHA-256 and bitmasking to reduce hash size.
+        Non-cryptographic hash: CRC32, then a multiplicative (Fibonacci) mix so that similar keys,
+        such as the 'node-0', 'node-1' virtual nodes, land far apart on the ring.
         :param key: Input key to hash
         :return: Reduced hash value
         """
-        full_hash = int(hashlib.sha256(key.encode()).hexdigest(), 16)
-        return full_hash & self.hash_mask  # Apply bitmask to reduce hash size
+        h = (zlib.crc32(key.encode()) * 0x9e3779b1) & 0xffffffff
+        return (h ^ (h >> 16)) & self.hash_mask  # Apply bitmask to reduce hash size
 
-    def add_node(self, node):
-        """Add a physical node and its virtual replicas to the ring."""
-        self.nodes[node] = f"tcp://127.0.0.1:{5000 + int(node[-1])}"  # Assign an address based on node id
-        for i in range(self.replicas):
+    def add_node(self, node, address=None, weight=1):
+        """
+        Add a physical node and its virtual replicas to the ring.
+        :param node: The node id.
+        :param address: The node's address, if known.
+        :param weight: Share of the ring relative to other nodes, scales its number of virtual nodes.
+        """
+        if node in self.nodes:
+            if address is not None and self.nodes[node] != address:
+                self.nodes[node] = address
+                self.version += 1
+            return
+        self.nodes[node] = address
+        self.virtual_nodes[node] = max(1, round(self.replicas * weight))
+        for i in range(self.virtual_nodes[node]):
             replica_key = f"{node}-{i}"
             hash_key = self._hash(replica_key)
+            if hash_key in self.ring:
+                # Collision with another virtual node, which keeps the position
+                continue
             self.ring[hash_key] = node
             bisect.insort(self.sorted_keys, hash_key)
+        self.version += 1
 
     def remove_node(self, node):
         """Remove a physical node and its virtual replicas from the ring."""
+        if node not in self.nodes:
+            return
         self.nodes.pop(node, None)  # Remove the node's address from the nodes map
-        for i in range(self.replicas):
+        for i in range(self.virtual_nodes.pop(node)):
             replica_key = f"{node}-{i}"
             hash_key = self._hash(replica_key)
-            self.ring.pop(hash_key, None)
-            self.sorted_keys.remove(hash_key)
+            if self.ring.get(hash_key) == node:
+                del self.ring[hash_key]
+                self.sorted_keys.remove(hash_key)
+        self.version += 1
+
+    def _refresh_caches(self):
+        """Drop the cached lookups once the ring changed."""
+        if self.cache_version != self.version:
+            self.positions = OrderedDict()
+            self.preference_lists = {}
+            self.cache_version = self.version
+
+    def _locate(self, key):
+        """Index in sorted_keys of the virtual node ending the key's range, cached until the ring changes."""
+        self._refresh_caches()
+        positions = self.positions
+        index = positions.get(key)
+        if index is not None:
+            try:
+                positions.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread in the meantime
+                pass
+            return index
+
+        index = bisect.bisect(self.sorted_keys, self._hash(key)) % len(self.sorted_keys)
+        if self.cache_size:
+            positions[key] = index
+            if len(positions) > self.cache_size:
+                try:
+                    positions.popitem(last=False)
+                except KeyError:
+                    pass
+        return index
 
     def get_node(self, key):
         """Get the closest node for the given key."""
-        hash_key = self._hash(key)
-        index = bisect.bisect(self.sorted_keys, hash_key) % len(self.sorted_keys)
-        return self.ring[self.sorted_keys[index]]
+        return self.ring[self.sorted_keys[self._locate(key)]]
+
+    def get_range(self, key):
+        """Get the ring range of the given key, identified by the hash of the virtual node ending it."""
+        return self.sorted_keys[self._locate(key)]
+
+    def get_preference_list(self, key, count):
+        """
+        Get the nodes responsible for the given key: the first `count` distinct physical nodes
+        met walking the ring clockwise from the key's position.
+        Every key of a range gets the same list, so the lists are cached per range until the ring changes.
+        :param key: The key to locate in the ring.
+        :param count: Number of nodes wanted, capped at the number of physical nodes.
+        :return: List of node ids, the key's primary node first.
+        """
+        if not self.sorted_keys:
+            return []
+        # Taken before the lookup, so a list walked on a ring that changed meanwhile is not kept
+        self._refresh_caches()
+        preference_lists = self.preference_lists
+        index = self._locate(key)
+        count = min(count, len(self.nodes))
+
+        nodes = preference_lists.get((index, count))
+        if nodes is None:
+            nodes = []
+            for i in range(len(self.sorted_keys)):
+                node = self.ring[self.sorted_keys[(index + i) % len(self.sorted_keys)]]
+                if node not in nodes:
+                    nodes.append(node)
+                    if len(nodes) == count:
+                        break
+            preference_lists[(index, count)] = nodes
+        return list(nodes)
+
+    def copy(self):
+        """Copy of the ring's current membership, with empty caches."""
+        ring = ConsistentHash(self.replicas, self.hash_mask.bit_length(), self.cache_size)
+        ring.ring = dict(self.ring)
+        ring.sorted_keys = list(self.sorted_keys)
+        ring.nodes = dict(self.nodes)
+        ring.virtual_nodes = dict(self.virtual_nodes)
+        ring.version = self.version
+        ring.cache_version = self.version
+        return ring
+
+    def with_node(self, node, address=None, weight=1):
+        """Copy of the ring with a node added, this ring is left unchanged."""
+        ring = self.copy()
+        ring.add_node(node, address, weight)
+        return ring
+
+    def without_node(self, node):
+        """Copy of the ring without a node, this ring is left unchanged."""
+        ring = self.copy()
+        ring.remove_node(node)
+        return ring
+
+    def get_address(self, node):
+        """Get the address of a physical node, None if it is unknown."""
+        return self.nodes.get(node)
 
     def get_nodes(self):
         """Returns a list of all physical nodes in the hash ring."""
@@ -1,102 +1,351 @@
-import orjson, zlib, jsonpickle, zmq, time, threading
+import zmq, time, threading, random, hashlib, itertools, math
+from communication.codec import compress_data, decompress_data
+
+# Seconds of a protocol period: every period a node probes one member and gossips with GOSSIP_FANOUT others
+PROTOCOL_PERIOD = 1.0
+# Random peers the membership is compared with in each period
+GOSSIP_FANOUT = 2
+# Members asked to probe a node that did not answer a direct ping
+INDIRECT_PROBES = 3
+# Protocol periods a suspected node has to refute the suspicion, scaled by log10 of the cluster size
+SUSPICION_MULTIPLIER = 4
+# Messages queued to an unreachable member before sends to it fail right away
+SEND_HIGH_WATER_MARK = 64
+
+# Order of the states within one incarnation: a suspicion overrides 'alive', a death overrides both
+STATES = ("alive", "suspect", "dead")
+
+def entry_version(entry):
+    """Order of membership entries: a later incarnation wins, and within one incarnation the worse state wins."""
+    return entry["incarnation"] * len(STATES) + STATES.index(entry["state"])
 
 class GossipProtocol:
-    def __init__(self, node_id, node, known_nodes=None):
+    def __init__(self, node_id, node, known_nodes=None, protocol_period=PROTOCOL_PERIOD):
+        """
+        SWIM failure detector and membership gossip.
+        The membership is {node_id: {incarnation, state, address, weight}}. Every protocol period the node pings
+        the next member of a shuffled round-robin; without an ack within a quarter of the period, INDIRECT_PROBES
+        other members are asked to ping it (ping_req). If none of them gets an ack either, the member becomes
+        'suspect', and 'dead' (out of the hash ring) unless it refutes the suspicion in time. Only a node itself
+        makes it alive again, by bumping its incarnation when it hears it is suspected or dead.
+        Changes spread by comparing a checksum of the membership with GOSSIP_FANOUT random peers each period;
+        only if it differs do they exchange their digests ({node_id: version}) and then the newer entries.
+        Every message is sent without blocking through one DEALER socket per member, and the answers
+        are handled by an event loop in the gossip thread.
+        :param node_id: This node.
+        :param node: The node whose hash ring follows the membership.
+        :param known_nodes: Configuration of the nodes to gossip with at first (seeds).
+        :param protocol_period: Seconds of a protocol period.
+        """
         self.node_id = node_id
-        self.node = node  # Reference to the Error gossiping to update the hash ring
-        self.node_states = {}  # Node states for each known node (alive or dead)
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)  # Request socket
+        self.node = node
+        self.protocol_period = protocol_period
+        self.ping_timeout = protocol_period / 4
         self.shutdown_flag = False
-        self.known_nodes = known_nodes
+        self.seeds = [node for node in known_nodes or [] if node['node_id'] != node_id]
 
-    def gossip(self):
-        while not self.shutdown_flag:
-            for node in self.known_nodes:
-                try:
-                    self.socket.connect(f"{node['address']}")  # Open the connection once for each gossip cycle
-                    self.socket.send(self.compress_data({
-                        "operation": "gossip",
-                        "node_id": self.node_id,
-                        "node_states": self.node_states,
-                        "hash_ring": self.node.hash_ring.ring  # Gossip the current hash ring
-                    })
-                    )
-                    response = self.decompress_data(self.socket.recv())
-                    # Check the status of the response
-                    if response.get("status") == "success":
-                        # Optionally, merge the node states and hash ring if necessary
-                        if "node_states" in response:
-                            self.merge_states(response["node_states"])
-                        else:
-                            self.node_states[node['node_id']] = "dead"
-                    else:
-                        print(f"Node {self.node_id}: Failed to process gossip from {node['node_id']}")
-                except Exception as e:
-                    print(f"Error gossiping with {node['node_id']}: {e}")
-                    self.node_states[node['node_id']] = "dead"
-            time.sleep(10)  # Gossip every 10 seconds
-
-    def merge_states(self, remote_states):
-        """Merge the states of remote nodes with the local state."""
-        for node, state in remote_states.items():
-            if state == "dead" and self.node_states.get(node, "alive") != "dead":
-                print(f"Node {node} is now marked as dead")
-                self.node_states[node] = "dead"
-                self.node.update_hash_ring(node, "dead")  # Remove from hash ring
-            elif state == "alive" and self.node_states.get(node, "dead") == "dead":
-                print(f"Node {node} is now marked as alive")
-                self.node_states[node] = "alive"
-                self.node.update_hash_ring(node, "alive")  # Add to hash ring
+        own_config = next((node for node in known_nodes or [] if node['node_id'] == node_id), {})
+        self.members = {node_id: {"incarnation": 0, "state": "alive", "address": own_config.get("address"), "weight": own_config.get("weight", 1)}}
+        self.lock = threading.RLock()
+        self.checksum = None      # Cached checksum of the membership, reset on every change
+        self.suspicions = {}      # Suspected members and when they are declared dead: {node_id: deadline}
 
-    def start(self):
-        """Start the gossiping process in a separate thread."""
-        threading.Thread(target=self.gossip, daemon=True).start()
+        # State of the gossip thread
+        self.sockets = {}         # DEALER socket to each member
+        self.callbacks = {}       # Requests waiting for an answer: {request_id: (callback, deadline)}
+        self.request_ids = itertools.count()
+        self.probe_order = []     # Members left to probe in this round-robin
 
-    def stop(self):
-        """Stop the gossiping thread."""
-        self.shutdown_flag = True
+    def clock(self):
+        return time.monotonic()
 
-    def compress_data(self, data):
-        """
-        Compress JSON data to be sent over ZMQ.
-        :param data: The data (dict) to compress.
-        :return: Compressed byte data
-        """
-        # Convert all dictionary keys to strings to avoid JSON serialization error
-        if 'hash_ring' in data:
-            # Convert keys in the 'hash_ring' dictionary to strings
-            data['hash_ring'] = {str(key): value for key, value in data['hash_ring'].items()}
-
-        if 'shopping_list' in data:
-            # Use jsonpickle to serialize the custom object
-            data['shopping_list'] = jsonpickle.dumps(data['shopping_list'])
-        
-        byte_data = orjson.dumps(data) # Convert the entire dictionary to JSON string
-    
-        # Compress the string into bytes
-        compressed_data = zlib.compress(byte_data)  # Ensure it's in byte form
-        return compressed_data      
-
-    def decompress_data(self, compressed_data):
+    def get_state(self, node_id):
+        """State of a node ('alive', 'suspect' or 'dead'), None if it is unknown."""
+        member = self.members.get(node_id)
+        return None if member is None else member["state"]
+
+    def get_digest(self):
+        """Version of every membership entry: {node_id: version}."""
+        with self.lock:
+            return {node_id: entry_version(entry) for node_id, entry in self.members.items()}
+
+    def get_checksum(self):
+        """Checksum of the membership: two nodes with the same one have nothing to exchange."""
+        with self.lock:
+            if self.checksum is None:
+                digest = "|".join(f"{node_id}:{version}" for node_id, version in sorted(self.get_digest().items()))
+                self.checksum = hashlib.blake2b(digest.encode(), digest_size=8).hexdigest()
+            return self.checksum
+
+    def get_updates(self, digest):
+        """Entries newer than the ones of a remote digest."""
+        with self.lock:
+            return {node_id: dict(entry) for node_id, entry in self.members.items()
+                    if entry_version(entry) > digest.get(node_id, -1)}
+
+    def get_wanted(self, digest):
+        """Nodes whose entry is newer in a remote digest."""
+        with self.lock:
+            return [node_id for node_id, version in digest.items()
+                    if node_id not in self.members or version > entry_version(self.members[node_id])]
+
+    def get_addresses(self, states=STATES):
+        """Addresses of the other members in the given states, and of the seeds not known yet: {node_id: address}."""
+        with self.lock:
+            addresses = {node['node_id']: node['address'] for node in self.seeds if node['node_id'] not in self.members}
+            addresses.update({node_id: entry["address"] for node_id, entry in self.members.items()
+                              if entry["state"] in states and entry.get("address")})
+        addresses.pop(self.node_id, None)
+        return addresses
+
+    def get_address(self, node_id):
+        """Address of a member or seed, None if it is unknown."""
+        entry = self.members.get(node_id)
+        if entry is not None and entry.get("address"):
+            return entry["address"]
+        return next((node['address'] for node in self.seeds if node['node_id'] == node_id), None)
+
+    def pick_peers(self):
+        """Random peers to gossip with, dead members included so a healed partition is noticed."""
+        peers = sorted(self.get_addresses())
+        return random.sample(peers, min(GOSSIP_FANOUT, len(peers)))
+
+    def next_probe_target(self):
+        """Next member to probe: every member is probed once per round-robin, in a new random order each time."""
+        targets = self.get_addresses(("alive", "suspect"))
+        while self.probe_order:
+            node_id = self.probe_order.pop()
+            if node_id in targets:
+                return node_id
+        self.probe_order = list(targets)
+        random.shuffle(self.probe_order)
+        return self.probe_order.pop() if self.probe_order else None
+
+    def send(self, node_id, message, callback, timeout, address=None):
         """
-        Decompress the data and convert it back to the original format.
-        :param compressed_data: The compressed data received.
-        :return: Decompressed and converted data
+        Send a message without waiting for its answer.
+        :param node_id: The member to send it to.
+        :param message: The message, with its 'operation'.
+        :param callback: Called with the decoded answer, or None if the member did not answer within the timeout.
+        :param timeout: Seconds to wait for the answer.
+        :param address: Address of the member, if it is not in the membership.
         """
-        # Decompress the data first
-        json_data = zlib.decompress(compressed_data)  # Decode from bytes to string
+        address = address or self.get_address(node_id)
+        if address is None:
+            callback(None)
+            return
+        socket = self.sockets.get(node_id)
+        if socket is None:
+            socket = self.node.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.SNDHWM, SEND_HIGH_WATER_MARK)
+            socket.connect(address)
+            self.poller.register(socket, zmq.POLLIN)
+            self.sockets[node_id] = socket
+
+        request_id = next(self.request_ids).to_bytes(8, 'big')
+        payload = compress_data(message)
+        try:
+            # The operation frame lets the node answer without queueing the message behind list requests
+            socket.send_multipart([request_id, b'', message["operation"].encode(), payload], zmq.NOBLOCK)
+        except zmq.ZMQError:
+            callback(None)
+            return
+        self.node.metrics.incr("gossip_bytes_sent", len(payload))
+        self.callbacks[request_id] = (callback, self.clock() + timeout)
+
+    def receive(self, socket):
+        """Hand every available answer of a member to its request's callback."""
+        while True:
+            try:
+                request_id, _, payload = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.node.metrics.incr("gossip_bytes_received", len(payload))
+            # Answers to requests that already timed out are dropped
+            entry = self.callbacks.pop(request_id, None)
+            if entry is not None:
+                entry[0](decompress_data(payload))
 
-        # Load the JSON string into a Python dictionary
-        data = orjson.loads(json_data)
+    def expire(self, now):
+        """Time out the requests past their deadline."""
+        for request_id, (callback, deadline) in list(self.callbacks.items()):
+            if deadline <= now:
+                del self.callbacks[request_id]
+                callback(None)
 
-        # Convert keys of the 'hash_ring' back to integers
-        if 'hash_ring' in data:
-            data['hash_ring'] = {int(key): value for key, value in data['hash_ring'].items()}
+    def period(self):
+        """One protocol period: probe a member and gossip with random peers."""
+        target = self.next_probe_target()
+        if target is not None:
+            self.node.metrics.incr("swim_probes")
+            self.send(target, {"operation": "ping", "node_id": self.node_id},
+                      lambda response: self.on_ping_ack(target, response), self.ping_timeout)
 
-        # Decompress list object
-        if 'shopping_list' in data:
-            data['shopping_list'] = jsonpickle.loads(data['shopping_list'])
+        for peer_id in self.pick_peers():
+            self.send(peer_id, {"operation": "gossip", "node_id": self.node_id, "checksum": self.get_checksum()},
+                      lambda response, peer_id=peer_id: self.on_digest(peer_id, response), self.protocol_period)
+        self.node.metrics.incr("gossip_rounds")
 
-        return data
+    def on_ping_ack(self, target, response):
+        """Without a direct ack, ask other members to probe the target."""
+        if response is not None:
+            return
+        self.node.metrics.incr("swim_probe_failures")
+        if target not in self.members:
+            # A seed that never answered: there is nothing to suspect yet
+            return
+        helpers = [node_id for node_id in self.get_addresses(("alive",)) if node_id != target and node_id in self.members]
+        helpers = random.sample(helpers, min(INDIRECT_PROBES, len(helpers)))
+        if not helpers:
+            self.suspect(target)
+            return
 
+        probe = {"waiting": len(helpers), "acked": False}
+        def on_indirect_ack(response):
+            probe["waiting"] -= 1
+            if response is not None and response.get("ack"):
+                if not probe["acked"]:
+                    self.node.metrics.incr("swim_indirect_acks")
+                probe["acked"] = True
+            elif probe["waiting"] == 0 and not probe["acked"]:
+                self.suspect(target)
+
+        message = {"operation": "ping_req", "node_id": self.node_id, "target": target, "address": self.get_address(target)}
+        for helper in helpers:
+            self.send(helper, message, on_indirect_ack, 2 * self.ping_timeout)
+
+    def on_digest(self, peer_id, response):
+        """Exchange the newer entries with a peer whose membership differs."""
+        if response is None or "digest" not in response:
+            return
+        digest = response["digest"]
+        self.send(peer_id, {
+            "operation": "gossip_push",
+            "node_id": self.node_id,
+            "updates": self.get_updates(digest),
+            "wanted": self.get_wanted(digest)
+        }, lambda response: response is not None and self.merge(response["updates"]), self.protocol_period)
+
+    def handle_ping(self, message):
+        """Acknowledge a probe."""
+        return {"status": "success", "node_id": self.node_id}
+
+    def handle_ping_req(self, message, reply):
+        """Probe a member on behalf of another one, and reply whether it acknowledged."""
+        self.send(message["target"], {"operation": "ping", "node_id": self.node_id},
+                  lambda response: reply({"status": "success", "node_id": self.node_id, "ack": response is not None}),
+                  self.ping_timeout, message.get("address"))
+
+    def handle_gossip(self, message):
+        """Answer a peer's checksum with the local digest, if they differ."""
+        if message["checksum"] == self.get_checksum():
+            return {"status": "success", "node_id": self.node_id}
+        return {"status": "success", "node_id": self.node_id, "digest": self.get_digest()}
+
+    def handle_push(self, message):
+        """Merge the entries a peer found newer, and send back the ones it asked for."""
+        self.merge(message["updates"])
+        with self.lock:
+            updates = {node_id: dict(self.members[node_id]) for node_id in message["wanted"] if node_id in self.members}
+        return {"status": "success", "node_id": self.node_id, "updates": updates}
+
+    def suspicion_timeout(self):
+        """Seconds a suspected member has to refute it, longer in larger clusters where the news spreads slower."""
+        return SUSPICION_MULTIPLIER * max(1, math.log10(len(self.members))) * self.protocol_period
+
+    def suspect(self, node_id):
+        """Suspect a member that answered neither the direct nor the indirect probes."""
+        with self.lock:
+            entry = self.members.get(node_id)
+            if entry is None or entry["state"] != "alive":
+                return
+            print(f"Node {node_id} is now suspected")
+            entry["state"] = "suspect"
+            self.checksum = None
+            self.suspicions[node_id] = self.clock() + self.suspicion_timeout()
+            self.node.metrics.incr("swim_suspicions")
+
+    def check_suspicions(self, now):
+        """Declare dead the suspected members that did not refute in time, and remove them from the hash ring."""
+        with self.lock:
+            for node_id, deadline in list(self.suspicions.items()):
+                if deadline > now:
+                    continue
+                del self.suspicions[node_id]
+                entry = self.members[node_id]
+                if entry["state"] == "suspect":
+                    print(f"Node {node_id} is now marked as dead")
+                    entry["state"] = "dead"
+                    self.checksum = None
+                    self.node.metrics.incr("swim_deaths")
+                    self.node.update_hash_ring(node_id, "dead")
+
+    def merge(self, updates):
+        """Apply the newer membership entries of a peer, and update the hash ring accordingly."""
+        with self.lock:
+            for node_id, entry in updates.items():
+                current = self.members.get(node_id)
+                if node_id == self.node_id:
+                    # Refute a suspicion or report of this node's death with a new incarnation
+                    if entry["state"] != "alive" and entry["incarnation"] >= current["incarnation"]:
+                        current["incarnation"] = entry["incarnation"] + 1
+                        self.checksum = None
+                        print(f"Node {self.node_id}: Reported {entry['state']}, now alive at incarnation {current['incarnation']}")
+                    continue
+                if current is not None and entry_version(entry) <= entry_version(current):
+                    continue
+
+                self.members[node_id] = dict(entry)
+                self.checksum = None
+                self.node.metrics.incr("gossip_updates_applied")
+                if entry["state"] == "suspect":
+                    self.suspicions.setdefault(node_id, self.clock() + self.suspicion_timeout())
+                else:
+                    self.suspicions.pop(node_id, None)
+
+                if current is None or current["state"] != entry["state"]:
+                    print(f"Node {node_id} is now marked as {entry['state']}")
+                # Suspected members stay in the hash ring until they are declared dead
+                in_ring = entry["state"] != "dead"
+                if current is None or (current["state"] != "dead") != in_ring:
+                    self.node.update_hash_ring(node_id, "alive" if in_ring else "dead", entry.get("address"), entry.get("weight", 1))
+
+    def run(self):
+        """Event loop of the gossip thread: protocol periods, answers, timeouts and ping_req messages."""
+        context = self.node.context
+        # ping_req messages forwarded by the node's main loop, and the socket their answers go back through
+        inbox = context.socket(zmq.PULL)
+        inbox.bind("inproc://gossip")
+        results = context.socket(zmq.PUSH)
+        results.connect("inproc://results")
+        self.poller = zmq.Poller()
+        self.poller.register(inbox, zmq.POLLIN)
+
+        next_period = self.clock()
+        while not self.shutdown_flag:
+            now = self.clock()
+            if now >= next_period:
+                self.period()
+                next_period = now + self.protocol_period
+            self.expire(now)
+            self.check_suspicions(now)
+
+            deadlines = [next_period] + [deadline for _, deadline in self.callbacks.values()] + list(self.suspicions.values())
+            timeout = max(0, min(deadlines) - self.clock())
+            for socket in dict(self.poller.poll(timeout * 1000 + 1)):
+                if socket is inbox:
+                    # [envelope..., payload] of a ping_req received by the node's ROUTER socket
+                    *envelope, payload = inbox.recv_multipart()
+                    self.handle_ping_req(decompress_data(payload), lambda response, envelope=envelope:
+                                         results.send_multipart([b'peer'] + envelope + [compress_data(response)]))
+                else:
+                    self.receive(socket)
+
+    def start(self):
+        """Start the gossiping process in a separate thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        """Stop the gossiping thread."""
+        self.shutdown_flag = True
@@ -0,0 +1,191 @@
+import os, threading, time
+
+# Hints kept for each unreachable node; the oldest ones are dropped (anti-entropy repairs them later)
+MAX_HINTS = 10000
+# Lists sent to a node in each replay batch
+HINT_BATCH_SIZE = 64
+# Seconds between two attempts to replay the hints of nodes gossip did not report as alive again
+HINT_REPLAY_INTERVAL = 10
+
+class HintedHandoff:
+    def __init__(self, node, data_dir, max_hints=MAX_HINTS):
+        """
+        Remembers the lists that could not be replicated to a node and replays them once the node is back.
+        A hint is only the (node, list_id) pair: replaying it sends the list's latest state, so any number of
+        failed updates to the same list collapse into one hint.
+        Hints survive restarts in an append-only log in the node's data directory.
+        :param node: The node holding the lists.
+        :param data_dir: Directory of the hint log.
+        :param max_hints: Maximum number of hints kept for each node.
+        """
+        self.node = node
+        self.max_hints = max_hints
+        # Lists to replay to each node, oldest first: {target: {list_id: None}}
+        self.hints = {}
+        self.lock = threading.Lock()
+        # Nodes gossip reported as alive again, replayed right away
+        self.requested = set()
+        self.wakeup = threading.Event()
+        self.shutdown_flag = False
+
+        os.makedirs(data_dir, exist_ok=True)
+        self.path = os.path.join(data_dir, 'hints.log')
+        self.log_lines = 0
+        self.load()
+        self.log = open(self.path, 'a')
+        self.update_metrics()
+
+    # Rebuild the hints from the log: '+ target list_id' adds a hint, '- target list_id' removes it
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) != 3:
+                    # A line cut short by a crash
+                    continue
+                operation, target, list_id = parts
+                if operation == '+':
+                    self.hints.setdefault(target, {})[list_id] = None
+                elif target in self.hints:
+                    self.hints[target].pop(list_id, None)
+                self.log_lines += 1
+
+    # Append changes to the log, rewriting it once it is mostly made of removed hints (must hold the lock)
+    def write_log(self, lines):
+        self.log.write(''.join(lines))
+        self.log.flush()
+        self.log_lines += len(lines)
+
+        live = sum(len(list_ids) for list_ids in self.hints.values())
+        if self.log_lines > 2 * live + 1000:
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'w') as file:
+                for target, list_ids in self.hints.items():
+                    file.writelines(f"+ {target} {list_id}\n" for list_id in list_ids)
+            self.log.close()
+            os.replace(temporary_path, self.path)
+            self.log = open(self.path, 'a')
+            self.log_lines = live
+
+    def add(self, target, list_id):
+        """
+        Remember that a list could not be replicated to a node.
+        :param target: The unreachable node.
+        :param list_id: The list it is missing.
+        """
+        with self.lock:
+            list_ids = self.hints.setdefault(target, {})
+            if list_id in list_ids:
+                return
+            lines = [f"+ {target} {list_id}\n"]
+            if len(list_ids) >= self.max_hints:
+                oldest = next(iter(list_ids))
+                del list_ids[oldest]
+                lines.append(f"- {target} {oldest}\n")
+                self.node.metrics.incr("hints_dropped")
+            list_ids[list_id] = None
+            self.write_log(lines)
+            self.update_metrics()
+
+    def remove(self, target, list_ids):
+        """Forget the hints of lists a node now has."""
+        with self.lock:
+            pending = self.hints.get(target)
+            if not pending:
+                return
+            lines = []
+            for list_id in list_ids:
+                if list_id in pending:
+                    del pending[list_id]
+                    lines.append(f"- {target} {list_id}\n")
+            if not pending:
+                del self.hints[target]
+            if lines:
+                self.write_log(lines)
+                self.update_metrics()
+
+    # Expose the number of hints waiting to be replayed (must hold the lock)
+    def update_metrics(self):
+        self.node.metrics.set("hints_queued", sum(len(list_ids) for list_ids in self.hints.values()))
+
+    def request_replay(self, target):
+        """Replay the hints of a node right away, e.g. when gossip reports it as alive again."""
+        with self.lock:
+            if target not in self.hints:
+                return
+            self.requested.add(target)
+        self.wakeup.set()
+
+    def replay(self, target):
+        """
+        Send a node the latest state of every list it is missing, in batches, until it fails.
+        :param target: The node to replay the hints of.
+        :return: Number of lists the node acknowledged.
+        """
+        replayed = 0
+        start = time.time()
+        while True:
+            with self.lock:
+                list_ids = list(self.hints.get(target, {}))[:HINT_BATCH_SIZE]
+            if not list_ids:
+                break
+
+            batch, unknown = [], []
+            for list_id in list_ids:
+                with self.node.get_list_lock(list_id):
+                    if not self.node.knows_list(list_id):
+                        # Nothing left to send (e.g. the node restarted without the list)
+                        unknown.append(list_id)
+                        continue
+                    for replica, version, payload in self.node.build_replication_requests(list_id, [target]):
+                        batch.append((list_id, version, payload))
+            self.remove(target, unknown)
+            if not batch:
+                continue
+
+            response = self.node.replication_manager.send(target, {
+                "operation": "replicate_batch",
+                "requests": [payload for _, _, payload in batch]
+            }).result()
+            acks = response.get("acks") or [{"status": "error"}] * len(batch)
+            failed = 0
+            for (list_id, version, _), ack in zip(batch, acks):
+                # Forgets the hint on success, keeps it on failure
+                self.node.handle_replication_ack(target, list_id, version, ack)
+                failed += ack["status"] == "error"
+            replayed += len(batch) - failed
+            if failed:
+                # The node is failing again, keep the rest for the next replay
+                break
+
+        if replayed:
+            elapsed = max(time.time() - start, 1e-6)
+            self.node.metrics.incr("hints_replayed", replayed)
+            self.node.metrics.set("hint_replay_rate", round(replayed / elapsed))
+            print(f"Node {self.node.node_id}: Replayed {replayed} hints to {target} in {elapsed:.2f}s")
+        return replayed
+
+    def run(self):
+        """Replay the hints of nodes reported alive right away, and retry every node with hints periodically."""
+        while not self.shutdown_flag:
+            requested_only = self.wakeup.wait(HINT_REPLAY_INTERVAL)
+            with self.lock:
+                targets = set(self.requested) if requested_only else set(self.hints)
+                self.requested.clear()
+                self.wakeup.clear()
+            for target in targets:
+                try:
+                    self.replay(target)
+                except Exception as e:
+                    print(f"Node {self.node.node_id}: Replaying hints to {target} failed: {e}")
+
+    def start(self):
+        """Start replaying in a separate thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        """Stop the replay thread."""
+        self.shutdown_flag = True
+        self.wakeup.set()
@@ -0,0 +1,58 @@
+import threading
+
+class MembershipService:
+    def __init__(self, ring):
+        """
+        Owns the hash ring of a node (or of the proxy) and tells subscribers when it changes.
+        The ring is an immutable snapshot: a change builds a new ring and swaps it in with one assignment,
+        so readers take `membership.ring` without a lock and keep a consistent ring for as long as they hold it.
+        :param ring: The initial ring (ConsistentHash), no longer changed in place once handed over.
+        """
+        self.ring = ring
+        self.lock = threading.RLock()  # Serializes the changes and the delivery of their events
+        self.subscribers = []
+
+    @property
+    def version(self):
+        return self.ring.version
+
+    def subscribe(self, callback):
+        """
+        Call `callback(event)` after every ring change, with
+        event = {"version": ring version, "ring": new ring, "added": [node_id], "removed": [node_id]}.
+        Events are delivered in version order, from the thread that made the change: callbacks must not block.
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def add_node(self, node_id, address=None, weight=1):
+        """Swap in a ring with the node added, or with its new address if it is already in the ring."""
+        with self.lock:
+            if node_id in self.ring.nodes:
+                if address is None or self.ring.get_address(node_id) == address:
+                    return
+                ring = self.ring.with_node(node_id, address, weight)
+                self.publish(ring, [], [])
+            else:
+                self.publish(self.ring.with_node(node_id, address, weight), [node_id], [])
+
+    def remove_node(self, node_id):
+        """Swap in a ring without the node."""
+        with self.lock:
+            if node_id not in self.ring.nodes:
+                return
+            self.publish(self.ring.without_node(node_id), [], [node_id])
+
+    # Swap the ring and notify the subscribers (must hold the lock)
+    def publish(self, ring, added, removed):
+        self.ring = ring
+        event = {"version": ring.version, "ring": ring, "added": added, "removed": removed}
+        for callback in list(self.subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Ring change subscriber failed: {e}")
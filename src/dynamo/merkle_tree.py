@@ -0,0 +1,101 @@
+import hashlib
+
+# Children of each tree node
+MERKLE_FANOUT = 16
+# Levels below the root: MERKLE_FANOUT ** MERKLE_DEPTH leaves
+MERKLE_DEPTH = 3
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+class MerkleTree:
+    def __init__(self, fanout=MERKLE_FANOUT, depth=MERKLE_DEPTH):
+        """
+        Hash tree over the digests of the lists in one range of the ring.
+        Each key falls in a leaf; the hash of a leaf is the XOR of the hashes of its (key, digest)
+        entries and the hash of any other node is the XOR of its children, so an update only
+        touches one path. Levels are sparse: nodes with a zero hash are not stored.
+        :param fanout: Children of each node.
+        :param depth: Levels below the root.
+        """
+        self.fanout = fanout
+        self.depth = depth
+        self.levels = [{} for _ in range(depth + 1)]  # [{index: hash}], level 0 is the root
+        self.entries = {}  # {key: (digest, entry hash)}
+        self.leaf_keys = {}  # Keys in each leaf: {leaf index: set of keys}
+
+    def leaf_of(self, key):
+        """Index of the leaf holding a key."""
+        return _hash(key) % (self.fanout ** self.depth)
+
+    def update(self, key, digest):
+        """
+        Set the digest of a key.
+        :param key: The key (list_id).
+        :param digest: Its new digest, None to remove the key.
+        """
+        index = self.leaf_of(key)
+        _, old_hash = self.entries.pop(key, (None, 0))
+        new_hash = 0 if digest is None else _hash(f"{key}|{digest}")
+        if digest is not None:
+            self.entries[key] = (digest, new_hash)
+            self.leaf_keys.setdefault(index, set()).add(key)
+        elif index in self.leaf_keys:
+            self.leaf_keys[index].discard(key)
+            if not self.leaf_keys[index]:
+                del self.leaf_keys[index]
+
+        change = old_hash ^ new_hash
+        if not change:
+            return
+        for level in range(self.depth, -1, -1):
+            value = self.levels[level].get(index, 0) ^ change
+            if value:
+                self.levels[level][index] = value
+            else:
+                self.levels[level].pop(index, None)
+            index //= self.fanout
+
+    def root(self):
+        """Hash of the whole tree, 0 when it is empty."""
+        return self.levels[0].get(0, 0)
+
+    def get_hashes(self, level, indices):
+        """Hashes of some nodes of a level."""
+        return [self.levels[level].get(index, 0) for index in indices]
+
+    def get_entries(self, leaves):
+        """Digests of the keys in some leaves: {key: digest}."""
+        return {key: self.entries[key][0] for leaf in leaves for key in self.leaf_keys.get(leaf, ())}
+
+    def is_empty(self):
+        return not self.entries
+
+    def copy(self):
+        tree = MerkleTree(self.fanout, self.depth)
+        tree.levels = [dict(level) for level in self.levels]
+        tree.entries = dict(self.entries)
+        tree.leaf_keys = {leaf: set(keys) for leaf, keys in self.leaf_keys.items()}
+        return tree
+
+    def diff(self, fetch_hashes, fetch_entries):
+        """
+        Find the keys whose digest differs from a remote tree whose root differs from this one's.
+        Only the subtrees that differ are fetched, one level at a time.
+        :param fetch_hashes: Function (level, indices) -> hashes of those nodes in the remote tree.
+        :param fetch_entries: Function (leaf indices) -> {key: digest} of those leaves in the remote tree.
+        :return: The differing keys with their remote digest (None if the remote tree does not have them).
+        """
+        indices = [0]
+        for level in range(1, self.depth + 1):
+            indices = [child for index in indices for child in range(index * self.fanout, (index + 1) * self.fanout)]
+            remote_hashes = fetch_hashes(level, indices)
+            indices = [index for index, remote_hash in zip(indices, remote_hashes)
+                       if remote_hash != self.levels[level].get(index, 0)]
+            if not indices:
+                return {}
+
+        remote_entries = fetch_entries(indices)
+        local_entries = self.get_entries(indices)
+        return {key: remote_entries.get(key) for key in remote_entries.keys() | local_entries.keys()
+                if remote_entries.get(key) != local_entries.get(key)}
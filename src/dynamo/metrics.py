@@ -0,0 +1,29 @@
+import threading
+
+class Metrics:
+    def __init__(self):
+        """
+        Thread-safe counters and gauges exposed by a node.
+        """
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def incr(self, name, value=1):
+        """Add a value to a counter."""
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        """Set the current value of a gauge."""
+        with self.lock:
+            self.values[name] = value
+
+    def get(self, name):
+        """Get the current value of a counter or gauge."""
+        with self.lock:
+            return self.values.get(name, 0)
+
+    def snapshot(self):
+        """Get a copy of every counter and gauge."""
+        with self.lock:
+            return dict(self.values)
@@ -1,42 +1,149 @@
-import zmq, threading
-from .gossipProtocol import GossipProtocol
+import zmq, threading, time, queue
+from concurrent.futures import Future
+from .gossipProtocol import GossipProtocol, PROTOCOL_PERIOD
 from .consistent_hash import ConsistentHash
+from .membership import MembershipService
+from .metrics import Metrics
+from .replication_scheduler import ReplicationScheduler, REPLICATION_WINDOW
+from .merkle_tree import MerkleTree
+from .hinted_handoff import HintedHandoff
+from .rebalancer import Rebalancer, REBALANCE_RATE
 from storage.shopping_list_manager import ShoppingListManager
+from storage.storage_engine import StorageEngine, FSYNC_POLICY, SNAPSHOT_INTERVAL
+from communication.codec import compress_data, decompress_data
+from crdt.causal_context import stable_version_vector
+
+# Seconds between two tombstone compaction passes
+COMPACTION_INTERVAL = 30
+
+# Number of threads handling requests, they keep the main loop free but share the GIL:
+# more of them do not add throughput to CPU-bound requests, more nodes per machine do
+WORKER_COUNT = 4
+# Number of threads handling the acks of replicate requests and answering coordinated requests once their quorum is reached
+ACK_WORKER_COUNT = 2
+
+# Operations the main loop handles itself, they never touch a list
+CONTROL_OPERATIONS = (b"ping", b"gossip", b"gossip_push", b"stats")
+# Membership operations, not logged
+MEMBERSHIP_OPERATIONS = ("ping", "ping_req", "gossip", "gossip_push")
+
+# Client operations coordinated with the list's replicas
+COORDINATED_OPERATIONS = ("read", "write", "delete")
+
+# Replicas that must answer a read or acknowledge a write, counting the coordinator itself
+READ_QUORUM = 2
+WRITE_QUORUM = 2
+
+# Seconds between two anti-entropy rounds
+ANTI_ENTROPY_INTERVAL = 30
 
 class Node:
-    def __init__(self, node_id, port, hash_ring=None, replication_manager=None, known_nodes=None):
+    def __init__(self, node_id, port, membership=None, replication_manager=None, known_nodes=None, proxy_address="tcp://localhost:5559", worker_count=WORKER_COUNT, replication_window=REPLICATION_WINDOW,
+                 read_quorum=READ_QUORUM, write_quorum=WRITE_QUORUM, anti_entropy_interval=ANTI_ENTROPY_INTERVAL, data_dir=None,
+                 rebalance_rate=REBALANCE_RATE, protocol_period=PROTOCOL_PERIOD, fsync_policy=FSYNC_POLICY, snapshot_interval=SNAPSHOT_INTERVAL):
         self.node_id = node_id
         self.port = port
-        self.hash_ring = hash_ring  # Reference to the consistent hash ring
+        self.membership = membership or MembershipService(ConsistentHash())  # Owner of the hash ring snapshots
+        self.known_nodes = {node["node_id"]: node for node in known_nodes or []}  # Configuration of every node
         self.replication_manager = replication_manager  # Reference to the replication manager
         self.context = zmq.Context()
 
-        self.rep_socket = self.context.socket(zmq.REP)
-        self.rep_socket.bind(f"tcp://*:{self.port}")
+        # ROUTER instead of REP, so requests from other nodes can be answered out of order by the workers
+        self.router_socket = self.context.socket(zmq.ROUTER)
+        self.router_socket.bind(f"tcp://*:{self.port}")
         print(f"Node {self.node_id}: Listening for requests on tcp://*:{self.port}")
 
         self.dealer_socket = self.context.socket(zmq.DEALER)
         
         # Set the dealer socket identity
         self.dealer_socket.setsockopt(zmq.IDENTITY, node_id.encode())
-        self.dealer_socket.connect("tcp://localhost:5559")
-        print(f"{self.dealer_socket.identity} connected to tcp://localhost:5559")
+        self.dealer_socket.connect(proxy_address)
+        print(f"{self.dealer_socket.identity} connected to {proxy_address}")
         
+        # Workers hand their responses back to the main loop, which owns the sockets
+        self.results_socket = self.context.socket(zmq.PULL)
+        self.results_socket.bind("inproc://results")
+        # Sockets pushing to it, one per thread that answers requests (see send_result)
+        self.result_sockets = threading.local()
+
+        # ping_req messages wait for the probe of another node, so the gossip thread answers them
+        self.gossip_socket = self.context.socket(zmq.PUSH)
+        self.gossip_socket.connect("inproc://gossip")
+
         # start poller
         self.poller = zmq.Poller()
-        self.poller.register(self.rep_socket, zmq.POLLIN)
+        self.poller.register(self.router_socket, zmq.POLLIN)
         self.poller.register(self.dealer_socket, zmq.POLLIN)
+        self.poller.register(self.results_socket, zmq.POLLIN)
 
-        # Initialize Gossip Protocol
-        self.gossip_protocol = GossipProtocol(self.node_id, self, known_nodes)
-        self.gossip_protocol.start()  # Start gossiping in a separate thread
+        # Requests waiting for a worker: (source, envelope, payload)
+        self.jobs = queue.Queue()
+        self.worker_count = worker_count
+        # Continuations of replication acks waiting for an ack worker: (function, args), see defer
+        self.ack_jobs = queue.Queue()
+
+        # One lock per list: requests for different lists run in parallel, writes to the same list are serialized
+        self.list_locks = {}
+        self.list_locks_lock = threading.Lock()
+        # Guards the set of active and deleted lists, shared by every list
+        self.catalog_lock = threading.Lock()
 
         # Initialize ShoppingListManager
         self.shopping_manager = ShoppingListManager()
 
+        # The lists survive restarts in a write-ahead log and snapshots in the node's data directory
+        self.data_dir = data_dir or f"data/{node_id}"
+        self.storage = StorageEngine(self.data_dir, fsync_policy)
+        recovered, replayed = self.storage.recover(self.shopping_manager)
+        print(f"Node {self.node_id}: Recovered {recovered} lists, replaying {replayed} log records")
+        self.snapshot_interval = snapshot_interval
+
+        # Versions of each list acknowledged by each replica: {(replica, list_id): version}
+        self.replica_versions = {}
+        # Causal contexts of each list acknowledged by each replica: {(replica, list_id): version vector}
+        self.replica_contexts = {}
+        self.replica_versions_lock = threading.Lock()
+
+        # Counters exposed through the 'stats' operation
+        self.metrics = Metrics()
+
+        # Replicates the lists changed by clients, coalescing bursts of writes
+        self.replication_scheduler = ReplicationScheduler(self, replication_window)
+
+        # Replicas (R and W, out of the replication factor N) that must answer client reads and writes
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+
+        # Merkle trees of the lists held in each range of the ring, for anti-entropy: {range: MerkleTree}
+        self.merkle_trees = {}
+        # State summarized in the trees for each list: {list_id: (shopping_list, version, range)}
+        self.merkle_entries = {}
+        # Ring the trees were built for, they are rebuilt when its ranges change
+        self.merkle_ring = None
+        self.merkle_lock = threading.Lock()
+        self.anti_entropy_interval = anti_entropy_interval
+
+        # Lists that could not be replicated to unreachable nodes, replayed when they come back (hinted handoff)
+        self.hinted_handoff = HintedHandoff(self, self.data_dir)
+
+        # Streams lists to the nodes that become their replicas when the ring changes
+        self.rebalancer = Rebalancer(self, rebalance_rate)
+
+        # Follow the ring changes the gossip protocol makes
+        self.membership.subscribe(self.on_ring_change)
+
+        # Initialize Gossip Protocol, last: it calls back into the node as soon as it learns of other nodes
+        self.gossip_protocol = GossipProtocol(self.node_id, self, known_nodes, protocol_period)
+        self.gossip_protocol.start()  # Start gossiping in a separate thread
+
+    @property
+    def hash_ring(self):
+        """The current ring snapshot: never changed in place, a membership change swaps in a new one."""
+        return self.membership.ring
+
     # Handles messages received from proxy
     def handle_message(self, topic, message):
-        if topic != "gossip":    
+        if topic not in MEMBERSHIP_OPERATIONS:
             print(f"Node {self.node_id}: Handling message with topic={topic}, message={message}")
 
         # Handle write operation
@@ -69,39 +176,55 @@ class Node:
             
         # Handle replication operation
         elif topic == "replicate":    
-            try:
-                ack = self.handle_replicate(message)
-                if ack == "success":
-                    return {"status": "success"}   
-                else:
-                    return {"status": "error"}
-            except Exception as e:
-                return {"status": "error", "message": str(e)}         
+            return self.acknowledge_replicate(message)
+
+        # Handle a read of the local state by the coordinator of a client read
+        elif topic == "replica_read":
+            shopping_list = self.shopping_manager.shopping_lists.peek(message["list_id"])
+            return {
+                "status": "success",
+                "node_id": self.node_id,
+                "shopping_list": shopping_list,
+                # Lets the coordinator tell whether this replica needs a repair
+                "digest": None if shopping_list is None else shopping_list.digest()
+            }
+
+        # Handle anti-entropy requests: roots of some ranges, then the differing subtrees and leaves
+        elif topic == "merkle_roots":
+            with self.merkle_lock:
+                self.refresh_merkle_trees()
+                return {"status": "success", "roots": [self.get_merkle_tree(token).root() for token in message["ranges"]]}
+        elif topic == "merkle_hashes":
+            with self.merkle_lock:
+                return {"status": "success", "hashes": self.get_merkle_tree(message["range"]).get_hashes(message["level"], message["indices"])}
+        elif topic == "merkle_entries":
+            with self.merkle_lock:
+                return {"status": "success", "entries": self.get_merkle_tree(message["range"]).get_entries(message["indices"])}
+
+        # Handle a batch of replicate requests, each one an encoded replicate message
+        elif topic == "replicate_batch":
+            acks = []
+            for request in message["requests"]:
+                request = decompress_data(request)
+                with self.get_list_lock(request["list_id"]):
+                    acks.append(self.acknowledge_replicate(request))
+            return {"status": "success", "acks": acks}
         
-        # Handle gossip operation
+        # Handle failure detector probes
+        elif topic == "ping":
+            return self.gossip_protocol.handle_ping(message)
+
+        # Handle gossip operations: membership checksum, then the newer entries
         elif topic == "gossip":
-            # Process the gossip message
-            remote_node_id = message["node_id"]
-            remote_node_states = message["node_states"]
-            remote_hash_ring = message["hash_ring"]
-
-            # Merge the gossip states
-            self.gossip_protocol.merge_states(remote_node_states)
-
-            # Update the local hash ring based on the remote hash ring
-            self.merge_hash_ring(remote_hash_ring)
-
-            # Send a response acknowledging the gossip
-            response = {
-                "status": "success",  # Acknowledge success
-                "message": f"Gossip processed from node {remote_node_id}",  # Optional detailed message
-                "node_id": self.node_id,  # Include the local node's ID
-                "node_states": self.gossip_protocol.node_states,  # Optionally, include the current local node states
-                "hash_ring": self.hash_ring.ring  # Optionally, include the updated hash ring
-            }
+            return self.gossip_protocol.handle_gossip(message)
 
-            return response
+        elif topic == "gossip_push":
+            return self.gossip_protocol.handle_push(message)
         
+        # Handle metrics request
+        elif topic == "stats":
+            return {"status": "success", "node_id": self.node_id, "stats": self.metrics.snapshot()}
+
         # Handle unknown operation
         else:
             print(f"Node {self.node_id}: Unknown topic {topic}")
@@ -109,25 +232,57 @@ class Node:
     def handle_write(self, message):
         """
         Handles the write operation.
-        Merges the incoming list with the local state.
+        Merges the incoming list (full state or delta) with the local state and answers
+        with the changes since the version the client last saw from this node.
         """
         list = message["shopping_list"]
         list_id = message['list_id']
 
         print(f"Node {self.node_id}: Write operation for key={list_id} with list={list}")
 
-        if list_id in self.shopping_manager.get_removed_lists():
-            raise KeyError(f"Shopping list with ID {list_id} has been deleted.")
+        with self.catalog_lock:
+            if list_id in self.shopping_manager.get_removed_lists():
+                raise KeyError(f"Shopping list with ID {list_id} has been deleted.")
 
-        if list_id not in self.shopping_manager.get_lists_still_active():
-            self.shopping_manager.create_shopping_list_with_id(list_id)
+            # A delta can only be applied on top of the state it was computed against, the client then sends the full list
+            if message.get("delta") and not self.holds_write_base(message):
+                print(f"Node {self.node_id}: Missing base state for delta of list_id={list_id}, requesting full state")
+                return {"status": "resync"}
+
+            if list_id not in self.shopping_manager.get_lists_still_active():
+                self.shopping_manager.create_shopping_list_with_id(list_id)
 
         # Merge the shopping lists with the same item_id 
-        self.shopping_manager.shopping_lists[list_id].merge(list)
+        shopping_list = self.shopping_manager.shopping_lists[list_id]
+        shopping_list.merge(list)
+        self.storage.log_merge(list_id, list, shopping_list.get_version())
 
         print(f"Node {self.node_id}: Write operation completed for key={list_id}")
-    
-        return {'shopping_list': self.shopping_manager.shopping_lists[list_id] }  # Send acknowledgment for write operation
+
+        # Versions seen by the client are only meaningful if they were issued by this node
+        since = message.get("since") if message.get("since_node") == self.node_id else None
+        delta = shopping_list.get_delta(since)
+
+        # Send acknowledgment for write operation
+        return {
+            'shopping_list': shopping_list if delta is None else delta,
+            'delta': delta is not None,
+            'node_id': self.node_id,
+            'version': shopping_list.get_version()
+        }
+
+    def holds_write_base(self, message):
+        """
+        Whether this node holds the base state of a client's delta: the state it answered the client's
+        last write with, at version `since`. Another node may lack some of its items, even if it has the list.
+        :param message: The write request.
+        :return: True if the delta can be merged.
+        """
+        if message.get("since_node") != self.node_id or message.get("since") is None:
+            return False
+        shopping_list = self.shopping_manager.shopping_lists.peek(message["list_id"])
+        # A version past ours was issued before this node lost part of its log
+        return shopping_list is not None and message["since"] <= shopping_list.get_version()
 
     def handle_read(self, message):
         """
@@ -135,11 +290,9 @@ class Node:
         Returns the current state of the requested shopping list.
         """
         list_id = message["list_id"]
-        try:
-            list = self.shopping_manager.get_shopping_list(list_id)
-            if(list == None):
-                raise KeyError(f"Shopping list with ID {list_id} does not exist.")
-        except KeyError as e:
+        # Reads decode lists still only in the snapshot without keeping them in memory
+        list = self.shopping_manager.shopping_lists.peek(list_id)
+        if(list == None):
             raise KeyError(f"Shopping list with ID {list_id} does not exist.")
 
         print(f"Node {self.node_id}: Read operation completed. List: {list}")
@@ -154,31 +307,67 @@ class Node:
             raise KeyError(f"Shopping list with ID {list_id} already exists.")
         
         # Create a new empty shopping list and add to set
-        self.shopping_manager.create_shopping_list_with_id(list_id)
+        with self.catalog_lock:
+            self.shopping_manager.create_shopping_list_with_id(list_id)
+        self.storage.log_create(list_id)
         print(f"Node {self.node_id}: Created new shopping list with ID {list_id}")
 
         return {"list_id": list_id}
     
     def handle_deletion(self, message):
-        self.shopping_manager.delete_shopping_list(message["list_id"])
+        with self.catalog_lock:
+            self.shopping_manager.delete_shopping_list(message["list_id"])
+        self.storage.log_delete(message["list_id"])
         return {"list_id": message["list_id"]}
 
+    # Apply a replicate request and build its acknowledgment
+    def acknowledge_replicate(self, message):
+        try:
+            ack = self.handle_replicate(message)
+            if ack == "success":
+                # Share the causal context of the list so the sender can compact tombstones
+                shopping_list = self.shopping_manager.shopping_lists.get(message["list_id"])
+                context = None if shopping_list is None else shopping_list.get_context()
+                return {"status": "success", "context": context}
+            elif ack == "resync":
+                return {"status": "resync"}
+            else:
+                return {"status": "error"}
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
     # Handle replication
     def handle_replicate(self, message):
         try:
             list_id = message["list_id"]
             list = message["shopping_list"]
 
-            # if the list id is not found, it means we're replicating a newly created list
-            if list_id not in self.shopping_manager.shopping_lists:
-                self.shopping_manager.create_shopping_list_with_id(list_id)
+            # A delta can only be applied on top of a state we already hold
+            if message.get("delta") and list_id not in self.shopping_manager.shopping_lists:
+                print(f"Node {self.node_id}: Missing base state for delta of list_id={list_id}, requesting full state")
+                return "resync"
 
-            if(list == None):
-                # If the list is empty, it means we're replicating a deletion
-                self.shopping_manager.delete_shopping_list(list_id)
-            else:
+            with self.catalog_lock:
+                # A deleted list is not brought back by a replica that missed the deletion
+                if list is not None and list_id in self.shopping_manager.get_removed_lists():
+                    print(f"Node {self.node_id}: Ignoring replication of deleted list_id={list_id}")
+                    return "success"
+
+                # if the list id is not found, it means we're replicating a newly created list
+                if list_id not in self.shopping_manager.shopping_lists:
+                    self.shopping_manager.create_shopping_list_with_id(list_id)
+
+                if(list == None):
+                    # If the list is empty, it means we're replicating a deletion
+                    self.shopping_manager.delete_shopping_list(list_id)
+
+            if list is not None:
                 # Merge the shopping lists with the same item_id
-                self.shopping_manager.shopping_lists[list_id].merge(list)
+                shopping_list = self.shopping_manager.shopping_lists[list_id]
+                shopping_list.merge(list)
+                self.storage.log_merge(list_id, list, shopping_list.get_version())
+            else:
+                self.storage.log_delete(list_id)
         
             print(f"Node {self.node_id}: Replication completed for list_id={list_id}")
             return "success"
@@ -187,73 +376,614 @@ class Node:
             return "error"
 
     # Add new node to hash ring
-    def add_node(self, new_node_id):
+    def add_node(self, new_node_id, address=None, weight=1):
         print(f"Node {self.node_id}: Adding new node {new_node_id} to the hash ring")
-        self.hash_ring.add_node(new_node_id)
+        # Every node must place the same virtual nodes, so the address and weight come from the configuration,
+        # or from the node's membership entry for nodes outside of it
+        node_config = self.known_nodes.get(new_node_id, {"address": address, "weight": weight})
+        self.membership.add_node(new_node_id, node_config.get("address"), node_config.get("weight", 1))
 
     # Remove node from hash ring
     def remove_node(self, node_id_to_remove):
         print(f"Node {self.node_id}: Removing node {node_id_to_remove} from the hash ring")
-        self.hash_ring.remove_node(node_id_to_remove)
+        self.membership.remove_node(node_id_to_remove)
+
+    def replicate_to_single_node(self, replica, list_id, version, payload):
+        """
+        Send an encoded replicate request to a single replica, without waiting for the answer.
+        :param replica: The replica to send the request to.
+        :param list_id: The replicated list.
+        :param version: Local version of the list in the request.
+        :param payload: The encoded replicate request.
+        :return: Future of the replica's ack, after sending the full list if the replica asked for it.
+        """
+        result = Future()
+        future = self.replication_manager.send_payload(replica, "replicate", payload)
+        future.add_done_callback(lambda future: self.defer(self.handle_replication_ack, replica, list_id, version, future.result(), result))
+        return result
+
+    # Record the state a replica acknowledged (runs on an ack worker, see defer)
+    def handle_replication_ack(self, replica, list_id, version, ack, result=None):
+        status = ack["status"]
+        if status == "resync":
+            # The replica is missing the base state of the delta, send the full list
+            with self.replica_versions_lock:
+                self.replica_versions.pop((replica, list_id), None)
+            with self.get_list_lock(list_id):
+                (_, version, payload), = self.build_replication_requests(list_id, [replica])
+                future = self.replicate_to_single_node(replica, list_id, version, payload)
+            if result is not None:
+                future.add_done_callback(lambda future: result.set_result(future.result()))
+            return
+
+        with self.replica_versions_lock:
+            if status == "success" and version is not None:
+                self.replica_versions[(replica, list_id)] = version
+                if ack.get("context") is not None:
+                    self.replica_contexts[(replica, list_id)] = ack["context"]
+            else:
+                # Unknown replica state, ship the full list next time
+                self.replica_versions.pop((replica, list_id), None)
+
+        if status == "success":
+            # The replica now holds the latest state (the full list after a failure), nothing left to hand off
+            self.hinted_handoff.remove(replica, [list_id])
+        else:
+            self.hinted_handoff.add(replica, list_id)
 
-    # Function to handle replication for a single replica
-    def replicate_to_single_node(self, replica, list_id, data):
-        self.replication_manager.replicate_to_node(replica, list_id, data)
-        print(f"Node {self.node_id}: Replication to node {replica} completed for list_id={list_id}")
+        print(f"Node {self.node_id}: Replication to node {replica} completed for list_id={list_id} with status={status}")
+        if result is not None:
+            result.set_result(ack)
 
-    def replicate_to_nodes(self, message):
+    # Whether this node holds a list or knows it was deleted (must hold the list's lock)
+    def knows_list(self, list_id):
+        if list_id in self.shopping_manager.shopping_lists:
+            return True
+        with self.catalog_lock:
+            return list_id in self.shopping_manager.get_removed_lists()
+
+    def build_replication_requests(self, list_id, replicas=None):
+        """
+        Encode the replicate requests of a list for each of its replicas.
+        Replicas that acknowledged the same version share one encoded request.
+        Must be called with the list's lock held.
+        :param list_id: The list to replicate.
+        :param replicas: The nodes to replicate to, the list's replicas by default.
+        :return: List of (replica, version, encoded replicate request).
+        """
+        shopping_list = self.shopping_manager.shopping_lists.peek(list_id)
+        version = None if shopping_list is None else shopping_list.get_version()
+        payloads = {}  # {since: payload}
+        requests = []
+        for replica in replicas or self.replication_manager.get_replicas(list_id):
+            if replica == self.node_id:  # Avoid self-replication
+                continue
+            if shopping_list is None:
+                # Replicate the deletion
+                since, data, delta = None, None, None
+            else:
+                # Ship only the changes the replica has not acknowledged yet
+                with self.replica_versions_lock:
+                    since = self.replica_versions.get((replica, list_id))
+                delta = shopping_list.get_delta(since)
+                data = shopping_list if delta is None else delta
+                if delta is None:
+                    since = None
+
+            if since not in payloads:
+                payloads[since] = compress_data({
+                    "operation": "replicate",
+                    "list_id": list_id,
+                    "shopping_list": data,
+                    "delta": delta is not None
+                })
+            requests.append((replica, version, payloads[since]))
+        return requests
+
+    def compact_tombstones(self):
+        """
+        Drop the tombstones of every list whose removal all of the list's replicas have seen,
+        according to the causal contexts they acknowledged.
+        """
+        reclaimed = 0
+        tombstones = 0
+        # Lists still only in the snapshot are only decoded if they hold tombstones
+        for list_id, shopping_list in list(self.shopping_manager.shopping_lists.entries()):
+            with self.get_list_lock(list_id):
+                if shopping_list.count_tombstones() > 0 and list_id in self.shopping_manager.shopping_lists:
+                    replicas = [replica for replica in self.replication_manager.get_replicas(list_id) if replica != self.node_id]
+                    with self.replica_versions_lock:
+                        contexts = [self.replica_contexts.get((replica, list_id)) for replica in replicas]
+
+                    # Until every replica acknowledged a context nothing is known to be stable
+                    if all(context is not None for context in contexts):
+                        shopping_list = self.shopping_manager.shopping_lists[list_id]
+                        stable_vv = stable_version_vector([shopping_list.get_context()] + contexts)
+                        list_reclaimed = shopping_list.compact(stable_vv)
+                        if list_reclaimed:
+                            # Replicas drop the same tombstones when they merge the compacted full state, and so does recovery
+                            self.storage.log_merge(list_id, shopping_list, shopping_list.get_version())
+                            self.replication_scheduler.schedule(list_id)
+                        reclaimed += list_reclaimed
+                tombstones += shopping_list.count_tombstones()
+
+        self.metrics.incr("compaction_runs")
+        self.metrics.incr("tombstones_reclaimed", reclaimed)
+        self.metrics.set("tombstones", tombstones)
+        if reclaimed:
+            print(f"Node {self.node_id}: Compaction reclaimed {reclaimed} tombstones")
+
+    def refresh_merkle_trees(self):
+        """
+        Bring the Merkle trees up to date with the lists held by the node.
+        Only the lists whose version changed since the last refresh are hashed again.
+        Must be called with the Merkle lock held.
+        """
+        hash_ring = self.hash_ring
+        ring = list(hash_ring.sorted_keys)
+        if ring != self.merkle_ring:
+            # The ranges changed, every list may belong to a different tree
+            self.merkle_trees = {}
+            self.merkle_entries = {}
+            self.merkle_ring = ring
+        if not ring:
+            return
+
+        shopping_lists = self.shopping_manager.shopping_lists
+        # The versions and digests of the lists still only in the snapshot are read from it
+        for list_id, shopping_list in list(shopping_lists.entries()):
+            entry = self.merkle_entries.get(list_id)
+            if entry is not None and entry[0] is shopping_list and entry[1] == shopping_list.get_version():
+                continue
+            with self.get_list_lock(list_id):
+                version, digest = shopping_list.get_version(), shopping_list.digest()
+            token = hash_ring.get_range(list_id)
+            self.merkle_trees.setdefault(token, MerkleTree()).update(list_id, digest)
+            self.merkle_entries[list_id] = (shopping_list, version, token)
+
+        for list_id in [list_id for list_id in self.merkle_entries if list_id not in shopping_lists]:
+            _, _, token = self.merkle_entries.pop(list_id)
+            self.merkle_trees[token].update(list_id, None)
+
+    def get_merkle_tree(self, token):
+        """Get the Merkle tree of a range (an empty one if the node holds no list in it)."""
+        return self.merkle_trees.get(token) or MerkleTree()
+
+    def merkle_request(self, peer, message):
+        """
+        Send an anti-entropy request to a peer and wait for the answer.
+        :raise ConnectionError: If the peer did not answer.
+        """
+        response = self.replication_manager.send(peer, message).result()
+        if response.get("status") != "success":
+            raise ConnectionError(f"Node {peer} did not answer {message['operation']}")
+        return response
+
+    def anti_entropy(self):
+        """
+        Compare the Merkle tree of every range with the other replicas of the range and sync the lists that differ.
+        Ranges whose roots match cost nothing more than their root; for the others only the differing subtrees are fetched.
+        """
+        with self.merkle_lock:
+            self.refresh_merkle_trees()
+            # Ranges to compare with each peer: {peer: [range]}
+            shared = {}
+            for token, tree in self.merkle_trees.items():
+                if tree.is_empty():
+                    continue
+                # Every list of a range has the same replicas
+                for replica in self.replication_manager.get_replicas(next(iter(tree.entries))):
+                    if replica != self.node_id:
+                        shared.setdefault(replica, []).append(token)
+
+        synced = 0
+        for peer, tokens in shared.items():
+            try:
+                roots = self.merkle_request(peer, {"operation": "merkle_roots", "ranges": tokens})["roots"]
+                for token, root in zip(tokens, roots):
+                    with self.merkle_lock:
+                        tree = self.get_merkle_tree(token)
+                        if tree.root() == root:
+                            continue
+                        # The tree keeps changing while the peer is queried
+                        tree = tree.copy()
+
+                    differences = tree.diff(
+                        lambda level, indices: self.merkle_request(peer, {"operation": "merkle_hashes", "range": token, "level": level, "indices": indices})["hashes"],
+                        lambda indices: self.merkle_request(peer, {"operation": "merkle_entries", "range": token, "indices": indices})["entries"])
+                    self.metrics.incr("anti_entropy_ranges_diverged")
+
+                    for list_id, digest in differences.items():
+                        if digest is None:
+                            # The peer does not have the list
+                            self.replication_scheduler.schedule_repair(list_id, peer, None)
+                        else:
+                            # Fetch the peer's state, merge it and send back what the peer is missing
+                            future = self.replication_manager.send(peer, {"operation": "replica_read", "list_id": list_id})
+                            future.add_done_callback(lambda future, list_id=list_id, peer=peer: self.schedule_read_repair(list_id, peer, future.result(), ()))
+                    synced += len(differences)
+            except ConnectionError as e:
+                print(f"Node {self.node_id}: Anti-entropy with {peer} failed: {e}")
+
+        self.metrics.incr("anti_entropy_rounds")
+        self.metrics.incr("anti_entropy_lists_synced", synced)
+        if synced:
+            print(f"Node {self.node_id}: Anti-entropy found {synced} divergent lists")
+
+    def anti_entropy_loop(self):
+        """Run anti-entropy rounds periodically."""
+        while True:
+            time.sleep(self.anti_entropy_interval)
+            try:
+                self.anti_entropy()
+            except Exception as e:
+                print(f"Node {self.node_id}: Anti-entropy round failed: {e}")
+
+    def snapshot_loop(self):
+        """Snapshot the lists periodically, or earlier once the write-ahead log grew large, and truncate the log."""
+        last_snapshot = time.time()
+        while True:
+            time.sleep(1)
+            self.metrics.set("wal_fsyncs", self.storage.fsyncs)
+            if time.time() - last_snapshot < self.snapshot_interval and not self.storage.needs_snapshot():
+                continue
+            start = time.time()
+            try:
+                count = self.storage.snapshot(self.shopping_manager, self.get_list_lock, self.catalog_lock)
+            except Exception as e:
+                print(f"Node {self.node_id}: Snapshot failed: {e}")
+                continue
+            finally:
+                last_snapshot = time.time()
+            self.metrics.incr("snapshots")
+            print(f"Node {self.node_id}: Snapshot of {count} lists in {last_snapshot - start:.2f}s")
+
+    def compaction_loop(self):
+        """Compact tombstones periodically, alongside the workers."""
+        while True:
+            time.sleep(COMPACTION_INTERVAL)
+            self.compact_tombstones()
+
+    def get_list_lock(self, list_id):
+        """
+        Get the lock serializing the requests for a list.
+        :param list_id: The list to lock.
+        :return: The list's lock (threading.Lock).
+        """
+        with self.list_locks_lock:
+            lock = self.list_locks.get(list_id)
+            if lock is None:
+                lock = self.list_locks[list_id] = threading.Lock()
+            return lock
+
+    def handle_job(self, source, message, reply):
+        """
+        Handle a request. Client reads, writes and deletions are coordinated with the list's replicas.
+        :param source: Where the request came from (b'proxy' or b'peer').
+        :param message: The decoded request.
+        :param reply: Function sending an encoded response back, for the responses that wait for replicas.
+        :return: The encoded response to send back, or None if reply will send it.
+        """
+        operation = message["operation"]
+        list_id = message.get("list_id")
+        # Gossip and stats do not touch any list
+        if list_id is None:
+            return compress_data(self.handle_message(operation, message))
+
+        if source == b'proxy' and operation in COORDINATED_OPERATIONS:
+            return self.coordinate(operation, message, reply)
+
+        # The response is encoded before releasing the lock, since it may hold the list itself
+        with self.get_list_lock(list_id):
+            return compress_data(self.handle_message(operation, message))
+
+    def coordinate(self, operation, message, reply):
+        """
+        Coordinate a client request with the list's replicas (N/R/W quorums).
+        Never waits for the replicas: the response is sent from an ack worker once the quorum is reached,
+        so the request workers move on to other requests. The list's lock is only held to touch the local state.
+        :param operation: 'read', 'write' or 'delete'.
+        :param message: The decoded request.
+        :param reply: Function sending the encoded response back.
+        :return: The encoded response if it does not wait for replicas, None otherwise.
+        """
         list_id = message["list_id"]
+        lock = self.get_list_lock(list_id)
+
+        if operation == "read":
+            requests = []
+            def send_reads(replicas):
+                sent = [(replica, self.replication_manager.send(replica, {"operation": "replica_read", "list_id": list_id}))
+                        for replica in replicas]
+                requests.extend(sent)
+                return sent
+
+            def finish_read(responses):
+                # Merge the states of R - 1 replicas (the coordinator being the other one) into the local state
+                with lock:
+                    self.merge_replica_states(list_id, responses)
+                    encoded = compress_data(self.handle_message(operation, message))
+
+                # Read repair: every answer, including the ones slower than the quorum, is checked in the background
+                merged = {response["node_id"] for response in responses}
+                for replica, future in requests:
+                    future.add_done_callback(lambda future, replica=replica: self.schedule_read_repair(list_id, replica, future.result(), merged))
+                return encoded
+
+            self.fan_out(list_id, self.read_quorum - 1, send_reads, lambda responses: self.complete(reply, finish_read, responses))
+            return None
+
+        with lock:
+            response = self.handle_message(operation, message)
+            encoded = compress_data(response)
+            if "error" in response or response.get("status") == "resync":
+                return encoded
+            if self.write_quorum <= 1:
+                # Nothing to wait for, replicate in the background with the other updates
+                self.replication_scheduler.schedule(list_id)
+                return encoded
+
+        def finish_write(acks):
+            if len(acks) >= self.write_quorum - 1:
+                return encoded
+
+            # The write is applied locally and reaches the other replicas later
+            self.metrics.incr("write_quorum_failures")
+            self.replication_scheduler.schedule(list_id)
+            with lock:
+                response["message"] = f"Write acknowledged by {len(acks) + 1} of {self.write_quorum} replicas"
+                return compress_data(response)
+
+        self.fan_out(list_id, self.write_quorum - 1, lambda replicas: self.send_replication_requests(list_id, replicas),
+                     lambda acks: self.complete(reply, finish_write, acks))
+        return None
+
+    def complete(self, reply, finish, responses):
+        """
+        Answer a coordinated request once its replicas answered (runs on an ack worker).
+        :param reply: Function sending the encoded response back.
+        :param finish: Function building the encoded response from the replicas' responses.
+        :param responses: The successful responses of the replicas.
+        """
+        try:
+            response = finish(responses)
+        except Exception as e:
+            print(f"Node {self.node_id}: Error handling request: {e}")
+            response = compress_data({"status": "error", "error": str(e)})
+        reply(response)
+
+    def send_replication_requests(self, list_id, replicas):
+        """
+        Send the list to some of its replicas.
+        :param list_id: The list to replicate.
+        :param replicas: The replicas to send it to.
+        :return: List of (replica, future of its ack).
+        """
+        with self.get_list_lock(list_id):
+            requests = self.build_replication_requests(list_id, replicas)
+            return [(replica, self.replicate_to_single_node(replica, list_id, version, payload))
+                    for replica, version, payload in requests]
 
-         # Replicate the update to replicas
-        replicas = self.replication_manager.get_replicas(list_id)
-        for replica in replicas:
-            if replica != self.node_id:  # Avoid self-replication
+    def fan_out(self, list_id, required, send, callback):
+        """
+        Send a request to every replica of a list, and call back once `required` of them succeeded.
+        If too many replicas fail, the next nodes on the ring stand in for them (sloppy quorum).
+        :param list_id: The list of the request.
+        :param required: Number of successful responses to wait for.
+        :param send: Function sending the request to a list of nodes, returning (node, future) pairs.
+        :param callback: Function called on an ack worker with the successful responses received
+                         (at least `required` unless not enough nodes answered).
+        """
+        replicas = [replica for replica in self.replication_manager.get_replicas(list_id) if replica != self.node_id]
+
+        def on_quorum(responses):
+            if len(responses) >= required:
+                return callback(responses)
+            contacted = set(replicas) | {self.node_id}
+            ring = self.replication_manager.get_replicas(list_id, len(self.hash_ring.get_nodes()))
+            fallbacks = [node for node in ring if node not in contacted][:required - len(responses)]
+            if not fallbacks:
+                return callback(responses)
+            print(f"Node {self.node_id}: Quorum not reached for list_id={list_id}, trying {fallbacks}")
+            self.gather_quorum([future for _, future in send(fallbacks)], required - len(responses),
+                               lambda more: callback(responses + more))
+
+        self.gather_quorum([future for _, future in send(replicas)], required, on_quorum)
+
+    def gather_quorum(self, futures, required, callback):
+        """
+        Call back once `required` futures succeeded or every future completed. Never waits: the replication
+        manager completes every future, with an error once its request timed out.
+        :param futures: Futures of the responses of the replicas.
+        :param required: Number of successful responses to wait for.
+        :param callback: Function called on an ack worker with the successful responses received.
+        """
+        if required <= 0 or not futures:
+            self.defer(callback, [])
+            return
+
+        lock = threading.Lock()
+        responses = []
+        remaining = [len(futures)]
+        called = [False]
+
+        def on_response(future):
+            with lock:
+                remaining[0] -= 1
+                if called[0]:
+                    return
+                if future.result().get("status") == "success":
+                    responses.append(future.result())
+                if len(responses) < required and remaining[0] > 0:
+                    return
+                called[0] = True
+            # Done-callbacks run on the replication manager's I/O thread
+            self.defer(callback, list(responses))
+
+        for future in futures:
+            future.add_done_callback(on_response)
+
+    # Queue a replica's answer to a read for read repair
+    def schedule_read_repair(self, list_id, replica, response, merged):
+        if response.get("status") != "success":
+            return
+        # States that arrived after the quorum were not merged into the local list yet
+        shopping_list = None if replica in merged else response.get("shopping_list")
+        self.replication_scheduler.schedule_repair(list_id, replica, response.get("digest"), shopping_list)
+
+    def find_stale_replicas(self, list_id, answers):
+        """
+        Merge the states replicas answered a read with, and find the replicas whose state differs from the result.
+        Must be called with the list's lock held.
+        :param list_id: The list that was read.
+        :param answers: The replicas' answers: [(replica, digest, shopping_list or None if already merged)].
+        :return: The replicas to repair.
+        """
+        self.merge_replica_states(list_id, [{"shopping_list": shopping_list} for _, _, shopping_list in answers])
+        shopping_list = self.shopping_manager.shopping_lists.peek(list_id)
+        if shopping_list is None:
+            # Replicas still holding a deleted list are sent the deletion
+            with self.catalog_lock:
+                deleted = list_id in self.shopping_manager.get_removed_lists()
+            return [replica for replica, replica_digest, _ in answers if deleted and replica_digest is not None]
+        digest = shopping_list.digest()
+        stale = [replica for replica, replica_digest, _ in answers if replica_digest != digest]
+        # The acknowledged versions of a stale replica cannot be trusted, repair it with the full list
+        with self.replica_versions_lock:
+            for replica in stale:
+                self.replica_versions.pop((replica, list_id), None)
+        return stale
+
+    # Merge the states read from other replicas into the local list (must hold the list's lock)
+    def merge_replica_states(self, list_id, responses):
+        for response in responses:
+            shopping_list = response.get("shopping_list")
+            if shopping_list is None:
+                continue
+            with self.catalog_lock:
+                if list_id in self.shopping_manager.get_removed_lists():
+                    return
                 if list_id not in self.shopping_manager.shopping_lists:
-                    data = None
-                else:
-                    data = self.shopping_manager.shopping_lists[list_id]
+                    self.shopping_manager.create_shopping_list_with_id(list_id)
+            local_list = self.shopping_manager.shopping_lists[list_id]
+            local_list.merge(shopping_list)
+            self.storage.log_merge(list_id, shopping_list, local_list.get_version())
 
-                # Start a new thread to replicate to the replica
-                replication_thread = threading.Thread(target=self.replicate_to_single_node, args=(replica, list_id, data))
-                replication_thread.start()
+    def defer(self, function, *args):
+        """
+        Run the continuation of a replication ack on an ack worker. Done-callbacks of the replication manager's futures
+        run on its I/O thread, which must not wait on list locks or write the hint log: every request in flight would stall.
+        The request workers are not used either, so the replies of requests already in flight do not queue behind new requests.
+        :param function: The continuation.
+        :param args: Its arguments.
+        """
+        self.ack_jobs.put((function, args))
 
-    # Start listening for messages (direct REQ-REP communication)
-    def start(self):
+    def ack_worker(self):
+        """Run the continuations of replication acks until the node stops."""
         while True:
-            # Handle direct REQ-REP requests
-            sockets = dict(self.poller.poll(100))
+            function, args = self.ack_jobs.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"Node {self.node_id}: Error handling a replication ack: {e}")
 
-            if self.rep_socket in sockets:
-                # Handle replication
-                message = self.rep_socket.recv()
-                decompressed_message = self.shopping_manager.decompress_data(message)
-                response = self.handle_message(decompressed_message["operation"], decompressed_message)
-                compressed_response = self.shopping_manager.compress_data(response)
-                self.rep_socket.send(compressed_response)
+    def send_result(self, frames):
+        """
+        Hand a message to the main loop, which owns the sockets and sends it through the one its request came from.
+        May be called from any thread, each one pushes through its own socket (ZeroMQ sockets are not thread-safe).
+        :param frames: [source] + envelope + [encoded response].
+        """
+        socket = getattr(self.result_sockets, "socket", None)
+        if socket is None:
+            socket = self.result_sockets.socket = self.context.socket(zmq.PUSH)
+            socket.connect("inproc://results")
+        socket.send_multipart(frames)
+
+    def worker(self):
+        """Take requests from the job queue until the node stops."""
+        while True:
+            source, envelope, payload = self.jobs.get()
+            # Every request gets an answer, peers are waiting on a REQ socket
+            reply = lambda response, source=source, envelope=envelope: self.send_result([source] + envelope + [response])
+            try:
+                response = self.handle_job(source, decompress_data(payload), reply)
+            except Exception as e:
+                print(f"Node {self.node_id}: Error handling request: {e}")
+                response = compress_data({"status": "error", "error": str(e)})
+            if response is not None:
+                reply(response)
+            self.metrics.incr("requests")
 
-            if self.dealer_socket in sockets:
+    # Start listening for messages from the proxy and from other nodes
+    def start(self):
+        for _ in range(self.worker_count):
+            threading.Thread(target=self.worker, daemon=True).start()
+        for _ in range(ACK_WORKER_COUNT):
+            threading.Thread(target=self.ack_worker, daemon=True).start()
+        threading.Thread(target=self.compaction_loop, daemon=True).start()
+        threading.Thread(target=self.anti_entropy_loop, daemon=True).start()
+        threading.Thread(target=self.snapshot_loop, daemon=True).start()
+        self.storage.start()
+        self.replication_scheduler.start()
+        self.hinted_handoff.start()
+        self.rebalancer.start()
+        self.announce_membership()
 
-                _, client_id, compressed_message = self.dealer_socket.recv_multipart()  # Blocking until a request is received
-                print(f"Node {self.node_id}: Received message from proxy")
-                message = self.shopping_manager.decompress_data(compressed_message)  # Blocking until a request is received
+        while True:
+            sockets = dict(self.poller.poll())
+
+            if self.router_socket in sockets:
+                # Requests from other nodes: [identity, (request_id,) b'', operation, payload]
+                # The envelope (every frame up to the empty one) is sent back with the response
+                frames = self.router_socket.recv_multipart()
+                envelope, (operation, payload) = frames[:-2], frames[-2:]
+                if operation in CONTROL_OPERATIONS:
+                    # Cheap and list-independent, answered right away instead of waiting behind the workers
+                    message = decompress_data(payload)
+                    response = self.handle_message(message["operation"], message)
+                    self.router_socket.send_multipart(envelope + [compress_data(response)])
+                elif operation == b"ping_req":
+                    self.gossip_socket.send_multipart(envelope + [payload])
+                else:
+                    self.jobs.put((b'peer', envelope, payload))
 
-                decompressed_response = self.handle_message(message["operation"], message)
-                response = self.shopping_manager.compress_data(decompressed_response)
-                self.dealer_socket.send_multipart([b'proxy_identity', client_id, b'', response])
+            if self.dealer_socket in sockets:
+                _, client_id, payload = self.dealer_socket.recv_multipart()
+                print(f"Node {self.node_id}: Received message from proxy")
+                self.jobs.put((b'proxy', [b'proxy_identity', client_id, b''], payload))
 
-                if(message['operation'] == 'write' or message['operation'] == 'delete'):
-                    self.replicate_to_nodes(message)
+            if self.results_socket in sockets:
+                # Send each response through the socket its request came from
+                source, *frames = self.results_socket.recv_multipart()
+                socket = self.dealer_socket if source == b'proxy' else self.router_socket
+                socket.send_multipart(frames)
 
     # Update hash ring based on gossip state of node
-    def update_hash_ring(self, node_id, state):
+    def update_hash_ring(self, node_id, state, address=None, weight=1):
         if state == "dead":
-            self.hash_ring.remove_node(node_id)
+            self.remove_node(node_id)
         elif state == "alive":
-            self.hash_ring.add_node(node_id)
-
-    def merge_hash_ring(self, remote_ring):
-        for hash_key, node_id in remote_ring.items():
-            if hash_key not in self.hash_ring.ring:
-                self.hash_ring.ring[hash_key] = node_id
-                if node_id not in self.hash_ring.nodes:
-                    self.hash_ring.nodes[node_id] = f"tcp://127.0.0.1:{5000 + int(node_id[-1])}"
\ No newline at end of file
+            self.add_node(node_id, address, weight)
+
+    def on_ring_change(self, event):
+        """
+        Ring change subscriber: reach the new nodes, replay their hints, and tell the proxy.
+        :param event: The ring change, see MembershipService.subscribe.
+        """
+        for node_id in event["added"]:
+            address = event["ring"].get_address(node_id)
+            if address and node_id not in self.replication_manager.nodes_config:
+                self.replication_manager.nodes_config[node_id] = address
+            self.hinted_handoff.request_replay(node_id)
+        self.announce_membership()
+
+    def announce_membership(self):
+        """
+        Send the gossip membership to the proxy, which keeps its own view of the ring from it.
+        May be called from any thread: the message goes through the main loop, like the workers' responses.
+        """
+        with self.gossip_protocol.lock:
+            members = {node_id: dict(entry) for node_id, entry in self.gossip_protocol.members.items()}
+        # An empty client id tells the proxy this is not a response
+        self.send_result([b'proxy', b'proxy_identity', b'', b'', compress_data({"operation": "membership", "members": members})])
@@ -0,0 +1,147 @@
+import threading, time
+
+# Seconds to wait after a membership change for the next ones (gossip usually brings several)
+REBALANCE_DELAY = 1.0
+# Lists sent to a node in each replicate_batch message
+REBALANCE_BATCH_SIZE = 32
+# Lists streamed per second at most, so rebalancing does not starve client requests
+REBALANCE_RATE = 500
+
+class Rebalancer:
+    def __init__(self, node, rate=REBALANCE_RATE):
+        """
+        Moves lists to their new replicas when the ring's membership changes.
+        The ring is compared with the one of the last completed rebalance: every list whose replicas
+        changed is streamed to the replicas that gained it, by the first of its previous replicas
+        still in the ring, so each list is sent once however many nodes hold it.
+        :param node: The node whose lists are rebalanced.
+        :param rate: Lists streamed per second at most.
+        """
+        self.node = node
+        self.rate = rate
+        # Ring snapshot the node's lists were last placed on. At startup the node's ring only holds itself,
+        # the lists are placed on the configured cluster, which gossip converges to
+        self.ring = self.configured_ring()
+        self.wakeup = threading.Event()
+        self.shutdown_flag = False
+        node.membership.subscribe(lambda event: self.schedule())
+
+    def configured_ring(self):
+        """The node's ring with every node of the cluster configuration added, with its address and weight."""
+        ring = self.node.membership.ring.copy()
+        for node_id, node_config in self.node.known_nodes.items():
+            if node_id not in ring.nodes:
+                ring.add_node(node_id, node_config.get("address"), node_config.get("weight", 1))
+        return ring
+
+    def schedule(self):
+        """Rebalance once the ring settles."""
+        self.wakeup.set()
+
+    def run(self):
+        """Rebalance after every burst of membership changes."""
+        while not self.shutdown_flag:
+            self.wakeup.wait()
+            time.sleep(REBALANCE_DELAY)
+            self.wakeup.clear()
+            try:
+                self.rebalance()
+            except Exception as e:
+                print(f"Node {self.node.node_id}: Rebalancing failed: {e}")
+
+    def find_moves(self, old_ring, new_ring):
+        """
+        Find the lists this node must stream after a membership change.
+        :param old_ring: The ring the lists were placed on.
+        :param new_ring: The current ring.
+        :return: The lists to send to each node that gained them: {target: [list_id]}, and the number of ranges that moved.
+        """
+        replication_factor = self.node.replication_manager.replication_factor
+        moves = {}
+        ranges = set()
+        for list_id in list(self.node.shopping_manager.shopping_lists):
+            old_replicas = old_ring.get_preference_list(list_id, replication_factor)
+            new_replicas = new_ring.get_preference_list(list_id, replication_factor)
+            if old_replicas == new_replicas:
+                continue
+            # Only the first previous replica still in the ring streams the list
+            senders = [replica for replica in old_replicas if replica in new_ring.nodes]
+            if (senders[0] if senders else new_replicas[0]) != self.node.node_id:
+                continue
+            targets = [replica for replica in new_replicas if replica not in old_replicas and replica != self.node.node_id]
+            for target in targets:
+                moves.setdefault(target, []).append(list_id)
+            if targets:
+                ranges.add(new_ring.get_range(list_id))
+        return moves, len(ranges)
+
+    def rebalance(self):
+        """Stream the lists whose replicas changed since the last rebalance, throttled to `rate` lists per second."""
+        ring = self.node.membership.ring
+        moves, ranges = self.find_moves(self.ring, ring)
+        pending = sum(len(list_ids) for list_ids in moves.values())
+        self.node.metrics.incr("rebalance_runs")
+        self.node.metrics.set("rebalance_lists_pending", pending)
+        if not pending:
+            self.ring = ring
+            return
+        print(f"Node {self.node.node_id}: Rebalancing {pending} lists of {ranges} ranges to {sorted(moves)}")
+
+        start = time.time()
+        streamed = 0
+        for target, list_ids in moves.items():
+            for offset in range(0, len(list_ids), REBALANCE_BATCH_SIZE):
+                if self.node.membership.ring is not ring:
+                    # The ring changed again, start over from the ring the lists are still placed on
+                    print(f"Node {self.node.node_id}: Ring changed while rebalancing, restarting")
+                    self.wakeup.set()
+                    return
+                batch = list_ids[offset:offset + REBALANCE_BATCH_SIZE]
+                batch_start = time.time()
+                streamed += self.stream(target, batch)
+                pending -= len(batch)
+                self.node.metrics.set("rebalance_lists_pending", pending)
+                # Throttle: each batch takes at least its share of the rate
+                time.sleep(max(0, len(batch) / self.rate - (time.time() - batch_start)))
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.node.metrics.set("rebalance_rate", round(streamed / elapsed))
+        print(f"Node {self.node.node_id}: Rebalanced {streamed} lists in {elapsed:.2f}s")
+        self.ring = ring
+
+    def stream(self, target, list_ids):
+        """
+        Send some lists to a node in one batch and wait for its answer.
+        Lists the node failed to take are left to hinted handoff.
+        :return: Number of lists the node acknowledged.
+        """
+        batch = []
+        for list_id in list_ids:
+            with self.node.get_list_lock(list_id):
+                for _, version, payload in self.node.build_replication_requests(list_id, [target]):
+                    batch.append((list_id, version, payload))
+        if not batch:
+            return 0
+
+        response = self.node.replication_manager.send(target, {
+            "operation": "replicate_batch",
+            "requests": [payload for _, _, payload in batch]
+        }).result()
+        acks = response.get("acks") or [{"status": "error"}] * len(batch)
+        acknowledged = 0
+        for (list_id, version, payload), ack in zip(batch, acks):
+            self.node.handle_replication_ack(target, list_id, version, ack)
+            if ack["status"] != "error":
+                acknowledged += 1
+                self.node.metrics.incr("rebalance_bytes_streamed", len(payload))
+        self.node.metrics.incr("rebalance_lists_streamed", acknowledged)
+        return acknowledged
+
+    def start(self):
+        """Start rebalancing in a separate thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        """Stop the rebalancing thread."""
+        self.shutdown_flag = True
+        self.wakeup.set()
@@ -1,123 +1,190 @@
-import zmq, orjson, jsonpickle, zlib
+import zmq, threading, time, os, itertools
+from collections import deque
+from concurrent.futures import Future
+from communication.codec import compress_data, decompress_data
+
+# Seconds to wait for a node to answer a request
+REQUEST_TIMEOUT = 2.0
+# Requests sent to a node and not answered yet, the rest wait in line
+MAX_IN_FLIGHT = 32
+# Seconds during which requests to a failed node fail right away (doubled on every failure)
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 10.0
 
 class ReplicationManager:
-    def __init__(self, hash_ring, replication_factor=3, nodes_config=None):
+    def __init__(self, membership, replication_factor=3, nodes_config=None):
         """
         Handles replication of data across nodes.
-        :param hash_ring: Instance of ConsistentHash.
+        Every node is reached through one long-lived DEALER socket, owned by an I/O thread.
+        :param membership: The MembershipService holding the node's hash ring.
         :param replication_factor: Number of replicas for each key.
         :param nodes_config: Configuration of nodes with their node_id and addresses.
         """
         self.context = zmq.Context()
-        self.hash_ring = hash_ring
+        self.membership = membership
         self.replication_factor = replication_factor
         self.nodes_config = nodes_config
 
-    def get_replicas(self, key):
+        # Requests handed to the I/O thread: (node_id, operation, payload, future)
+        self.outbox = deque()
+        self.outbox_lock = threading.Lock()
+        # Pipe waking the I/O thread up when the outbox gets requests, holds at most one byte
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.wakeup_pending = False
+
+        # State below is only touched by the I/O thread
+        self.poller = zmq.Poller()
+        self.poller.register(self.wakeup_read, zmq.POLLIN)
+        self.sockets = {}    # {node_id: DEALER socket}
+        self.pending = {}    # Requests waiting for room in the window: {node_id: deque of (operation, payload, future)}
+        self.in_flight = {}  # {node_id: {request_id: (future, deadline)}}
+        self.backoff = {}    # {node_id: (retry_at, backoff)}
+        self.request_ids = itertools.count(1)
+
+        self.shutdown_flag = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def get_replicas(self, key, count=None):
         """
         Get the replica nodes for a given key.
         :param key: The key to locate in the hash ring.
+        :param count: Number of nodes to return, the replication factor by default.
+            Nodes past the replication factor stand in for failed replicas (sloppy quorum).
         :return: List of nodes responsible for the key.
         """
-        primary_node = self.hash_ring.get_node(key)
-        all_nodes = self.hash_ring.get_nodes()
-        start_index = all_nodes.index(primary_node)
-        
-        # Get the replica nodes
-        return [all_nodes[(start_index + i) % len(all_nodes)] for i in range(self.replication_factor)]
-
-    def replicate_to_node(self, node_id, list_id, list):
-        """
-        Send a write request to a node.
-        :param node_id: The node ID to replicate data to.
-        :param list_id: The list_id to replicate.
-        :param value: The list state to replicate.
-        :return: True if the replication was successful, False otherwise.
-        """
-        try:
-            # Get the node socket using the node_id
-            address = self.nodes_config[node_id]
-            if not address:
-                print(f"Node address for {node_id} not found.")
-                return False
-            
-            socket = self.context.socket(zmq.REQ)
-            socket.connect(address)
-
-            # Print the node address and key before trying to connect
-            print(f"Attempting to replicate to node {node_id} for key={list_id}")
-
-            message = {
-                "operation": "replicate",
-                "list_id": list_id,
-                "shopping_list": list
-            }
-        
-            # Compress the data before sending
-            compressed_message = self.compress_data(message)
-
-            # Send the write request
-            socket.send(compressed_message)
-
-            print(f"Sent write request to node {node_id} for key={list_id}")
-
-            # Receive acknowledgment
-            ack = socket.recv()
-
-            # Decompress the response
-            ack = self.decompress_data(ack)
-            print(f"Replication to node {node_id} completed with response: {ack}")
+        return self.membership.ring.get_preference_list(key, count or self.replication_factor)
 
-            socket.close()
-        
-            return ack['status'] == 'success'
-
-        except zmq.ZMQError as e:
-            print(f"ZeroMQ error occurred while replicating to {node_id}: {e}")
-            return False
-        except Exception as e:
-            print(f"Failed to replicate to {node_id}: {e}")
-            return False
-        
-    def compress_data(self, data):
+    def send(self, node_id, message):
         """
-        Compress JSON data to be sent over ZMQ.
-        :param data: The data (dict) to compress.
-        :return: Compressed byte data
+        Send a request to a node without waiting for its answer.
+        The message is encoded right away, so the caller may keep changing the objects in it.
+        :param node_id: The node to send the request to.
+        :param message: The request, with its 'operation'.
+        :return: Future of the node's response; {"status": "error"} if the node failed or timed out.
         """
-        # Convert all dictionary keys to strings to avoid JSON serialization error
-        if 'hash_ring' in data:
-            # Convert keys in the 'hash_ring' dictionary to strings
-            data['hash_ring'] = {str(key): value for key, value in data['hash_ring'].items()}
-
-        if 'shopping_list' in data:
-            # Use jsonpickle to serialize the custom object
-            data['shopping_list'] = jsonpickle.dumps(data['shopping_list'])
-        
-        byte_data = orjson.dumps(data) # Convert the entire dictionary to JSON string
-    
-        # Compress the string into bytes
-        compressed_data = zlib.compress(byte_data)  # Ensure it's in byte form
-        return compressed_data      
-
-    def decompress_data(self, compressed_data):
+        return self.send_payload(node_id, message["operation"], compress_data(message))
+
+    def send_payload(self, node_id, operation, payload):
         """
-        Decompress the data and convert it back to the original format.
-        :param compressed_data: The compressed data received.
-        :return: Decompressed and converted data
+        Send an already encoded request to a node without waiting for its answer.
+        :param node_id: The node to send the request to.
+        :param operation: The operation of the request.
+        :param payload: The encoded request.
+        :return: Future of the node's response; {"status": "error"} if the node failed or timed out.
         """
-        # Decompress the data first
-        json_data = zlib.decompress(compressed_data)  # Decode from bytes to string
-
-        # Load the JSON string into a Python dictionary
-        data = orjson.loads(json_data)
-
-        # Convert keys of the 'hash_ring' back to integers
-        if 'hash_ring' in data:
-            data['hash_ring'] = {int(key): value for key, value in data['hash_ring'].items()}
-
-        # Decompress list object
-        if 'shopping_list' in data:
-            data['shopping_list'] = jsonpickle.loads(data['shopping_list'])
+        future = Future()
+        with self.outbox_lock:
+            self.outbox.append((node_id, operation.encode(), payload, future))
+            wakeup = not self.wakeup_pending
+            self.wakeup_pending = True
+        if wakeup:
+            os.write(self.wakeup_write, b'\0')
+        return future
+
+    def stop(self):
+        """Stop the I/O thread."""
+        self.shutdown_flag = True
+        os.write(self.wakeup_write, b'\0')
+
+    # I/O thread: sends queued requests, matches responses to their requests and expires the late ones
+    def run(self):
+        while not self.shutdown_flag:
+            sockets = dict(self.poller.poll(self.poll_timeout()))
+
+            if self.wakeup_read in sockets:
+                os.read(self.wakeup_read, 1)
+                with self.outbox_lock:
+                    requests = list(self.outbox)
+                    self.outbox.clear()
+                    self.wakeup_pending = False
+                for node_id, operation, payload, future in requests:
+                    self.pending.setdefault(node_id, deque()).append((operation, payload, future))
+                for node_id in {request[0] for request in requests}:
+                    self.dispatch(node_id)
+
+            for node_id, socket in list(self.sockets.items()):
+                if socket in sockets:
+                    self.receive(node_id, socket)
+
+            self.expire_requests()
+
+        for node_id in list(self.sockets):
+            self.fail_node(node_id, "Replication manager stopped")
+
+    # Milliseconds until the next request deadline
+    def poll_timeout(self):
+        deadlines = [deadline for requests in self.in_flight.values() for _, deadline in requests.values()]
+        if not deadlines:
+            return None
+        return max(0, int((min(deadlines) - time.time()) * 1000) + 1)
+
+    # Get the socket connected to a node, creating it on first use
+    def get_socket(self, node_id):
+        socket = self.sockets.get(node_id)
+        if socket is None:
+            socket = self.context.socket(zmq.DEALER)
+            # Requests to a node that never answers are dropped with the socket when it times out
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.nodes_config[node_id])
+            self.poller.register(socket, zmq.POLLIN)
+            self.sockets[node_id] = socket
+        return socket
+
+    # Send the waiting requests of a node while its window has room
+    def dispatch(self, node_id):
+        pending = self.pending.get(node_id)
+        in_flight = self.in_flight.setdefault(node_id, {})
+        while pending and len(in_flight) < MAX_IN_FLIGHT:
+            operation, payload, future = pending.popleft()
+
+            retry_at, _ = self.backoff.get(node_id, (0, 0))
+            if time.time() < retry_at or not self.nodes_config.get(node_id):
+                future.set_result({"status": "error"})
+                continue
+
+            request_id = next(self.request_ids).to_bytes(8, 'big')
+            try:
+                self.get_socket(node_id).send_multipart([request_id, b'', operation, payload], zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                future.set_result({"status": "error"})
+                self.fail_node(node_id, e)
+                return
+            in_flight[request_id] = (future, time.time() + REQUEST_TIMEOUT)
+
+    # Read every available response of a node: [request_id, b'', payload]
+    def receive(self, node_id, socket):
+        while True:
+            try:
+                request_id, _, payload = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            # Responses to requests that already timed out are dropped
+            entry = self.in_flight.get(node_id, {}).pop(request_id, None)
+            if entry is not None:
+                self.backoff.pop(node_id, None)
+                entry[0].set_result(decompress_data(payload))
+        self.dispatch(node_id)
+
+    # Fail the nodes with a request past its deadline
+    def expire_requests(self):
+        now = time.time()
+        for node_id, requests in list(self.in_flight.items()):
+            if any(deadline <= now for _, deadline in requests.values()):
+                self.fail_node(node_id, "Request timed out")
+
+    # Fail every request to a node, reset its connection and back off before trying it again
+    def fail_node(self, node_id, reason):
+        print(f"Replication to node {node_id} failed: {reason}")
+        requests = [future for future, _ in self.in_flight.pop(node_id, {}).values()]
+        requests += [future for _, _, future in self.pending.pop(node_id, ())]
+        for future in requests:
+            future.set_result({"status": "error"})
+
+        socket = self.sockets.pop(node_id, None)
+        if socket is not None:
+            self.poller.unregister(socket)
+            socket.close()
 
-        return data
\ No newline at end of file
+        _, backoff = self.backoff.get(node_id, (0, 0))
+        backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, backoff * 2))
+        self.backoff[node_id] = (time.time() + backoff, backoff)
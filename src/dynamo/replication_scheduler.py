@@ -0,0 +1,118 @@
+import threading, time
+
+# Seconds during which updates to the same list are coalesced before being replicated
+REPLICATION_WINDOW = 0.05
+# Lists sent to a replica in a single replicate_batch message
+MAX_BATCH_SIZE = 64
+
+class ReplicationScheduler:
+    def __init__(self, node, window=REPLICATION_WINDOW):
+        """
+        Replicates the lists changed on a node, coalescing the updates to each list over a short window
+        and sending the lists due to the same replica in batches.
+        Also repairs the replicas that answered a read with a stale state (read repair).
+        :param node: The node whose lists are replicated.
+        :param window: Seconds to wait for more updates before replicating.
+        """
+        self.node = node
+        self.window = window
+        # Lists changed since the last flush, in the order they were first changed: {list_id: None}
+        self.dirty = {}
+        # Replica answers to reads, checked at the next flush: {list_id: [(replica, digest, shopping_list)]}
+        self.repairs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.shutdown_flag = False
+
+    def schedule(self, list_id):
+        """
+        Replicate a list at the end of the current window.
+        :param list_id: The list that changed (or was deleted).
+        """
+        with self.lock:
+            if list_id in self.dirty:
+                # Shipped together with the update already waiting
+                self.node.metrics.incr("replication_updates_coalesced")
+            else:
+                self.dirty[list_id] = None
+        self.node.metrics.incr("replication_updates")
+        self.wakeup.set()
+
+    def schedule_repair(self, list_id, replica, digest, shopping_list=None):
+        """
+        Check a replica's answer to a read at the end of the current window, and repair the replica if it is stale.
+        :param list_id: The list that was read.
+        :param replica: The replica that answered.
+        :param digest: Digest of the replica's state (None if it does not have the list).
+        :param shopping_list: The replica's state, if the coordinator did not merge it yet.
+        """
+        with self.lock:
+            self.repairs.setdefault(list_id, []).append((replica, digest, shopping_list))
+        self.wakeup.set()
+
+    def run(self):
+        """Flush the changed lists once per window, while there are any."""
+        while not self.shutdown_flag:
+            self.wakeup.wait()
+            # Let the rest of the burst arrive
+            time.sleep(self.window)
+            with self.lock:
+                list_ids = list(self.dirty)
+                repairs = self.repairs
+                self.dirty.clear()
+                self.repairs = {}
+                self.wakeup.clear()
+            self.flush(list_ids, repairs)
+
+    def flush(self, list_ids, repairs=None):
+        """
+        Send the changed lists to their replicas, one message per replica and batch.
+        :param list_ids: The lists to replicate.
+        :param repairs: Replica answers to reads to check: {list_id: [(replica, digest, shopping_list)]}.
+        """
+        # Requests due to each replica: {replica: [(list_id, version, payload)]}
+        batches = {}
+        for list_id in list_ids:
+            with self.node.get_list_lock(list_id):
+                for replica, version, payload in self.node.build_replication_requests(list_id):
+                    batches.setdefault(replica, []).append((list_id, version, payload))
+
+        for list_id, answers in (repairs or {}).items():
+            with self.node.get_list_lock(list_id):
+                stale = self.node.find_stale_replicas(list_id, answers)
+                if stale:
+                    self.node.metrics.incr("read_repairs", len(stale))
+                    for replica, version, payload in self.node.build_replication_requests(list_id, stale):
+                        batches.setdefault(replica, []).append((list_id, version, payload))
+
+        for replica, requests in batches.items():
+            for start in range(0, len(requests), MAX_BATCH_SIZE):
+                batch = requests[start:start + MAX_BATCH_SIZE]
+                future = self.node.replication_manager.send(replica, {
+                    "operation": "replicate_batch",
+                    "requests": [payload for _, _, payload in batch]
+                })
+                # Handled on the node's ack workers, not on the replication manager's I/O thread
+                future.add_done_callback(lambda future, replica=replica, batch=batch: self.node.defer(self.handle_batch_ack, replica, batch, future.result()))
+                self.node.metrics.incr("replication_batches_sent")
+                self.node.metrics.incr("replication_updates_sent", len(batch))
+
+    def handle_batch_ack(self, replica, batch, response):
+        """
+        Record the answer of a replica to each list of a batch.
+        :param replica: The replica the batch was sent to.
+        :param batch: The (list_id, version, payload) requests of the batch.
+        :param response: The replica's response, with one ack per request.
+        """
+        acks = response.get("acks") or [{"status": "error"}] * len(batch)
+        for (list_id, version, _), ack in zip(batch, acks):
+            self.node.handle_replication_ack(replica, list_id, version, ack)
+
+    def start(self):
+        """Start flushing in a separate thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        """Stop the flushing thread."""
+        self.shutdown_flag = True
+        self.wakeup.set()
@@ -149,7 +149,7 @@ def main():
                             break
                         
                         # Overload merged list with local list
-                        manager.shopping_lists[list_id] = shopping_list
+                        manager.set_shopping_list(list_id, shopping_list)
                         manager.save_to_json()
                 case '2':
                     while True:  # Infinite loop for retrying until Esc is pressed or valid input
@@ -177,7 +177,7 @@ def main():
                                 break
 
                             # Overload merged list with local list
-                            manager.shopping_lists[list_id] = shopping_list
+                            manager.set_shopping_list(list_id, shopping_list)
                             manager.save_to_json()
                             
                         else:
@@ -230,7 +230,7 @@ def main():
                                                 break
 
                                             # Overload merged list with local list
-                                            manager.shopping_lists[list_id] = shopping_list
+                                            manager.set_shopping_list(list_id, shopping_list)
                                             manager.save_to_json()
                                             break  # Exit the loop after successful operation
                                         except ValueError:
@@ -256,7 +256,7 @@ def main():
                                                 break
 
                                             # Overload merged list with local list
-                                            manager.shopping_lists[list_id] = shopping_list
+                                            manager.set_shopping_list(list_id, shopping_list)
                                             manager.save_to_json()
                                             break  # Exit the loop after successful operation
                                         except ValueError:
@@ -298,7 +298,7 @@ def main():
                                 break
 
                             # Overload merged list with local list
-                            manager.shopping_lists[list_id] = shopping_list
+                            manager.set_shopping_list(list_id, shopping_list)
                             manager.save_to_json()
                         
                         else:
@@ -315,7 +315,7 @@ def main():
                         manager.get_shopping_list(list_id).display_list()
                     else:
                         # Overload merged list with local list
-                        manager.shopping_lists[list_id] = shopping_list
+                        manager.set_shopping_list(list_id, shopping_list)
                         manager.save_to_json()
                         shopping_list.display_list()
                 case '6':
@@ -0,0 +1,56 @@
+import argparse
+from dynamo.cluster_config import DEFAULT_CONFIG_PATH, load_cluster_config, get_node_config
+from dynamo.consistent_hash import ConsistentHash, VIRTUAL_NODES
+from dynamo.replication_manager import ReplicationManager
+from dynamo.membership import MembershipService
+from dynamo.replication_scheduler import REPLICATION_WINDOW
+from dynamo.node import Node, READ_QUORUM, WRITE_QUORUM, ANTI_ENTROPY_INTERVAL
+from dynamo.rebalancer import REBALANCE_RATE
+from dynamo.gossipProtocol import PROTOCOL_PERIOD
+from storage.storage_engine import FSYNC_POLICY, SNAPSHOT_INTERVAL
+from crdt.causal_context import set_local_replica_id
+
+def start_node(node_id, config_path=DEFAULT_CONFIG_PATH):
+    """
+    Start a Node in the current process.
+    The node's hash ring starts with the node itself, the other nodes are learned through gossip.
+    :param node_id: Unique identifier for the node, as listed in the cluster configuration.
+    :param config_path: Path to the cluster configuration.
+    """
+    config = load_cluster_config(config_path)
+    node_config = get_node_config(config, node_id)
+    # Dots of the operations of this process are the node's, whatever the restarts
+    set_local_replica_id(node_id)
+
+    hash_ring = ConsistentHash(replicas=config.get("virtual_nodes", VIRTUAL_NODES))
+    hash_ring.add_node(node_id, node_config["address"], node_config.get("weight", 1))
+
+    membership = MembershipService(hash_ring)
+
+    nodes_dict = {node["node_id"]: node["address"] for node in config["nodes"]}
+    replication_manager = ReplicationManager(membership, replication_factor=config["replication_factor"], nodes_config=nodes_dict)
+
+    node = Node(node_id=node_id, port=node_config["port"], membership=membership,
+                replication_manager=replication_manager, known_nodes=config["nodes"],
+                proxy_address=config["proxy"]["backend_address"],
+                replication_window=config.get("replication_window", REPLICATION_WINDOW),
+                read_quorum=config.get("read_quorum", READ_QUORUM),
+                write_quorum=config.get("write_quorum", WRITE_QUORUM),
+                anti_entropy_interval=config.get("anti_entropy_interval", ANTI_ENTROPY_INTERVAL),
+                data_dir=node_config.get("data_dir"),
+                rebalance_rate=config.get("rebalance_rate", REBALANCE_RATE),
+                protocol_period=config.get("protocol_period", PROTOCOL_PERIOD),
+                fsync_policy=config.get("fsync_policy", FSYNC_POLICY),
+                snapshot_interval=config.get("snapshot_interval", SNAPSHOT_INTERVAL))
+    node.start()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a single storage node")
+    parser.add_argument("node_id", help="ID of the node in the cluster configuration")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="Path to the cluster configuration")
+    args = parser.parse_args()
+
+    try:
+        start_node(args.node_id, args.config)
+    except KeyboardInterrupt:
+        print(f"\nShutting down {args.node_id}...")
@@ -1,122 +1,136 @@
-import zmq, time, sys
-from threading import Thread
-from dynamo.consistent_hash import ConsistentHash
-from dynamo.replication_manager import ReplicationManager
-from dynamo.node import Node
-from storage.shopping_list_manager import ShoppingListManager
-
-def start_node(node_id, port, hash_ring, replication_manager, known_nodes):
+import zmq, zmq.asyncio, asyncio, time, argparse
+from multiprocessing import Process
+from dynamo.consistent_hash import ConsistentHash, VIRTUAL_NODES
+from dynamo.membership import MembershipService
+from dynamo.gossipProtocol import entry_version
+from dynamo.cluster_config import DEFAULT_CONFIG_PATH, load_cluster_config
+from communication.codec import compress_data, decompress_data
+from run_node import start_node
+
+async def forward_requests(frontend, backend, membership):
     """
-    Start a Node instance as a separate process.
-    :param node_id: Unique identifier for the node.
-    :param port: The port the node will bind to.
-    :param hash_ring: The consistent hash ring instance.
-    :param replication_manager: The replication manager instance.
+    Forward every client request to the node responsible for its list.
+    Requests are routed by their plaintext routing frame (the list_id), the payload is never decoded.
     """
-    node = Node(node_id=node_id, port=port, hash_ring=hash_ring,
-                replication_manager=replication_manager, known_nodes=known_nodes)
-    node.start()
+    while True:
+        client_id, _, routing_key, payload = await frontend.recv_multipart()
+
+        # An empty routing key is a ping
+        if not routing_key:
+            await frontend.send_multipart([client_id, b'', b"pong"])
+            continue
+
+        # Use the current ring snapshot to find the appropriate node for the request
+        ring = membership.ring
+        if not ring.sorted_keys:
+            await frontend.send_multipart([client_id, b'', compress_data({"error": "No node is available"})])
+            continue
+        responsible_node = ring.get_node(routing_key.decode())
+        try:
+            await backend.send_multipart([responsible_node.encode(), b'', client_id, payload])
+        except zmq.ZMQError as e:
+            # The node is not connected (ROUTER_MANDATORY), answer the client instead of dropping the request
+            print(f"Proxy could not reach node {responsible_node}: {e}")
+            error = compress_data({"error": f"Node {responsible_node} is unreachable"})
+            await frontend.send_multipart([client_id, b'', error])
+
+async def forward_responses(frontend, backend, membership, members):
+    """Send every node response back to the client that made the request, and apply the nodes' membership announcements."""
+    while True:
+        _, _, client_id, _, response = await backend.recv_multipart()
+        if not client_id:
+            # Not a response: a node announcing its view of the membership
+            merge_membership(membership, members, decompress_data(response)["members"])
+            continue
+        await frontend.send_multipart([client_id, b'', response])
+
+def merge_membership(membership, members, update):
+    """
+    Apply the newer entries of a node's gossip membership to the proxy's view, so requests stop going to dead nodes.
+    Entries are merged by version like gossip does, so announcements may arrive in any order.
+    :param membership: The proxy's MembershipService.
+    :param members: The proxy's membership entries: {node_id: {incarnation, state, address, weight}}.
+    :param update: The membership announced by a node.
+    """
+    for node_id, entry in update.items():
+        current = members.get(node_id)
+        if current is not None and entry_version(entry) <= entry_version(current):
+            continue
+        members[node_id] = entry
+        if entry["state"] == "dead":
+            membership.remove_node(node_id)
+        else:
+            membership.add_node(node_id, entry.get("address"), entry.get("weight", 1))
+
+async def run_proxy(membership, members, frontend_address="tcp://*:5558", backend_address="tcp://*:5559"):
+    """
+    Run the ROUTER-ROUTER proxy between clients and nodes.
+    Both directions run as coroutines, so every ready message is handled as soon as it arrives.
+    :param membership: The MembershipService of the proxy's ring, used to route requests.
+    :param members: The membership entries the proxy's ring was built from.
+    :param frontend_address: Address clients connect to.
+    :param backend_address: Address nodes connect to.
+    """
+    context = zmq.asyncio.Context()
 
-def start_proxy(context):
-    # Create a REQ socket for the server-side (clients request here)
     frontend = context.socket(zmq.ROUTER)  # This is for client requests
-    frontend.bind("tcp://*:5558")
+    frontend.bind(frontend_address)
 
     backend = context.socket(zmq.ROUTER)  # This is for server requests
     backend.setsockopt(zmq.IDENTITY, b"proxy_identity")
     backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
-    backend.bind("tcp://*:5559")
+    backend.bind(backend_address)
 
     print("Proxy started with ROUTER-DEALER pattern")
 
-    poller = zmq.Poller()
-
-    poller.register(frontend, zmq.POLLIN)
-    poller.register(backend, zmq.POLLIN)
-
-    return frontend, backend, poller
-
-def run_server():
-    # Initialize the Hash Ring
-    hash_ring = ConsistentHash()
-
-    # Initialize the Shopping List Manager for compression and decompression
-    manager = ShoppingListManager()
-
-    # Define nodes with their IDs and ports
-    nodes_config = [
-        {"node_id": "node1", "port": 5001, "address": "tcp://localhost:5001"},
-        {"node_id": "node2", "port": 5002, "address": "tcp://localhost:5002"},
-        {"node_id": "node3", "port": 5003, "address": "tcp://localhost:5003"},
-        {"node_id": "node4", "port": 5004, "address": "tcp://localhost:5004"},
-        {"node_id": "node5", "port": 5005, "address": "tcp://localhost:5005"}
-    ]
-
-    context = zmq.Context()
-
-    # Add nodes to the hash ring
-    for config in nodes_config:
-        hash_ring.add_node(config["node_id"])
-
-    nodes_dict = {node["node_id"]: node["address"] for node in nodes_config}
-    # Initialize ReplicationManager
-    replication_manager = ReplicationManager(hash_ring, replication_factor=3, nodes_config=nodes_dict)
+    try:
+        await asyncio.gather(forward_requests(frontend, backend, membership), forward_responses(frontend, backend, membership, members))
+    finally:
+        frontend.close()
+        backend.close()
+        context.term()
 
-    # Start Node Threads
-    threads = []
-    for config in nodes_config:
-        thread = Thread(target=start_node, args=(config["node_id"], config["port"], hash_ring, replication_manager, nodes_config))
-        thread.start()
-        threads.append(thread)
-        print(f"Started {config['node_id']} on port {config['port']}")
-        time.sleep(1)
+def run_server(config_path=DEFAULT_CONFIG_PATH, proxy_only=False):
+    """
+    Run the proxy and, unless proxy_only is set, one process per configured node.
+    :param config_path: Path to the cluster configuration.
+    :param proxy_only: Whether the nodes are started separately (with run_node.py).
+    """
+    config = load_cluster_config(config_path)
+
+    # The proxy keeps its own view of the ring: the configured nodes, then the membership the nodes announce
+    hash_ring = ConsistentHash(replicas=config.get("virtual_nodes", VIRTUAL_NODES))
+    members = {}
+    for node_config in config["nodes"]:
+        hash_ring.add_node(node_config["node_id"], node_config["address"], node_config.get("weight", 1))
+        members[node_config["node_id"]] = {"incarnation": 0, "state": "alive", "address": node_config["address"], "weight": node_config.get("weight", 1)}
+    membership = MembershipService(hash_ring)
+    membership.subscribe(lambda event: print(f"Proxy ring version {event['version']}: added {event['added']}, removed {event['removed']}"))
+
+    # Start every node in its own process
+    processes = []
+    for node_config in ([] if proxy_only else config["nodes"]):
+        process = Process(target=start_node, args=(node_config["node_id"], config_path), daemon=True)
+        process.start()
+        processes.append(process)
+        print(f"Started {node_config['node_id']} on port {node_config['port']} (pid {process.pid})")
 
     print("Await all nodes to start...")
     time.sleep(1)
 
     # Start Proxy
-    frontend, backend, poller = start_proxy(context)
-
     try:
-        # Handle requests from clients
-        while True:
-            sockets = dict(poller.poll(100))
-
-            if frontend in sockets and sockets[frontend] == zmq.POLLIN:
-                # Receive client request
-                client_id, _, compressed_message = frontend.recv_multipart()
-                message = manager.decompress_data(compressed_message)
-                print(f"Proxy received: {message}")
-
-                if(message["operation"] == "ping"):
-                    # Respond to the ping request
-                    frontend.send_multipart([client_id, b'', b"pong"])
-                    continue
-
-                # Use the hash ring to find the appropriate node for the request
-                key = message["list_id"]
-
-                responsible_node = hash_ring.get_node(key)
-
-                print(f"Proxy forwarding request to node {responsible_node} for key={key}")
-
-                backend.send_multipart([responsible_node.encode(), b'', client_id, compressed_message])
-
-            if backend in sockets and sockets[backend] == zmq.POLLIN:
-                # Wait for the response from the node and send it back to the client
-                _, _, client_id, _, response = backend.recv_multipart()
-                frontend.send_multipart([client_id, b'', response])
-
-            time.sleep(0.1) # Sleep for a while to prevent high CPU usage
-
+        asyncio.run(run_proxy(membership, members, config["proxy"]["frontend"], config["proxy"]["backend"]))
     except KeyboardInterrupt:
         print("\nShutting down all nodes...")
-        for thread in threads:
-            thread.join()
-
-        frontend.close()
-        backend.close()
-        context.term()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 if __name__ == "__main__":
-    run_server()
+    parser = argparse.ArgumentParser(description="Run the proxy and the storage nodes")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="Path to the cluster configuration")
+    parser.add_argument("--proxy-only", action="store_true", help="Only run the proxy, the nodes are started with run_node.py")
+    args = parser.parse_args()
+    run_server(args.config, args.proxy_only)
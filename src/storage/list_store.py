@@ -0,0 +1,203 @@
+import orjson, os, sys, weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from urllib.parse import quote, unquote
+from crdt.shopping_list import ShoppingList
+from crdt.pn_counter import PNCounter
+from crdt.or_map import Entry
+
+# Suffix of the file of each list
+LIST_SUFFIX = '.json'
+# Most lists kept decoded in memory at once
+LOADED_LISTS = 256
+
+class ListStore(MutableMapping):
+    def __init__(self, data_dir, capacity=LOADED_LISTS):
+        """
+        The client's shopping lists by ID, one JSON file each in a directory.
+        Opening the store only lists the directory: a list is read and decoded the first time it is used,
+        and the least recently used ones are dropped from memory beyond `capacity`
+        (written first if they changed since they were last saved).
+        A caller may keep using a list after it was dropped: it is found again by ID, and saved when marked dirty.
+        :param data_dir: Directory of the list files.
+        :param capacity: Most lists kept decoded in memory.
+        """
+        self.data_dir = data_dir
+        self.capacity = capacity
+        self.loaded = OrderedDict()   # Decoded lists, least recently used first
+        self.evicted = weakref.WeakValueDictionary()  # Lists dropped from memory that callers still hold
+        self.dirty = set()            # IDs of the lists changed since they were last saved
+        self.unsynced = False         # Whether files were renamed or removed since the directory was last fsynced
+        self.list_ids = set()
+        try:
+            names = os.listdir(data_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith('.tmp'):
+                # Left by a crash before its rename: the previous version of the file is still there
+                os.remove(os.path.join(data_dir, name))
+            elif name.endswith(LIST_SUFFIX):
+                self.list_ids.add(unquote(name[:-len(LIST_SUFFIX)]))
+
+    def __getitem__(self, list_id):
+        shopping_list = self.loaded.get(list_id)
+        if shopping_list is not None:
+            self.loaded.move_to_end(list_id)
+            return shopping_list
+        # The same object as a caller that held on to it, so its changes and the ones made through the store are not split
+        shopping_list = self.evicted.pop(list_id, None)
+        if shopping_list is None:
+            if list_id not in self.list_ids:
+                raise KeyError(list_id)
+            with open(self.list_path(list_id), 'rb') as file:
+                shopping_list = self.list_from_dict(orjson.loads(file.read()))
+        self.cache(list_id, shopping_list)
+        return shopping_list
+
+    def __setitem__(self, list_id, shopping_list):
+        self.list_ids.add(list_id)
+        self.dirty.add(list_id)
+        self.evicted.pop(list_id, None)
+        self.cache(list_id, shopping_list)
+
+    def __delitem__(self, list_id):
+        if list_id not in self.list_ids:
+            raise KeyError(list_id)
+        self.list_ids.remove(list_id)
+        self.loaded.pop(list_id, None)
+        self.evicted.pop(list_id, None)
+        self.dirty.add(list_id)
+
+    # Answered from the index, without loading the list
+    def __contains__(self, list_id):
+        return list_id in self.list_ids
+
+    def __iter__(self):
+        return iter(list(self.list_ids))
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    # Keep a decoded list, dropping the least recently used ones beyond the capacity
+    def cache(self, list_id, shopping_list):
+        self.loaded[list_id] = shopping_list
+        self.loaded.move_to_end(list_id)
+        while len(self.loaded) > self.capacity:
+            evicted_id, evicted = self.loaded.popitem(last=False)
+            if evicted_id in self.dirty:
+                self.write(evicted_id, evicted)
+                self.dirty.discard(evicted_id)
+            self.evicted[evicted_id] = evicted
+
+    # Path of the file of a list (IDs are quoted, so any of them is a plain file name)
+    def list_path(self, list_id):
+        return os.path.join(self.data_dir, quote(list_id, safe='') + LIST_SUFFIX)
+
+    # Write a list aside, fsync it and rename it over its file, so a crash leaves either version whole
+    def write(self, list_id, shopping_list):
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = self.list_path(list_id)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(orjson.dumps(self.list_to_dict(shopping_list)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+        self.unsynced = True
+
+    def flush(self):
+        """Save the lists changed since the last save, and remove the files of the deleted ones."""
+        for list_id in self.dirty:
+            if list_id in self.list_ids:
+                # A list dropped from memory was written then, it is written again if a caller changed it since
+                shopping_list = self.loaded.get(list_id)
+                if shopping_list is None:
+                    shopping_list = self.evicted.get(list_id)
+                if shopping_list is not None:
+                    self.write(list_id, shopping_list)
+            else:
+                try:
+                    os.remove(self.list_path(list_id))
+                    self.unsynced = True
+                except FileNotFoundError:
+                    pass
+        self.dirty.clear()
+        if self.unsynced:
+            self.sync_directory()
+            self.unsynced = False
+
+    # Make the renames and removals in the data directory durable
+    def sync_directory(self):
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.data_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Serializable form of a list
+    @staticmethod
+    def list_to_dict(shopping_list):
+        return {
+            "items": {
+                item_id: {
+                    "name": entry.name,
+                    "pn_counter": {
+                        "positive": entry.counter.positive,
+                        "negative": entry.counter.negative
+                    },
+                    "state": entry.state,
+                    "dot": entry.dot,
+                    "removal_dot": entry.removal_dot
+                }
+                for item_id, entry in shopping_list.or_map.items.items()
+            },
+            # Causal context, so compacted items are not brought back after a restart
+            "context": {
+                "vv": shopping_list.or_map.context.vv,
+                "cloud": list(shopping_list.or_map.context.cloud)
+            },
+            "retired": shopping_list.or_map.retired
+        }
+
+    # Rebuild a counter from its serializable form
+    @staticmethod
+    def counter_from_dict(pn_data):
+        pn_counter = PNCounter()
+        pn_counter.positive = pn_data["positive"]
+        pn_counter.negative = pn_data["negative"]
+        return pn_counter
+
+    # Rebuild a list from its serializable form
+    @staticmethod
+    def list_from_dict(shopping_list_data):
+        shopping_list = ShoppingList()
+        or_map = shopping_list.or_map
+
+        if "items" in shopping_list_data:
+            for item_id, item_data in shopping_list_data["items"].items():
+                dot, removal_dot = item_data.get("dot"), item_data.get("removal_dot")
+                # Names and IDs repeat across lists, interning keeps one copy of each
+                or_map.items[sys.intern(item_id)] = Entry(sys.intern(item_data["name"]), ListStore.counter_from_dict(item_data["pn_counter"]),
+                                                          item_data["state"], dot and tuple(dot), removal_dot and tuple(removal_dot))
+            or_map.rebuild_index()
+        else:
+            # Files written when items were kept in three maps
+            maps = {}
+            dots, removal_dots = {}, {}
+            for name, map_dots in (("add_map", dots), ("removed_map", removal_dots), ("acquired_map", removal_dots)):
+                maps[name] = {}
+                for item_id, item_data in shopping_list_data.get(name, {}).items():
+                    maps[name][item_id] = (item_data["name"], ListStore.counter_from_dict(item_data["pn_counter"]), item_data["acquired"])
+                    if item_data.get("dot"):
+                        map_dots[item_id] = tuple(item_data["dot"])
+            or_map.load_legacy_maps(maps["add_map"], maps["removed_map"], maps["acquired_map"], dots, removal_dots)
+
+        # Restore causal context (absent in files written before it existed)
+        context_data = shopping_list_data.get("context", {})
+        or_map.context.vv = context_data.get("vv", {})
+        or_map.context.cloud = {tuple(dot) for dot in context_data.get("cloud", [])}
+        or_map.retired = shopping_list_data.get("retired", {})
+        return shopping_list
@@ -1,15 +1,25 @@
-import orjson, uuid, zlib, jsonpickle
+import orjson, os, uuid
 from crdt.shopping_list import ShoppingList
-from crdt.pn_counter import PNCounter
 from crdt.or_set import ORSet
+from crdt.causal_context import set_local_replica_id
+from storage.list_store import ListStore, LOADED_LISTS
 
-# Paths to JSON database
-DATA_PATH = 'data/shopping_list_data.json'
+# Directory with one JSON file per shopping list
+DATA_DIR = 'data/lists'
+# Single JSON file of every list, used before; moved to DATA_DIR when found
+LEGACY_DATA_PATH = 'data/shopping_list_data.json'
+# File in DATA_DIR with the client's replica ID, kept so every session adds its operations under the same one
+REPLICA_ID_FILE = 'replica_id'
 
 class ShoppingListManager:
-    def __init__(self):
-        # Dictionary to store shopping lists by their unique IDs
+    def __init__(self, data_dir=DATA_DIR, loaded_lists=LOADED_LISTS):
+        # Dictionary to store shopping lists by their unique IDs (a ListStore of the saved lists once they are loaded)
         self.shopping_lists = {}
+        # Directory of the list files, most lists kept decoded in memory, and IDs of the lists changed since they were last saved
+        # (only tracked once the lists are saved to their files, see load_from_json: nodes keep theirs in the storage engine)
+        self.data_dir = data_dir
+        self.loaded_lists = loaded_lists
+        self.dirty = None
         # Set to control which lists are currently still active (not deleted by the user)
         self.list_ids = ORSet()
 
@@ -17,12 +27,14 @@ class ShoppingListManager:
     def create_shopping_list(self):
         list_id = str(uuid.uuid4())
         self.shopping_lists[list_id] = ShoppingList()
+        self.mark_dirty(list_id)
         self.list_ids.add(list_id)
         return list_id
     
     # Create shopping list with existing ID
     def create_shopping_list_with_id(self, list_id):
         self.shopping_lists[list_id] = ShoppingList()
+        self.mark_dirty(list_id)
         self.list_ids.add(list_id)
         return list_id
 
@@ -30,6 +42,7 @@ class ShoppingListManager:
     def delete_shopping_list(self, list_id):
         if list_id in self.shopping_lists:
             del self.shopping_lists[list_id]
+            self.mark_dirty(list_id)
             self.list_ids.remove(list_id)
         else:
             print(f"\nShopping list with ID {list_id} does not exist in your local environment.")
@@ -40,12 +53,11 @@ class ShoppingListManager:
 
         if list_id in self.shopping_lists:
             shopping_list = self.shopping_lists[list_id]
-            items = shopping_list.get_shopping_list()
-            for _, (name, _, _) in items.items():
-                if name == item_name:
-                    print(f"\n\033[31;1mError:\033[0m Item '{item_name_cap}' already exists in the shopping list.")
-                    return
-            self.shopping_lists[list_id].add_item(item_name, quantity)
+            if shopping_list.get_item_id(item_name) is not None:
+                print(f"\n\033[31;1mError:\033[0m Item '{item_name_cap}' already exists in the shopping list.")
+                return
+            shopping_list.add_item(item_name, quantity)
+            self.mark_dirty(list_id)
             print(f"\n{item_name_cap} was added to your shopping list successfully!")
         else:
             print(f"\nShopping list with ID {list_id} does not exist in your local environment.")
@@ -54,6 +66,7 @@ class ShoppingListManager:
     def remove_item_from_list(self, list_id, item_id):
         if list_id in self.shopping_lists:
             self.shopping_lists[list_id].remove_item(item_id)
+            self.mark_dirty(list_id)
         else:
             print(f"\nShopping list with ID {list_id} does not exist in your local environment.")
         
@@ -61,6 +74,7 @@ class ShoppingListManager:
     def acquire_item_from_list(self, list_id, item_id):
         if list_id in self.shopping_lists:
             self.shopping_lists[list_id].mark_item_acquired(item_id)
+            self.mark_dirty(list_id)
         else:
             print(f"\nShopping list with ID {list_id} does not exist in your local environment.")
 
@@ -68,9 +82,9 @@ class ShoppingListManager:
     def increment_product_quantity(self, list_id, item_id, value=1):
         if list_id in self.shopping_lists:
             shopping_list = self.shopping_lists[list_id]
-            items = shopping_list.get_shopping_list()
-            if item_id in items:
+            if shopping_list.has_item(item_id):
                 shopping_list.increment_quantity(item_id, value)
+                self.mark_dirty(list_id)
             else:
                 print(f"\nProduct with ID {item_id} does not exist in list {list_id}.")
         else:
@@ -80,9 +94,9 @@ class ShoppingListManager:
     def decrement_product_quantity(self, list_id, item_id, value=1):
         if list_id in self.shopping_lists:
             shopping_list = self.shopping_lists[list_id]
-            items = shopping_list.get_shopping_list()
-            if item_id in items:
+            if shopping_list.has_item(item_id):
                 shopping_list.decrement_quantity(item_id, value)
+                self.mark_dirty(list_id)
             else:
                 print(f"\nProduct with ID {item_id} does not exist in list {list_id}.")
         else:
@@ -106,134 +120,58 @@ class ShoppingListManager:
     # Get item ID through item name of specific list
     def get_item_id_by_name(self, list_id, item_name):
         if list_id in self.shopping_lists:
-            shopping_list = self.shopping_lists[list_id]
-            items = shopping_list.get_shopping_list()
-            for item_id, (name, _, _) in items.items():
-                if name == item_name:
-                    return item_id
-            return
+            return self.shopping_lists[list_id].get_item_id(item_name)
         else:
             print(f"\nShopping list with ID {list_id} does not exist in your local environment.")
 
 
-    # Save all shopping lists to JSON file
+    # Mark a list as changed, so the next save writes it (if the lists are saved to files)
+    def mark_dirty(self, list_id):
+        if self.dirty is not None:
+            self.dirty.add(list_id)
+
+    # Replace a list (e.g. with the state merged by the cloud)
+    def set_shopping_list(self, list_id, shopping_list):
+        self.shopping_lists[list_id] = shopping_list
+        self.mark_dirty(list_id)
+
+    # Save the lists changed since the last save, one file each (see ListStore)
     def save_to_json(self):
-        data = {}
-        for list_id, shopping_list in self.shopping_lists.items():
-            data[list_id] = {
-                "add_map": {
-                    item_id: {
-                        "name": item_name,
-                        "pn_counter": {
-                            "positive": counter.positive,
-                            "negative": counter.negative
-                        },
-                        "acquired": acquired
-                    }
-                    for item_id, (item_name, counter, acquired) in shopping_list.or_map.add_map.items()
-                },
-                "removed_map": {
-                    item_id: {
-                        "name": item_name,
-                        "pn_counter": {
-                            "positive": counter.positive,
-                            "negative": counter.negative
-                        },
-                        "acquired": acquired
-                    }
-                    for item_id, (item_name, counter, acquired) in shopping_list.or_map.removed_map.items()
-                },
-                "acquired_map": {
-                    item_id: {
-                        "name": item_name,
-                        "pn_counter": {
-                            "positive": counter.positive,
-                            "negative": counter.negative
-                        },
-                        "acquired": acquired
-                    }
-                    for item_id, (item_name, counter, acquired) in shopping_list.or_map.acquired_map.items()
-                }
-            }
-        # Serialize using orjson
-        with open(DATA_PATH, 'wb') as file:
-            file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
-
-    # Load all shopping lists from JSON file
+        self.shopping_lists.flush()
+
+    # Open the saved lists, moving the lists of the old single JSON file to their own files first
+    # Lists are only read from their files when first used
     def load_from_json(self):
+        set_local_replica_id(self.load_replica_id())
+        self.shopping_lists = ListStore(self.data_dir, self.loaded_lists)
+        self.dirty = self.shopping_lists.dirty
+        if os.path.exists(LEGACY_DATA_PATH):
+            self.migrate_legacy_file()
+
+    # Read the client's replica ID from the data directory, creating it the first time
+    def load_replica_id(self):
+        path = os.path.join(self.data_dir, REPLICA_ID_FILE)
         try:
-            with open(DATA_PATH, 'rb') as file:
-                data = orjson.loads(file.read())
+            with open(path) as file:
+                replica_id = file.read().strip()
+            if replica_id:
+                return replica_id
         except FileNotFoundError:
-            data = {}
-
-        self.shopping_lists = {}
+            pass
+        replica_id = uuid.uuid4().hex[:12]
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(replica_id)
+            file.flush()
+            os.fsync(file.fileno())
+        return replica_id
+
+    # Write the lists of the old single JSON file to one file each, then remove it
+    def migrate_legacy_file(self):
+        with open(LEGACY_DATA_PATH, 'rb') as file:
+            data = orjson.loads(file.read())
         for list_id, shopping_list_data in data.items():
-            shopping_list = ShoppingList()
-
-            # Rebuild add_map
-            for item_id, item_data in shopping_list_data.get("add_map", {}).items():
-                item_name = item_data["name"]
-                pn_data = item_data["pn_counter"]
-                pn_counter = PNCounter()
-                pn_counter.positive = pn_data["positive"]
-                pn_counter.negative = pn_data["negative"]
-                acquired = item_data["acquired"]
-                shopping_list.or_map.add_map[item_id] = (item_name, pn_counter, acquired)
-
-            # Rebuild removed_map
-            for item_id, item_data in shopping_list_data.get("removed_map", {}).items():
-                item_name = item_data["name"]
-                pn_data = item_data["pn_counter"]
-                pn_counter = PNCounter()
-                pn_counter.positive = pn_data["positive"]
-                pn_counter.negative = pn_data["negative"]
-                acquired = item_data["acquired"]
-                shopping_list.or_map.removed_map[item_id] = (item_name, pn_counter, acquired)
-
-            # Rebuild acquired_map
-            for item_id, item_data in shopping_list_data.get("acquired_map", {}).items():
-                item_name = item_data["name"]
-                pn_data = item_data["pn_counter"]
-                pn_counter = PNCounter()
-                pn_counter.positive = pn_data["positive"]
-                pn_counter.negative = pn_data["negative"]
-                acquired = item_data["acquired"]
-                shopping_list.or_map.acquired_map[item_id] = (item_name, pn_counter, acquired)
-
-            self.shopping_lists[list_id] = shopping_list
-
-    # Compress JSON data to be sent over ZMQ
-    def compress_data(self, data):
-        # Convert all dictionary keys to strings to avoid JSON serialization error
-        if 'hash_ring' in data:
-            # Convert keys in the 'hash_ring' dictionary to strings
-            data['hash_ring'] = {str(key): value for key, value in data['hash_ring'].items()}
-
-        if 'shopping_list' in data:
-            # Use jsonpickle to serialize the custom object
-            data['shopping_list'] = jsonpickle.dumps(data['shopping_list'])
-        
-        byte_data = orjson.dumps(data) # Convert the entire dictionary to JSON string
-    
-        # Compress the string into bytes
-        compressed_data = zlib.compress(byte_data)  # Ensure it's in byte form
-        return compressed_data      
-
-    # Decompress data and convert it back to original format
-    def decompress_data(self, compressed_data):
-        # Decompress the data first
-        json_data = zlib.decompress(compressed_data)  # Decode from bytes to string
-
-        # Load the JSON string into a Python dictionary
-        data = orjson.loads(json_data)
-
-        # Convert keys of the 'hash_ring' back to integers
-        if 'hash_ring' in data:
-            data['hash_ring'] = {int(key): value for key, value in data['hash_ring'].items()}
-
-        # Decompress list object
-        if 'shopping_list' in data:
-            data['shopping_list'] = jsonpickle.loads(data['shopping_list'])
-
-        return data
+            self.set_shopping_list(list_id, ListStore.list_from_dict(shopping_list_data))
+        self.save_to_json()
+        os.remove(LEGACY_DATA_PATH)
+        print(f"Moved {len(data)} lists from {LEGACY_DATA_PATH} to {self.data_dir}")
@@ -0,0 +1,382 @@
+import mmap, struct, sys, threading, zlib
+from array import array
+from collections.abc import MutableMapping
+from communication.codec import compress_data, decompress_data
+from crdt.shopping_list import ShoppingList
+from crdt.pn_counter import PNCounter
+from crdt.or_map import Entry
+
+# Layout of a snapshot file (little endian, every section aligned to 8 bytes):
+#     header     magic, counts and the offset of every section below
+#     strings    string_count + 1 u32 offsets, then the UTF-8 bytes of every distinct list ID, item ID, name and replica ID
+#     lists      one column per field, list_count values each: list ID (string), saved version, digest,
+#                tombstone count, first item row, number of items, offset and length of its metadata
+#     items      one column per field, item_count values each: item ID and name (strings), counter positive and negative,
+#                state, replica (string, NO_DOT if none) and counter of the add dot and of the removal dot
+#     metadata   codec envelope of each list's causal context and retired names
+#     catalog    codec envelope of the set of active and deleted lists
+#     footer     crc32 of everything before it and the end magic; a file without them was not written completely
+MAGIC = b'SLSNAP02'
+END_MAGIC = b'SNAPEND1'
+_header = struct.Struct('<8sIIIIQQQQQ')
+_footer = struct.Struct('<I8s')
+NO_DOT = 0xFFFFFFFF
+
+# Columns of the lists and items sections: (name, array typecode, struct format)
+LIST_COLUMNS = [("list_id", 'I', 'I'), ("version", 'Q', 'Q'), ("digest", 'Q', 'Q'), ("tombstones", 'I', 'I'),
+                ("first_item", 'I', 'I'), ("item_count", 'I', 'I'), ("metadata_offset", 'Q', 'Q'), ("metadata_length", 'I', 'I')]
+ITEM_COLUMNS = [("item_id", 'I', 'I'), ("name", 'I', 'I'), ("positive", 'q', 'q'), ("negative", 'q', 'q'),
+                ("state", 'B', 'B'), ("dot_replica", 'I', 'I'), ("dot_counter", 'Q', 'Q'),
+                ("removal_replica", 'I', 'I'), ("removal_counter", 'Q', 'Q')]
+
+# First version of the layout, still read: the items of a list in three groups (added, then removed, then acquired)
+# with an acquired flag and a single dot, removed and acquired items also appearing among the added ones
+MAGIC_V1 = b'SLSNAP01'
+LIST_COLUMNS_V1 = [("list_id", 'I', 'I'), ("version", 'Q', 'Q'), ("digest", 'Q', 'Q'), ("tombstones", 'I', 'I'),
+                   ("first_item", 'I', 'I'), ("added", 'I', 'I'), ("removed", 'I', 'I'), ("acquired", 'I', 'I'),
+                   ("metadata_offset", 'Q', 'Q'), ("metadata_length", 'I', 'I')]
+ITEM_COLUMNS_V1 = [("item_id", 'I', 'I'), ("name", 'I', 'I'), ("positive", 'q', 'q'), ("negative", 'q', 'q'),
+                   ("acquired", 'B', 'B'), ("dot_replica", 'I', 'I'), ("dot_counter", 'Q', 'Q')]
+
+# Bytes of padding that align a length to 8 bytes
+def _padding(length):
+    return -length % 8
+
+class SnapshotWriter:
+    def __init__(self):
+        """
+        Builds a snapshot: lists are added one at a time (e.g. each under its own lock), then written at once.
+        Strings are stored once however many lists use them, counters as fixed size columns.
+        """
+        self.strings = {}
+        self.string_bytes = []
+        self.lists = {name: array(typecode) for name, typecode, _ in LIST_COLUMNS}
+        self.items = {name: array(typecode) for name, typecode, _ in ITEM_COLUMNS}
+        self.metadata = bytearray()
+        self.catalog = b''
+
+    # Index of a string in the string table
+    def string(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.string_bytes)
+            self.string_bytes.append(value.encode())
+        return index
+
+    def add(self, list_id, shopping_list):
+        """Add the current state of a list."""
+        or_map = shopping_list.or_map
+        columns = self.lists
+        columns["list_id"].append(self.string(list_id))
+        columns["version"].append(or_map.version)
+        columns["digest"].append(or_map.digest())
+        columns["tombstones"].append(or_map.count_tombstones())
+        columns["first_item"].append(len(self.items["item_id"]))
+        columns["item_count"].append(len(or_map.items))
+        items = self.items
+        for item_id, entry in or_map.items.items():
+            items["item_id"].append(self.string(item_id))
+            items["name"].append(self.string(entry.name))
+            items["positive"].append(entry.counter.positive)
+            items["negative"].append(entry.counter.negative)
+            items["state"].append(entry.state)
+            for replica_column, counter_column, dot in (("dot_replica", "dot_counter", entry.dot),
+                                                        ("removal_replica", "removal_counter", entry.removal_dot)):
+                items[replica_column].append(NO_DOT if dot is None else self.string(dot[0]))
+                items[counter_column].append(0 if dot is None else dot[1])
+
+        metadata = compress_data({"context": [or_map.context.vv, list(or_map.context.cloud)], "retired": or_map.retired})
+        columns["metadata_offset"].append(len(self.metadata))
+        columns["metadata_length"].append(len(metadata))
+        self.metadata += metadata
+
+    def set_catalog(self, list_ids):
+        """Set the catalog of active and deleted lists (an ORSet)."""
+        self.catalog = compress_data({"list_ids": list_ids})
+
+    def write(self, file):
+        """
+        Write the snapshot to a file open for writing in binary mode.
+        :return: Number of lists written.
+        """
+        string_offsets = array('I', [0])
+        for raw in self.string_bytes:
+            string_offsets.append(string_offsets[-1] + len(raw))
+
+        sections = [[string_offsets, b''.join(self.string_bytes)],
+                    [self.lists[name] for name, _, _ in LIST_COLUMNS],
+                    [self.items[name] for name, _, _ in ITEM_COLUMNS],
+                    [bytes(self.metadata)],
+                    [self.catalog]]
+        chunks = [None]
+        offsets = []
+        position = _header.size + _padding(_header.size)
+        chunks.append(bytes(_padding(_header.size)))
+        for section in sections:
+            offsets.append(position)
+            for chunk in section:
+                if isinstance(chunk, array):
+                    if sys.byteorder == 'big':
+                        chunk.byteswap()
+                    chunk = chunk.tobytes()
+                chunks.append(chunk)
+                chunks.append(bytes(_padding(len(chunk))))
+                position += len(chunk) + _padding(len(chunk))
+
+        list_count = len(self.lists["list_id"])
+        chunks[0] = _header.pack(MAGIC, list_count, len(self.items["item_id"]), len(self.string_bytes), len(self.catalog), *offsets)
+        checksum = 0
+        for chunk in chunks:
+            checksum = zlib.crc32(chunk, checksum)
+            file.write(chunk)
+        file.write(_footer.pack(checksum, END_MAGIC))
+        return list_count
+
+class Snapshot:
+    def __init__(self, path):
+        """
+        A snapshot file mapped in memory. Opening it checks the file and reads the list IDs;
+        the items of a list are only decoded when the list is read.
+        :raise ValueError: If the file is not a complete snapshot.
+        """
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+        if len(data) < _header.size + _footer.size:
+            raise ValueError(f"Truncated snapshot {path}")
+        checksum, end_magic = _footer.unpack_from(data, len(data) - _footer.size)
+        (magic, self.list_count, self.item_count, self.string_count, catalog_length,
+         strings_offset, lists_offset, items_offset, metadata_offset, catalog_offset) = _header.unpack_from(data, 0)
+        if magic not in (MAGIC, MAGIC_V1) or end_magic != END_MAGIC or zlib.crc32(memoryview(data)[:len(data) - _footer.size]) != checksum:
+            raise ValueError(f"Incomplete or corrupt snapshot {path}")
+        self.path = path
+        self.legacy = magic == MAGIC_V1
+        self.metadata_offset = metadata_offset
+        self.catalog_range = (catalog_offset, catalog_offset + catalog_length)
+
+        self.string_offsets = strings_offset
+        self.string_data = strings_offset + 4 * (self.string_count + 1) + _padding(4 * (self.string_count + 1))
+        self.strings = {}  # Decoded strings by index, so names shared by many lists are one object
+
+        self.list_columns = self.columns(LIST_COLUMNS_V1 if self.legacy else LIST_COLUMNS, lists_offset, self.list_count)
+        self.item_columns = self.columns(ITEM_COLUMNS_V1 if self.legacy else ITEM_COLUMNS, items_offset, self.item_count)
+        # Row of each list
+        offset, format = self.list_columns["list_id"]
+        list_ids = struct.unpack_from(f'<{self.list_count}{format}', data, offset)
+        self.index = {self.string(string): row for row, string in enumerate(list_ids)}
+
+    # Offset and struct format of each column of a section
+    @staticmethod
+    def columns(columns, offset, count):
+        positions = {}
+        for name, _, format in columns:
+            positions[name] = (offset, format)
+            length = struct.calcsize(format) * count
+            offset += length + _padding(length)
+        return positions
+
+    def string(self, index):
+        value = self.strings.get(index)
+        if value is None:
+            start, end = struct.unpack_from('<II', self.data, self.string_offsets + 4 * index)
+            # Interned, so lists decoded from the snapshot share their names and IDs with the others
+            value = self.strings[index] = sys.intern(self.data[self.string_data + start:self.string_data + end].decode())
+        return value
+
+    # Value of a column for one list
+    def list_value(self, name, row):
+        offset, format = self.list_columns[name]
+        return struct.unpack_from('<' + format, self.data, offset + struct.calcsize(format) * row)[0]
+
+    # Values of an item column for a range of rows
+    def item_values(self, name, start, count):
+        offset, format = self.item_columns[name]
+        return struct.unpack_from(f'<{count}{format}', self.data, offset + struct.calcsize(format) * start)
+
+    def __contains__(self, list_id):
+        return list_id in self.index
+
+    def __len__(self):
+        return self.list_count
+
+    def get_catalog(self):
+        start, end = self.catalog_range
+        return decompress_data(self.data[start:end])["list_ids"]
+
+    # Version of a list as recovered: above the saved one, so replicas that were behind get the full state
+    def get_version(self, list_id):
+        return self.list_value("version", self.index[list_id]) + 1
+
+    def get_digest(self, list_id):
+        return self.list_value("digest", self.index[list_id])
+
+    def count_tombstones(self, list_id):
+        return self.list_value("tombstones", self.index[list_id])
+
+    def read(self, list_id):
+        """Decode a list into a new ShoppingList."""
+        row = self.index[list_id]
+        shopping_list = ShoppingList()
+        or_map = shopping_list.or_map
+        if self.legacy:
+            self.read_legacy_items(row, or_map)
+        else:
+            start, count = self.list_value("first_item", row), self.list_value("item_count", row)
+            columns = [self.item_values(name, start, count) for name, _, _ in ITEM_COLUMNS]
+            string = self.string
+            for item_id, item_name, positive, negative, state, dot_replica, dot_counter, removal_replica, removal_counter in zip(*columns):
+                counter = PNCounter()
+                counter.positive = positive
+                counter.negative = negative
+                or_map.items[string(item_id)] = Entry(string(item_name), counter, state,
+                                                      None if dot_replica == NO_DOT else (string(dot_replica), dot_counter),
+                                                      None if removal_replica == NO_DOT else (string(removal_replica), removal_counter))
+            or_map.rebuild_index()
+
+        offset = self.metadata_offset + self.list_value("metadata_offset", row)
+        metadata = decompress_data(self.data[offset:offset + self.list_value("metadata_length", row)])
+        vv, cloud = metadata["context"]
+        or_map.context.vv = vv
+        or_map.context.cloud = {tuple(dot) for dot in cloud}
+        or_map.retired = metadata["retired"]
+        or_map.version = or_map.gc_version = self.get_version(list_id)
+        return shopping_list
+
+    # Items of a list in a version 1 snapshot
+    def read_legacy_items(self, row, or_map):
+        start = self.list_value("first_item", row)
+        count = sum(self.list_value(name, row) for name in ("added", "removed", "acquired"))
+        rows = iter(zip(*[self.item_values(name, start, count) for name, _, _ in ITEM_COLUMNS_V1]))
+        maps = {}
+        dots, removal_dots = {}, {}
+        for name, map_dots in (("added", dots), ("removed", removal_dots), ("acquired", removal_dots)):
+            maps[name] = {}
+            for _ in range(self.list_value(name, row)):
+                item_id, item_name, positive, negative, acquired, dot_replica, dot_counter = next(rows)
+                item_id = self.string(item_id)
+                counter = PNCounter()
+                counter.positive = positive
+                counter.negative = negative
+                maps[name][item_id] = (self.string(item_name), counter, acquired == 1)
+                if dot_replica != NO_DOT:
+                    map_dots[item_id] = (self.string(dot_replica), dot_counter)
+        or_map.load_legacy_maps(maps["added"], maps["removed"], maps["acquired"], dots, removal_dots)
+
+class SnapshotEntry:
+    """What the node's background passes read of a list still only in the snapshot, without decoding it."""
+    def __init__(self, snapshot, list_id):
+        self.snapshot = snapshot
+        self.list_id = list_id
+
+    def get_version(self):
+        return self.snapshot.get_version(self.list_id)
+
+    def digest(self):
+        return self.snapshot.get_digest(self.list_id)
+
+    def count_tombstones(self):
+        return self.snapshot.count_tombstones(self.list_id)
+
+class SnapshotLists(MutableMapping):
+    def __init__(self, snapshot=None):
+        """
+        The lists of a node by ID: those changed since the snapshot was taken as ShoppingLists in memory,
+        the others read from the snapshot.
+        Getting a list (`lists[list_id]`) materializes it, as the caller may change it;
+        `peek` decodes it for reading only, and `entries` does not decode it at all.
+        :param snapshot: The Snapshot the node recovered from, if any.
+        """
+        self.snapshot = snapshot
+        self.loaded = {}         # Lists in memory
+        self.deleted = set()     # IDs of the snapshot's lists deleted since
+        self.shadowed = set()    # IDs of the snapshot's lists loaded or deleted since
+        self.entries_cache = {}  # SnapshotEntry of the snapshot's lists, one per list so they can be told apart
+        self.lock = threading.Lock()
+
+    # Whether a list is only in the snapshot
+    def in_snapshot(self, list_id):
+        return self.snapshot is not None and list_id in self.snapshot and list_id not in self.shadowed
+
+    def __getitem__(self, list_id):
+        shopping_list = self.loaded.get(list_id)
+        if shopping_list is not None:
+            return shopping_list
+        with self.lock:
+            if list_id in self.loaded:
+                return self.loaded[list_id]
+            if not self.in_snapshot(list_id):
+                raise KeyError(list_id)
+            shopping_list = self.loaded[list_id] = self.snapshot.read(list_id)
+            self.shadowed.add(list_id)
+            return shopping_list
+
+    def __setitem__(self, list_id, shopping_list):
+        with self.lock:
+            self.loaded[list_id] = shopping_list
+            self.deleted.discard(list_id)
+            if self.snapshot is not None and list_id in self.snapshot:
+                self.shadowed.add(list_id)
+
+    def __delitem__(self, list_id):
+        with self.lock:
+            if list_id in self.loaded:
+                del self.loaded[list_id]
+            elif not self.in_snapshot(list_id):
+                raise KeyError(list_id)
+            if self.snapshot is not None and list_id in self.snapshot:
+                self.deleted.add(list_id)
+                self.shadowed.add(list_id)
+
+    def __contains__(self, list_id):
+        return list_id in self.loaded or self.in_snapshot(list_id)
+
+    def __iter__(self):
+        list_ids = list(self.loaded)
+        if self.snapshot is not None:
+            list_ids += [list_id for list_id in self.snapshot.index if list_id not in self.shadowed]
+        return iter(list_ids)
+
+    def __len__(self):
+        return len(self.loaded) + (len(self.snapshot) - len(self.shadowed) if self.snapshot is not None else 0)
+
+    def peek(self, list_id):
+        """Get a list to read it, decoding it from the snapshot if it is only there (None if there is no such list)."""
+        shopping_list = self.loaded.get(list_id)
+        if shopping_list is not None:
+            return shopping_list
+        snapshot = self.snapshot
+        if snapshot is not None and list_id in snapshot and list_id not in self.shadowed:
+            return snapshot.read(list_id)
+        return self.loaded.get(list_id)
+
+    def entries(self):
+        """(list ID, list) pairs, with a SnapshotEntry for the lists only in the snapshot."""
+        for list_id in self:
+            shopping_list = self.loaded.get(list_id)
+            if shopping_list is None:
+                shopping_list = self.entries_cache.get(list_id)
+                if shopping_list is None:
+                    shopping_list = self.entries_cache[list_id] = SnapshotEntry(self.snapshot, list_id)
+            yield list_id, shopping_list
+
+    def replace_snapshot(self, snapshot, get_list_lock):
+        """
+        Read the lists not in memory from a newer snapshot holding them too, so older ones can be deleted.
+        The lists in memory the snapshot holds unchanged are dropped, and read from it again when needed.
+        :param snapshot: The new Snapshot.
+        :param get_list_lock: Function returning the lock of a list, held while dropping it so no writer changes it meanwhile.
+        """
+        with self.lock:
+            self.snapshot = snapshot
+            self.deleted = {list_id for list_id in self.deleted if list_id in snapshot}
+            self.shadowed = {list_id for list_id in snapshot.index if list_id in self.loaded or list_id in self.deleted}
+            self.entries_cache = {}
+            covered = [list_id for list_id in self.loaded if list_id in snapshot]
+
+        for list_id in covered:
+            with get_list_lock(list_id), self.lock:
+                shopping_list = self.loaded.get(list_id)
+                # A list read from a snapshot is one version above the saved one (see Snapshot.get_version)
+                if shopping_list is not None and self.snapshot is snapshot and snapshot.get_version(list_id) == shopping_list.get_version() + 1:
+                    del self.loaded[list_id]
+                    self.shadowed.discard(list_id)
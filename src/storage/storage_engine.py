@@ -0,0 +1,326 @@
+import os, threading, time, struct, zlib
+from communication.codec import compress_data, decompress_data
+from storage.snapshot import Snapshot, SnapshotWriter, SnapshotLists
+
+# When appended records reach the disk:
+#   'always'   fsync after every record, writers wait for it
+#   'group'    writers wait, and one fsync covers every record appended while the previous one ran (group commit)
+#   'interval' fsync every FSYNC_INTERVAL seconds in the background, writers do not wait
+#   'none'     never fsync, the operating system writes the records back (they survive a crash of the process only)
+FSYNC_POLICIES = ("always", "group", "interval", "none")
+FSYNC_POLICY = "group"
+# Seconds between two fsyncs with the 'interval' policy
+FSYNC_INTERVAL = 1.0
+# Seconds between two snapshots, and log size that triggers one earlier
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_LOG_SIZE = 64 * 1024 * 1024
+
+# Every record is framed as [length: u32][crc32 of the payload: u32][payload], the payload being a codec envelope
+_header = struct.Struct('<II')
+
+class StorageEngine:
+    def __init__(self, data_dir, fsync_policy=FSYNC_POLICY):
+        """
+        Durable state of a node's lists: an append-only write-ahead log of the operations applied to them
+        (creations, deletions and the CRDT states or deltas merged into them) and periodic snapshots.
+        The log is split in segments (wal-N.log); snapshot-N.snap holds every list as of the start of segment N,
+        so older segments are deleted once it is written. Recovery maps the latest snapshot in memory (see Snapshot),
+        so lists are only decoded when used, and replays the segments after it.
+        Merges are idempotent, so records applied both in the snapshot and in the log are harmless.
+        :param data_dir: Directory of the log and snapshots.
+        :param fsync_policy: When records reach the disk, one of FSYNC_POLICIES.
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy}, expected one of {FSYNC_POLICIES}")
+        self.data_dir = data_dir
+        self.fsync_policy = fsync_policy
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.lock = threading.Lock()          # Serializes appends and segment rotation
+        self.segment = None                   # Number of the segment being appended to
+        self.fd = None
+        self.log_size = 0                     # Bytes appended since the last snapshot
+        self.appended = 0                     # Sequence number of the last appended record
+        self.durable = 0                      # Sequence number of the last record known to be on disk
+        self.flushing = False                 # Whether a writer is running a group fsync
+        self.flush_condition = threading.Condition()
+        self.fsyncs = 0
+        self.shutdown_flag = False
+
+    def segment_path(self, segment):
+        return os.path.join(self.data_dir, f"wal-{segment:08d}.log")
+
+    def snapshot_path(self, segment):
+        return os.path.join(self.data_dir, f"snapshot-{segment:08d}.snap")
+
+    # Snapshots written before the mapped format: a log of records like the segments
+    def record_snapshot_path(self, segment):
+        return os.path.join(self.data_dir, f"snapshot-{segment:08d}.dat")
+
+    # Numbers of the files with a prefix in the data directory, in order
+    def list_files(self, prefix, suffix):
+        numbers = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith(prefix) and name.endswith(suffix):
+                try:
+                    numbers.append(int(name[len(prefix):-len(suffix)]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    # Encode a record with its frame
+    @staticmethod
+    def frame(record):
+        payload = compress_data(record)
+        return _header.pack(len(payload), zlib.crc32(payload)) + payload
+
+    # Decode the records of a file, stopping at the first incomplete or corrupt one
+    # Returns the records and the length of the valid prefix of the file
+    @staticmethod
+    def read_records(path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        records = []
+        offset = 0
+        while offset + _header.size <= len(data):
+            length, checksum = _header.unpack_from(data, offset)
+            payload = data[offset + _header.size:offset + _header.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            records.append(decompress_data(payload))
+            offset += _header.size + length
+        return records, offset
+
+    def recover(self, shopping_manager):
+        """
+        Rebuild the lists of a ShoppingListManager from the latest snapshot and the log after it,
+        then open a new log segment. The manager's lists become a SnapshotLists.
+        A record cut short by a crash ends the log: the segment is truncated before it.
+        :return: Number of lists recovered and of log records replayed.
+        """
+        versions = {}
+        snapshot = None
+        first_segment = 0
+        for segment in reversed(self.list_files("snapshot-", ".snap")):
+            # A snapshot is only used if it was written completely
+            try:
+                snapshot = Snapshot(self.snapshot_path(segment))
+            except ValueError as e:
+                print(f"Storage: {e}")
+                continue
+            first_segment = segment
+            break
+        shopping_manager.shopping_lists = SnapshotLists(snapshot)
+        if snapshot is not None:
+            shopping_manager.list_ids = snapshot.get_catalog()
+        else:
+            for segment in reversed(self.list_files("snapshot-", ".dat")):
+                records, _ = self.read_records(self.record_snapshot_path(segment))
+                if records and records[-1]["operation"] == "end":
+                    for record in records[:-1]:
+                        self.apply(shopping_manager, record, versions)
+                    first_segment = segment
+                    break
+
+        replayed = 0
+        segments = [segment for segment in self.list_files("wal-", ".log") if segment >= first_segment]
+        for segment in segments:
+            path = self.segment_path(segment)
+            records, valid_length = self.read_records(path)
+            for record in records:
+                self.apply(shopping_manager, record, versions)
+            replayed += len(records)
+            if valid_length < os.path.getsize(path):
+                print(f"Storage: Truncating {path} after {len(records)} valid records")
+                with open(path, 'r+b') as file:
+                    file.truncate(valid_length)
+
+        # Versions restart from where they were, and older ones get the full state (see ShoppingList.get_delta)
+        for list_id, version in versions.items():
+            shopping_list = shopping_manager.shopping_lists.get(list_id)
+            if shopping_list is not None:
+                shopping_list.or_map.version = max(shopping_list.or_map.version, version) + 1
+                shopping_list.or_map.gc_version = shopping_list.or_map.version
+
+        self.open_segment((segments[-1] + 1) if segments else first_segment + 1)
+        return len(shopping_manager.shopping_lists), replayed
+
+    # Apply a log or snapshot record to the lists
+    @staticmethod
+    def apply(shopping_manager, record, versions):
+        operation = record["operation"]
+        list_id = record.get("list_id")
+        if operation == "catalog":
+            shopping_manager.list_ids = record["list_ids"]
+        elif operation == "create":
+            if list_id not in shopping_manager.shopping_lists:
+                shopping_manager.create_shopping_list_with_id(list_id)
+        elif operation == "delete":
+            shopping_manager.shopping_lists.pop(list_id, None)
+            shopping_manager.list_ids.remove(list_id)
+        elif operation == "merge":
+            if list_id in shopping_manager.get_removed_lists():
+                return
+            if list_id not in shopping_manager.shopping_lists:
+                shopping_manager.create_shopping_list_with_id(list_id)
+            shopping_manager.shopping_lists[list_id].merge(record["shopping_list"])
+            versions[list_id] = max(versions.get(list_id, 0), record.get("version") or 0)
+
+    # Start appending to a new segment (must hold the lock, or be the only thread using the engine)
+    def open_segment(self, segment):
+        if self.fd is not None:
+            self.sync_all()
+            os.close(self.fd)
+        self.segment = segment
+        self.fd = os.open(self.segment_path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.sync_directory()
+
+    # Make the creation or renaming of files in the data directory durable
+    def sync_directory(self):
+        if self.fsync_policy == "none" or not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.data_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # fsync every appended record, waiting for a group fsync in progress (must hold the lock)
+    def sync_all(self):
+        with self.flush_condition:
+            while self.flushing:
+                self.flush_condition.wait()
+            if self.fsync_policy != "none" and self.durable < self.appended:
+                os.fsync(self.fd)
+                self.fsyncs += 1
+            self.durable = self.appended
+
+    def append(self, record):
+        """
+        Append a record to the log, and wait until it is on disk if the fsync policy says so.
+        :param record: The operation: {"operation": "create" | "delete", "list_id"} or
+            {"operation": "merge", "list_id", "shopping_list", "version"}.
+        :return: Sequence number of the record.
+        """
+        data = self.frame(record)
+        with self.lock:
+            os.write(self.fd, data)
+            self.log_size += len(data)
+            self.appended += 1
+            sequence = self.appended
+            if self.fsync_policy == "always":
+                os.fsync(self.fd)
+                self.fsyncs += 1
+                self.durable = sequence
+        if self.fsync_policy == "group":
+            self.wait_durable(sequence)
+        return sequence
+
+    # Group commit: the first writer to find its record not on disk fsyncs every record appended so far,
+    # the writers arriving meanwhile wait for it and are usually covered by the next fsync
+    def wait_durable(self, sequence):
+        with self.flush_condition:
+            while self.durable < sequence:
+                if self.flushing:
+                    self.flush_condition.wait()
+                    continue
+                self.flushing = True
+                target = self.appended
+                fd = self.fd
+                self.flush_condition.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.flush_condition.acquire()
+                    self.flushing = False
+                    self.fsyncs += 1
+                    self.durable = max(self.durable, target)
+                    self.flush_condition.notify_all()
+
+    def log_create(self, list_id):
+        return self.append({"operation": "create", "list_id": list_id})
+
+    def log_delete(self, list_id):
+        return self.append({"operation": "delete", "list_id": list_id})
+
+    def log_merge(self, list_id, shopping_list, version):
+        """Log a full state or delta merged into a list, and the list's version after the merge."""
+        return self.append({"operation": "merge", "list_id": list_id, "shopping_list": shopping_list, "version": version})
+
+    def snapshot(self, shopping_manager, get_list_lock, catalog_lock):
+        """
+        Write every list to a new snapshot and delete the log segments and snapshots it replaces.
+        The log moves to a new segment first, so the snapshot holds at least every record of the older ones.
+        Each list is read under its own lock, and the catalog of lists under the catalog lock,
+        so writes go on while the snapshot is taken. The lists not in memory, and the ones it holds unchanged,
+        are then read from the new snapshot.
+        :return: Number of lists in the snapshot.
+        """
+        with self.lock:
+            segment = self.segment + 1
+            self.open_segment(segment)
+            self.log_size = 0
+
+        shopping_lists = shopping_manager.shopping_lists
+        writer = SnapshotWriter()
+        with catalog_lock:
+            writer.set_catalog(shopping_manager.list_ids)
+        for list_id in list(shopping_lists):
+            with get_list_lock(list_id):
+                shopping_list = shopping_lists.peek(list_id)
+                if shopping_list is not None:
+                    writer.add(list_id, shopping_list)
+
+        path = self.snapshot_path(segment)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            count = writer.write(file)
+            file.flush()
+            if self.fsync_policy != "none":
+                os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+        self.sync_directory()
+        shopping_lists.replace_snapshot(Snapshot(path), get_list_lock)
+
+        for old_segment in self.list_files("wal-", ".log"):
+            if old_segment < segment:
+                os.remove(self.segment_path(old_segment))
+        for old_snapshot in self.list_files("snapshot-", ".snap"):
+            if old_snapshot < segment:
+                self.remove_snapshot(self.snapshot_path(old_snapshot))
+        for old_snapshot in self.list_files("snapshot-", ".dat"):
+            os.remove(self.record_snapshot_path(old_snapshot))
+        return count
+
+    # Delete an older snapshot; one still mapped by a reader cannot be deleted on Windows, the next snapshot retries
+    @staticmethod
+    def remove_snapshot(path):
+        try:
+            os.remove(path)
+        except PermissionError:
+            pass
+
+    def needs_snapshot(self):
+        """Whether the log grew enough since the last snapshot to take one early."""
+        return self.log_size >= SNAPSHOT_LOG_SIZE
+
+    def run_fsync_interval(self):
+        # Background fsyncs of the 'interval' policy
+        while not self.shutdown_flag:
+            time.sleep(FSYNC_INTERVAL)
+            # Same path as a group commit, so writers keep appending during the fsync
+            self.wait_durable(self.appended)
+
+    def start(self):
+        """Start the background fsyncs, if the policy needs them."""
+        if self.fsync_policy == "interval":
+            threading.Thread(target=self.run_fsync_interval, daemon=True).start()
+
+    def close(self):
+        """fsync and close the log."""
+        self.shutdown_flag = True
+        with self.lock:
+            if self.fd is not None:
+                self.sync_all()
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules are imported from the src folder, as when running the client, the server or the benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
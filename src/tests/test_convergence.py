@@ -0,0 +1,108 @@
+import random
+from crdt.shopping_list import ShoppingList
+from crdt.causal_context import stable_version_vector
+from communication.codec import compress_data, decompress_data
+
+ITEM_NAMES = ("bread", "eggs", "milk")
+
+# Round-trip a list through the codec, as every write and replicate does
+def wire(shopping_list):
+    return decompress_data(compress_data({"shopping_list": shopping_list}))["shopping_list"]
+
+def items(shopping_list):
+    return sorted((item_name, quantity) for item_name, quantity, _ in shopping_list.get_shopping_list().values())
+
+def sync_all(lists):
+    for _ in range(2):
+        for shopping_list in lists:
+            for other in lists:
+                if other is not shopping_list:
+                    shopping_list.merge(wire(other))
+
+def removed_on_both_nodes():
+    a = ShoppingList("a")
+    a.add_item("eggs")
+    n0, n1 = ShoppingList("n0"), ShoppingList("n1")
+    n0.merge(wire(a))
+    n1.merge(wire(a))
+    a.remove_item(a.get_item_id("eggs"))
+    n0.merge(wire(a))
+    n1.merge(wire(a))
+    return a, n0, n1
+
+def test_concurrent_re_add_survives_compaction_on_one_replica_only():
+    _, n0, n1 = removed_on_both_nodes()
+    # b never saw the list, its eggs get the same ID as the removed ones
+    b = ShoppingList("b")
+    b.add_item("eggs")
+    assert b.get_item_id("eggs") in n0.or_map.items
+
+    n1.compact(stable_version_vector([n0.get_context(), n1.get_context()]))
+    n0.merge(wire(b))
+    n1.merge(wire(b))
+    sync_all([n0, n1])
+    assert items(n0) == items(n1) == [("eggs", 1)]
+
+def test_client_tombstone_does_not_hide_a_concurrent_re_add():
+    a, n0, _ = removed_on_both_nodes()
+    b = ShoppingList("b")
+    b.add_item("eggs")
+    n0.merge(wire(b))
+
+    a.merge(wire(n0))
+    assert items(a) == [("eggs", 1)]
+
+def test_removal_covers_only_the_adds_it_observed():
+    _, n0, _ = removed_on_both_nodes()
+    b = ShoppingList("b")
+    b.add_item("eggs")
+    b.merge(wire(n0))
+    assert items(b) == [("eggs", 1)]
+
+    # Once b's add is observed, removing it again wins everywhere
+    n0.merge(wire(b))
+    n0.remove_item(n0.get_item_id("eggs"))
+    b.merge(wire(n0))
+    assert items(b) == items(n0) == []
+
+def test_replicas_converge_with_partial_compaction():
+    for seed in range(200):
+        rng = random.Random(seed)
+        nodes = [ShoppingList(f"n{i}") for i in range(3)]
+        clients = [ShoppingList(f"c{i}") for i in range(2)]
+        synced = {}
+        for step in range(60):
+            client = rng.randrange(len(clients))
+            shopping_list = clients[client]
+            live_items = list(shopping_list.get_shopping_list())
+            operation = rng.random()
+            if operation < 0.3:
+                shopping_list.add_item(rng.choice(ITEM_NAMES), rng.randint(1, 3))
+            elif operation < 0.4 and live_items:
+                shopping_list.remove_item(rng.choice(live_items))
+            elif operation < 0.5 and live_items:
+                shopping_list.mark_item_acquired(rng.choice(live_items))
+            elif operation < 0.55:
+                # A client that never saw the list starts over
+                clients[client] = ShoppingList(f"c{seed}-{step}")
+            elif operation < 0.8:
+                # Client writes go as deltas on top of what the node acknowledged, reads bring back full states
+                node = rng.randrange(len(nodes))
+                key = (shopping_list.or_map.replica_id, node)
+                if rng.random() < 0.5:
+                    delta = shopping_list.get_delta(synced.get(key))
+                    nodes[node].merge(wire(delta if delta is not None else shopping_list))
+                    synced[key] = shopping_list.get_version()
+                else:
+                    shopping_list.merge(wire(nodes[node]))
+            elif operation < 0.9:
+                node, other = rng.sample(nodes, 2)
+                node.merge(wire(other))
+            else:
+                # Only the nodes take part in compaction
+                rng.choice(nodes).compact(stable_version_vector([node.get_context() for node in nodes]))
+
+        lists = nodes + clients
+        sync_all(lists)
+        assert len({tuple(items(shopping_list)) for shopping_list in lists}) == 1, seed
+        assert len({shopping_list.digest() for shopping_list in lists}) == 1, seed
@@ -0,0 +1,108 @@
+import queue, threading, pytest
+from concurrent.futures import Future
+from communication.codec import compress_data, decompress_data
+from crdt.shopping_list import ShoppingList
+from dynamo.consistent_hash import ConsistentHash
+from dynamo.membership import MembershipService
+from dynamo.metrics import Metrics
+from dynamo.node import Node
+from storage.shopping_list_manager import ShoppingListManager
+from storage.storage_engine import StorageEngine
+
+LIST_ID = "list-1"
+REPLICAS = ["node1", "node2", "node3"]
+
+class ReplicationManager:
+    """Every request waits until the test answers it."""
+    def __init__(self):
+        self.futures = []
+
+    def get_replicas(self, key, count=None):
+        return REPLICAS
+
+    def send_payload(self, node_id, operation, payload):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def send(self, node_id, message):
+        return self.send_payload(node_id, message["operation"], compress_data(message))
+
+class HintedHandoff:
+    def add(self, target, list_id):
+        pass
+
+    def remove(self, target, list_ids):
+        pass
+
+class ReplicationScheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, list_id):
+        self.scheduled.append(list_id)
+
+@pytest.fixture
+def node(tmp_path):
+    # Only the state coordinated requests use: no sockets or request workers
+    node = Node.__new__(Node)
+    node.node_id = "node1"
+    node.membership = MembershipService(ConsistentHash())
+    node.catalog_lock = threading.Lock()
+    node.list_locks = {}
+    node.list_locks_lock = threading.Lock()
+    node.shopping_manager = ShoppingListManager()
+    node.storage = StorageEngine(str(tmp_path / "node1"), "none")
+    node.storage.recover(node.shopping_manager)
+    node.ack_jobs = queue.Queue()
+    node.replica_versions = {}
+    node.replica_contexts = {}
+    node.replica_versions_lock = threading.Lock()
+    node.replication_manager = ReplicationManager()
+    node.hinted_handoff = HintedHandoff()
+    node.replication_scheduler = ReplicationScheduler()
+    node.metrics = Metrics()
+    node.read_quorum = node.write_quorum = 2
+    threading.Thread(target=node.ack_worker, daemon=True).start()
+    yield node
+    node.storage.close()
+
+def write_request():
+    shopping_list = ShoppingList("client")
+    shopping_list.add_item("milk")
+    return decompress_data(compress_data({"operation": "write", "list_id": LIST_ID, "shopping_list": shopping_list}))
+
+def coordinate(node, operation, message):
+    replies = queue.Queue()
+    assert node.coordinate(operation, message, replies.put) is None
+    return replies
+
+def test_write_is_answered_once_a_replica_acknowledged_it(node):
+    replies = coordinate(node, "write", write_request())
+    # The worker is free while the replicas have not answered
+    assert replies.empty()
+
+    node.replication_manager.futures[0].set_result({"status": "success"})
+    response = decompress_data(replies.get(timeout=5))
+    assert response["node_id"] == "node1" and "message" not in response
+    assert replies.empty()
+
+def test_write_without_quorum_is_answered_once_every_replica_failed(node):
+    replies = coordinate(node, "write", write_request())
+    for future in node.replication_manager.futures:
+        future.set_result({"status": "error"})
+
+    response = decompress_data(replies.get(timeout=5))
+    assert response["message"] == "Write acknowledged by 1 of 2 replicas"
+    assert node.replication_scheduler.scheduled == [LIST_ID]
+
+def test_read_merges_the_replica_that_answered(node):
+    replica_list = ShoppingList("node2")
+    replica_list.add_item("eggs")
+    replies = coordinate(node, "read", {"operation": "read", "list_id": LIST_ID})
+    assert replies.empty()
+
+    node.replication_manager.futures[1].set_result({"status": "success", "node_id": "node3", "shopping_list": replica_list})
+    response = decompress_data(replies.get(timeout=5))
+    items = response["shopping_list"].get_shopping_list().values()
+    assert [item_name for item_name, _, _ in items] == ["eggs"]
@@ -0,0 +1,51 @@
+from crdt.shopping_list import ShoppingList
+from communication.codec import compress_data, decompress_data
+
+# Round-trip a list through the codec, as every write and replicate does
+def wire(shopping_list):
+    return decompress_data(compress_data({"shopping_list": shopping_list}))["shopping_list"]
+
+def item_names(shopping_list):
+    return sorted(item_name for item_name, _, _ in shopping_list.get_shopping_list().values())
+
+def test_delta_context_only_holds_its_own_dots():
+    client = ShoppingList("client")
+    client.add_item("milk")
+    version = client.get_version()
+    client.add_item("eggs")
+
+    delta = client.get_delta(version)
+    eggs = delta.or_map.items[client.get_item_id("eggs")]
+    assert delta.or_map.context.vv == {}
+    assert delta.or_map.context.cloud == {eggs.dot}
+
+def test_delta_merged_without_base_does_not_remove_items():
+    client = ShoppingList("client")
+    client.add_item("milk")
+    n1 = ShoppingList("n1")
+    n1.merge(wire(client))
+    version = client.get_version()
+    client.add_item("eggs")
+
+    # n2 never received milk, then n3 merges both full states
+    n2 = ShoppingList("n2")
+    n2.merge(wire(client.get_delta(version)))
+    n3 = ShoppingList("n3")
+    n3.merge(wire(n1))
+    n3.merge(wire(n2))
+
+    assert item_names(n2) == ["eggs"]
+    assert item_names(n3) == ["eggs", "milk"]
+
+def test_delta_carries_removals():
+    client = ShoppingList("client")
+    for item_name in ("bread", "eggs", "milk"):
+        client.add_item(item_name)
+    replica = ShoppingList("replica")
+    replica.merge(wire(client))
+    version = client.get_version()
+    client.remove_item(client.get_item_id("milk"))
+
+    replica.merge(wire(client.get_delta(version)))
+    assert item_names(replica) == ["bread", "eggs"]
+    assert replica.digest() == client.digest()
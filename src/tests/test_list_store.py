@@ -0,0 +1,46 @@
+from crdt.shopping_list import ShoppingList
+from storage.list_store import ListStore
+from storage.shopping_list_manager import ShoppingListManager
+
+def open_manager(data_dir, loaded_lists):
+    manager = ShoppingListManager(str(data_dir), loaded_lists)
+    manager.load_from_json()
+    return manager
+
+def test_changes_to_an_evicted_list_are_saved(tmp_path):
+    manager = open_manager(tmp_path, 1)
+    list_id = manager.create_shopping_list()
+    shopping_list = manager.get_shopping_list(list_id)
+    # Creating another list drops the first one from memory
+    manager.create_shopping_list()
+    assert list_id not in manager.shopping_lists.loaded
+
+    shopping_list.add_item("milk")
+    manager.mark_dirty(list_id)
+    manager.save_to_json()
+
+    assert open_manager(tmp_path, 1).get_item_id_by_name(list_id, "milk") is not None
+
+def test_evicted_list_still_held_is_found_again(tmp_path):
+    manager = open_manager(tmp_path, 1)
+    list_id = manager.create_shopping_list()
+    shopping_list = manager.get_shopping_list(list_id)
+    manager.create_shopping_list()
+
+    assert manager.get_shopping_list(list_id) is shopping_list
+    manager.add_item_to_list(list_id, "eggs")
+    assert shopping_list.get_item_id("eggs") is not None
+
+def test_evicted_list_no_longer_held_is_read_from_its_file(tmp_path):
+    store = ListStore(str(tmp_path), 1)
+    store["a"] = ShoppingList()
+    store["b"] = ShoppingList()
+    assert "a" not in store.loaded and "a" not in store.evicted
+    assert store["a"].get_shopping_list() == {}
+
+def test_lists_not_saved_to_files_are_not_tracked():
+    # Nodes keep their lists in the storage engine and never save them to files
+    manager = ShoppingListManager()
+    list_id = manager.create_shopping_list()
+    manager.add_item_to_list(list_id, "milk")
+    assert manager.dirty is None
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+from dynamo.consistent_hash import ConsistentHash
+from dynamo.membership import MembershipService
+from dynamo.rebalancer import Rebalancer
+
+NODES = [{"node_id": f"node{i}", "address": f"tcp://localhost:500{i}"} for i in range(1, 6)]
+LIST_IDS = [f"list-{i}" for i in range(200)]
+
+def make_node():
+    # Only the state find_moves uses: the node's ring starts with the node itself, as in run_node
+    ring = ConsistentHash()
+    ring.add_node("node1", "tcp://localhost:5001")
+    return SimpleNamespace(
+        node_id="node1",
+        membership=MembershipService(ring),
+        known_nodes={node["node_id"]: node for node in NODES},
+        replication_manager=SimpleNamespace(replication_factor=3),
+        shopping_manager=SimpleNamespace(shopping_lists=LIST_IDS))
+
+def test_gossip_converging_to_the_configured_ring_moves_nothing():
+    node = make_node()
+    rebalancer = Rebalancer(node)
+    for config in NODES[1:]:
+        node.membership.add_node(config["node_id"], config["address"])
+
+    assert rebalancer.find_moves(rebalancer.ring, node.membership.ring) == ({}, 0)
+
+def test_a_node_outside_the_configuration_gets_its_lists():
+    node = make_node()
+    rebalancer = Rebalancer(node)
+    for config in NODES[1:] + [{"node_id": "node6", "address": "tcp://localhost:5006"}]:
+        node.membership.add_node(config["node_id"], config["address"])
+
+    moves, _ = rebalancer.find_moves(rebalancer.ring, node.membership.ring)
+    assert list(moves) == ["node6"]
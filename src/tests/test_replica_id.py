@@ -0,0 +1,32 @@
+import pytest
+from crdt.causal_context import get_local_replica_id, set_local_replica_id
+from storage.shopping_list_manager import ShoppingListManager
+
+@pytest.fixture(autouse=True)
+def new_process():
+    # Each test starts as a process that did not set its replica ID yet
+    set_local_replica_id(None)
+    yield
+    set_local_replica_id(None)
+
+def test_client_replica_id_is_kept_with_the_lists(tmp_path):
+    manager = ShoppingListManager(str(tmp_path))
+    manager.load_from_json()
+    replica_id = get_local_replica_id()
+    list_id = manager.create_shopping_list()
+    manager.add_item_to_list(list_id, "milk")
+    manager.save_to_json()
+
+    # A later session adds its operations under the same replica ID
+    set_local_replica_id(None)
+    manager = ShoppingListManager(str(tmp_path))
+    manager.load_from_json()
+    assert get_local_replica_id() == replica_id
+    manager.add_item_to_list(list_id, "eggs")
+    assert manager.get_shopping_list(list_id).get_context() == {replica_id: 2}
+
+def test_clients_with_their_own_data_get_their_own_replica_ids(tmp_path):
+    ShoppingListManager(str(tmp_path / "a")).load_from_json()
+    first = get_local_replica_id()
+    ShoppingListManager(str(tmp_path / "b")).load_from_json()
+    assert get_local_replica_id() != first
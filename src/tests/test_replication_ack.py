@@ -0,0 +1,50 @@
+import queue, threading
+from concurrent.futures import Future
+from dynamo.node import Node
+
+class ReplicationManager:
+    """Requests are answered by the test, from a thread standing for the replication manager's I/O thread."""
+    def __init__(self):
+        self.futures = []
+
+    def send_payload(self, node_id, operation, payload):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+class HintedHandoff:
+    """Records the threads the hint log would be written from."""
+    def __init__(self):
+        self.threads = []
+
+    def add(self, target, list_id):
+        self.threads.append(threading.current_thread())
+
+    def remove(self, target, list_ids):
+        self.threads.append(threading.current_thread())
+
+def make_node():
+    # Only the state the replication acks use: no sockets, storage or request workers
+    node = Node.__new__(Node)
+    node.node_id = "node1"
+    node.ack_jobs = queue.Queue()
+    node.replica_versions = {}
+    node.replica_contexts = {}
+    node.replica_versions_lock = threading.Lock()
+    node.replication_manager = ReplicationManager()
+    node.hinted_handoff = HintedHandoff()
+    threading.Thread(target=node.ack_worker, daemon=True).start()
+    return node
+
+def test_acks_are_handled_off_the_io_thread():
+    node = make_node()
+    result = node.replicate_to_single_node("node2", "list-1", 3, b"request")
+    ack = {"status": "success", "context": {"client": 4}}
+    io_thread = threading.Thread(target=node.replication_manager.futures[0].set_result, args=(ack,))
+    io_thread.start()
+    io_thread.join()
+
+    assert result.result(timeout=5) == ack
+    assert node.replica_versions[("node2", "list-1")] == 3
+    assert node.replica_contexts[("node2", "list-1")] == {"client": 4}
+    assert node.hinted_handoff.threads and io_thread not in node.hinted_handoff.threads
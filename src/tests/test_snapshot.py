@@ -0,0 +1,48 @@
+import contextlib, threading, pytest
+from storage.shopping_list_manager import ShoppingListManager
+from storage.storage_engine import StorageEngine
+
+LIST_IDS = ("list-1", "list-2")
+
+def get_list_lock(list_id):
+    return threading.Lock()
+
+def item_names(shopping_list):
+    return sorted(item_name for item_name, _, _ in shopping_list.get_shopping_list().values())
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = StorageEngine(str(tmp_path), "none")
+    storage.manager = ShoppingListManager()
+    storage.recover(storage.manager)
+    for list_id in LIST_IDS:
+        storage.manager.create_shopping_list_with_id(list_id)
+        storage.manager.add_item_to_list(list_id, "milk")
+    yield storage
+    storage.close()
+
+def test_snapshot_drops_the_lists_it_holds_unchanged(storage):
+    storage.snapshot(storage.manager, get_list_lock, threading.Lock())
+    shopping_lists = storage.manager.shopping_lists
+    assert shopping_lists.loaded == {}
+    for list_id in LIST_IDS:
+        assert item_names(shopping_lists.peek(list_id)) == ["milk"]
+
+def test_lists_changed_since_the_snapshot_stay_in_memory(storage):
+    manager = storage.manager
+    storage.snapshot(manager, get_list_lock, threading.Lock())
+    for list_id in LIST_IDS:
+        manager.shopping_lists[list_id]
+
+    # A write to list-1 lands right after the next snapshot read it, before the snapshot replaces the older one
+    @contextlib.contextmanager
+    def write_after_snapshot(list_id):
+        yield
+        if list_id == "list-1" and manager.get_item_id_by_name(list_id, "eggs") is None:
+            manager.add_item_to_list(list_id, "eggs")
+
+    storage.snapshot(manager, write_after_snapshot, threading.Lock())
+    shopping_lists = manager.shopping_lists
+    assert list(shopping_lists.loaded) == ["list-1"]
+    assert item_names(shopping_lists["list-1"]) == ["eggs", "milk"]
+    assert item_names(shopping_lists["list-2"]) == ["milk"]
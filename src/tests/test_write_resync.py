@@ -0,0 +1,111 @@
+import threading, pytest
+from communication.client import Client
+from communication.codec import compress_data, decompress_data
+from crdt.shopping_list import ShoppingList
+from dynamo.node import Node
+from storage.shopping_list_manager import ShoppingListManager
+from storage.storage_engine import StorageEngine
+
+LIST_ID = "list-1"
+
+# Round-trip a message through the codec, as the proxy and the nodes do
+def wire(message):
+    return decompress_data(compress_data(message))
+
+def make_node(node_id, data_dir):
+    # Only the state handle_write uses: no sockets, threads or replicas
+    node = Node.__new__(Node)
+    node.node_id = node_id
+    node.catalog_lock = threading.Lock()
+    node.shopping_manager = ShoppingListManager()
+    node.storage = StorageEngine(str(data_dir / node_id), "none")
+    node.storage.recover(node.shopping_manager)
+    return node
+
+class RoutedClient(Client):
+    """A client whose writes reach the node the test points it to, as the proxy may pick any of them."""
+    def __init__(self, node):
+        self.node = node
+        self.server_availabilty = True
+        self.synced_versions = {}
+        self.requests = []
+
+    def send_request(self, operation, payload=None, list=None):
+        request = wire({"operation": operation, **payload, "shopping_list": list})
+        self.requests.append(request)
+        return wire(self.node.handle_write(request))
+
+@pytest.fixture
+def nodes(tmp_path):
+    nodes = [make_node("node1", tmp_path), make_node("node2", tmp_path)]
+    yield nodes
+    for node in nodes:
+        node.storage.close()
+
+def item_names(shopping_list):
+    return sorted(item_name for item_name, _, _ in shopping_list.get_shopping_list().values())
+
+def build_delta(node_id, since):
+    shopping_list = ShoppingList("client")
+    for item_name in ("bread", "eggs", "milk"):
+        shopping_list.add_item(item_name)
+    version = shopping_list.get_version()
+    shopping_list.add_item("rice")
+    return {"list_id": LIST_ID, "shopping_list": shopping_list.get_delta(version), "delta": True, "since": since, "since_node": node_id}
+
+def test_delta_without_the_list_asks_for_resync(nodes):
+    node1, _ = nodes
+    assert node1.handle_write(wire(build_delta("node1", 3))) == {"status": "resync"}
+    assert LIST_ID not in node1.shopping_manager.shopping_lists
+
+def test_delta_based_on_another_node_asks_for_resync(nodes):
+    node1, node2 = nodes
+    node2.shopping_manager.create_shopping_list_with_id(LIST_ID)
+    assert node2.handle_write(wire(build_delta("node1", 0))) == {"status": "resync"}
+
+def test_delta_based_on_a_later_version_asks_for_resync(nodes):
+    node1, _ = nodes
+    node1.shopping_manager.create_shopping_list_with_id(LIST_ID)
+    assert node1.handle_write(wire(build_delta("node1", 5))) == {"status": "resync"}
+
+def test_client_sends_the_full_list_after_resync(nodes):
+    node1, node2 = nodes
+    shopping_list = ShoppingList("client")
+    for item_name in ("bread", "eggs", "milk"):
+        shopping_list.add_item(item_name)
+    client = RoutedClient(node1)
+    client.write_shopping_list(shopping_list, LIST_ID)
+    assert not client.requests[-1]["delta"]
+
+    # The next write is a delta on top of node1's state, node2 never saw the list
+    shopping_list.add_item("rice")
+    client.node = node2
+    shopping_list = client.write_shopping_list(shopping_list, LIST_ID)
+
+    delta_request, full_request = client.requests[1:]
+    assert delta_request["delta"] and not full_request["delta"]
+    assert item_names(node2.shopping_manager.shopping_lists[LIST_ID]) == ["bread", "eggs", "milk", "rice"]
+    assert client.synced_versions[LIST_ID][2] == "node2"
+
+    # Further deltas go to node2, which now holds their base
+    shopping_list.add_item("salt")
+    client.write_shopping_list(shopping_list, LIST_ID)
+    assert client.requests[-1]["delta"]
+    assert item_names(node2.shopping_manager.shopping_lists[LIST_ID]) == ["bread", "eggs", "milk", "rice", "salt"]
+
+def test_client_sends_the_full_list_after_reloading_it(nodes):
+    node1, _ = nodes
+    shopping_list = ShoppingList("client")
+    for item_name in ("bread", "eggs", "milk"):
+        shopping_list.add_item(item_name)
+    client = RoutedClient(node1)
+    client.write_shopping_list(shopping_list, LIST_ID)
+
+    # Decoded again, as after being evicted from memory: its versions start over, and soon pass the acknowledged one
+    shopping_list = wire({"shopping_list": shopping_list})["shopping_list"]
+    for i in range(7):
+        shopping_list.add_item(f"new{i}")
+    client.write_shopping_list(shopping_list, LIST_ID)
+
+    assert not client.requests[-1]["delta"]
+    assert len(item_names(node1.shopping_manager.shopping_lists[LIST_ID])) == 10